@@ -1,4 +1,7 @@
+#include <ctype.h>
+#include <time.h>
 #include "Python.h"
+#include "structmember.h"
 #include "stplugin.h"
 
 
@@ -8,100 +11,173 @@
 
 PyObject *Py_MISSING = NULL ; /* Python version of Stata's "." missing value */
 PyObject *Py_MissingValueCls = NULL ; /* the missing value class */
-PyObject *Py_GetMissing = NULL ; /* returns MissingValue instance for float */
-
-char varnames[32767][33] ; /* all Stata variable names at each invocation */
+PyObject *Py_MissingVals[27] ; /* MISSING_VALS, i.e., ., .a, ..., .z */
+
+/* Index of all Stata variable names. Names are stored back to back in
+one buffer, and `sorted` holds the variable numbers in order of name.
+Names sharing a prefix are then adjacent in `sorted`, so exact names
+and abbreviations are both resolved with one binary search.
+
+The index is kept between plugin calls. At each call the names are
+gathered into one space-delimited list, and the index is rebuilt only
+if the signature of that list (its length, number of names, and hash)
+differs from the one the index was built from. */
+typedef struct
+{
+	long nvars ;
+	char *pool ;    /* names, each null-terminated */
+	int *offsets ;  /* name of variable i starts at pool + offsets[i] */
+	int *sorted ;   /* variable numbers, sorted by name */
+	size_t bytes ;  /* memory allocated for index */
+	double build_time ; /* seconds taken to build index */
+	size_t sig_len ;    /* signature of list index was built from */
+	unsigned long long sig_hash ;
+	long reuses ;   /* calls where index was reused */
+	long builds ;   /* calls where index was (re)built */
+	long hits ;     /* lookups of names found in index */
+	long misses ;   /* lookups of names not found in index */
+} varname_index ;
+
+varname_index varnames = {0, NULL, NULL, NULL, 0, 0.0, 0, 0, 0, 0, 0, 0} ;
 long num_stata_vars = 0 ;
 
-/* adapted from http://en.wikipedia.org/wiki/Trie#A_C_version */
-typedef struct trie
+/* number of times the plugin has been called; the data set's 
+variables and observations can change only between calls */
+long num_plugin_calls = 0 ;
+
+/* Information about the data set, gathered once at each plugin call 
+(the data set cannot change while the plugin runs), so that getting or 
+setting a single value doesn't need to ask Stata for it again. */
+typedef struct
 {
-	int varnum ;
-	int prefixes ;
-	struct trie *edges[63] ;
-} trie ;
+	ST_int nobs ;
+	ST_int nvar ;
+	ST_int in1 ;    /* 1-based and inclusive, as from SF_in1 and SF_in2 */
+	ST_int in2 ;
+	unsigned char *isstr ;  /* 1 if variable j is string, else 0 */
+	size_t size ;   /* memory allocated for isstr */
+} data_context ;
+
+data_context context = {0, 0, 1, 0, NULL, 0} ;
+
+/* whether variable j (0-based) is string; asks Stata if the context
+could not be allocated */
+#define VAR_ISSTR(j) \
+	(context.isstr != NULL ? context.isstr[(j)] : SF_isstr((j) + 1))
+
+#define VARNAME(i) (varnames.pool + varnames.offsets[(i)])
 
-trie *varnames_trie ;
- 
-static trie * 
-trie_initialize(trie *node)
+static void
+varname_index_free(void)
 {
-	int i ;
-	if (node == NULL)
-		node = (trie *) malloc(sizeof(trie)) ;
-	node->varnum = -1 ;
-	node->prefixes = 0 ;
-	
-	/* 63 allowed characters: underscore, numbers, a-z, and A-Z */
-	for (i = 0; i < 63; i++) 
-		node->edges[i] = NULL ;
-	return node ;
+	free(varnames.pool) ;
+	free(varnames.offsets) ;
+	free(varnames.sorted) ;
+	varnames.pool = NULL ;
+	varnames.offsets = NULL ;
+	varnames.sorted = NULL ;
+	varnames.nvars = 0 ;
+	varnames.bytes = 0 ;
+	varnames.sig_len = 0 ;
+	varnames.sig_hash = 0 ;
 }
 
-static int 
-trie_char_index(char s)
+static int
+varname_cmp(const void *a, const void *b)
+{
+	return strcmp(VARNAME(*(const int *) a), VARNAME(*(const int *) b)) ;
+}
+
+static unsigned long long
+names_hash(const char *text, size_t len)
+{
+	unsigned long long hash = 14695981039346656037ULL ; /* FNV-1a */
+	size_t k ;
+
+	for (k = 0; k < len; k++)
+		hash = (hash ^ (unsigned char) text[k]) * 1099511628211ULL ;
+	return hash ;
+}
+
+/* Make sure index matches `text`, a list of nvars names, each followed
+by a single space. The index is only rebuilt if the signature of `text`
+has changed. Returns -1 if out of memory, in which case the index is
+left empty. */
+static int
+varname_index_update(const char *text, size_t len, long nvars)
 {
-	if (s == '_') {
+	unsigned long long hash ;
+	clock_t start ;
+	size_t k ;
+	long i ;
+
+	hash = names_hash(text, len) ;
+	if (varnames.pool != NULL && varnames.nvars == nvars &&
+			varnames.sig_len == len && varnames.sig_hash == hash) {
+		varnames.reuses++ ;
 		return 0 ;
 	}
-	else if (s >= '0' && s <= '9') {
-		return s - '0' + 1 ;
-	}
-	else if (s >= 'a' && s <= 'z') {
-		return s - 'a' + 11 ;
-	}
-	else if (s >= 'A' && s <= 'Z') {
-		return s - 'A' + 37 ;
-	}
-	else {
+
+	start = clock() ;
+	varnames.builds++ ;
+	varname_index_free() ;
+	varnames.pool = (char *) malloc(len > 0 ? len : 1) ;
+	varnames.offsets = (int *) malloc((nvars > 0 ? nvars : 1) * sizeof(int)) ;
+	varnames.sorted = (int *) malloc((nvars > 0 ? nvars : 1) * sizeof(int)) ;
+	if (varnames.pool == NULL || varnames.offsets == NULL ||
+			varnames.sorted == NULL) {
+		varname_index_free() ;
 		return -1 ;
 	}
-}
- 
-static trie * 
-trie_add_word(trie *ver, char *str, int varnum)
-{
-	char s ;
-	int k ;
-	
-	s = str[0] ;
-	if(s == '\0') {
-		ver->varnum = varnum ;
-	}
-	else {
-		ver->prefixes = (ver->prefixes) + 1 ;
-		k = trie_char_index(s) ;
-		if (k == -1) {
-			/* This is really weak protection against illegal characters.
-			User should make sure that _pyallvars`i' is a varname. */
-			return ver ;
+
+	/* one pass over text, ending each name at its delimiter */
+	i = 0 ;
+	if (nvars > 0)
+		varnames.offsets[0] = 0 ;
+	for (k = 0; k < len && i < nvars; k++) {
+		if (text[k] == ' ') {
+			varnames.pool[k] = '\0' ;
+			varnames.sorted[i] = (int) i ;
+			i++ ;
+			if (i < nvars)
+				varnames.offsets[i] = (int) (k + 1) ;
 		}
-		str++ ;
-		if(ver->edges[k] == NULL) {
-			ver->edges[k] = trie_initialize(ver->edges[k]) ;
+		else {
+			varnames.pool[k] = text[k] ;
 		}
-		ver->edges[k] = trie_add_word(ver->edges[k], str, varnum) ;
 	}
-	return ver ;
+	varnames.nvars = i ;
+
+	qsort(varnames.sorted, varnames.nvars, sizeof(int), varname_cmp) ;
+
+	varnames.bytes = len + 2 * nvars * sizeof(int) ;
+	varnames.sig_len = len ;
+	varnames.sig_hash = hash ;
+	varnames.build_time = (double) (clock() - start) / CLOCKS_PER_SEC ;
+	return 0 ;
 }
 
 static int 
-trie_free(trie *node)
+is_name_char(char s)
 {
-	int k ;
-	for (k = 0; k < 63; k++) {
-		if(node->edges[k] != NULL)
-			trie_free(node->edges[k]) ;
-	}
-	free(node) ;
-	return 0 ;
+	/* 63 allowed characters: underscore, numbers, a-z, and A-Z */
+	return s == '_' || (s >= '0' && s <= '9') ||
+		(s >= 'a' && s <= 'z') || (s >= 'A' && s <= 'Z') ;
+}
+
+/* Return 1 if `prefix` is a prefix of name of variable varnum */
+static int
+varname_has_prefix(int varnum, const char *prefix, size_t len)
+{
+	return strncmp(VARNAME(varnum), prefix, len) == 0 ;
 }
 
 static int 
 findvar(char *name, char abbr_ok)
 {
-	int i, k, foundNext ;
-	trie *node = varnames_trie ;
+	long lo, hi, mid ;
+	size_t i ;
+	int *sorted = varnames.sorted ;
 
 	if (name[0] == '\0') {
 		PyErr_SetString(PyExc_ValueError, 
@@ -110,393 +186,2100 @@ findvar(char *name, char abbr_ok)
 	}
 
 	for (i = 0; name[i] != '\0'; i++) {
-		k = trie_char_index(name[i]) ;
-		if (k == -1) {
+		if (!is_name_char(name[i])) {
 			PyErr_SetString(PyExc_ValueError, 
 				"argument cannot be Stata variable name") ;
 			return -1 ;
 		}
-		node = node->edges[k] ;
-		if(node == NULL) {
-			PyErr_SetString(PyExc_ValueError, 
-				"no Stata variable found") ;
-			return -1 ;
-		}
 	}
 
-	/* if node->varnum != -1, then we have an exact match */
-	if (node->varnum != -1)
-		return node->varnum ;
+	/* find first name not less than `name`; names that start
+	with `name`, if any, begin there */
+	lo = 0 ;
+	hi = varnames.nvars ;
+	while (lo < hi) {
+		mid = lo + (hi - lo) / 2 ;
+		if (strcmp(VARNAME(sorted[mid]), name) < 0)
+			lo = mid + 1 ;
+		else
+			hi = mid ;
+	}
+
+	if (lo == varnames.nvars || !varname_has_prefix(sorted[lo], name, i)) {
+		varnames.misses++ ;
+		PyErr_SetString(PyExc_ValueError, 
+			"no Stata variable found") ;
+		return -1 ;
+	}
+
+	/* an exact match sorts before any longer name with same prefix */
+	if (VARNAME(sorted[lo])[i] == '\0') {
+		varnames.hits++ ;
+		return sorted[lo] ;
+	}
 
 	/* no exact match, keep looking */
 	if (!abbr_ok) {
+		varnames.misses++ ;
 		PyErr_SetString(PyExc_ValueError,
 			"no Stata variable found (abbrev. not allowed)") ;
 		return -1 ;
 	}
 
-	if (node->prefixes > 1) {
+	if (lo + 1 < varnames.nvars && 
+			varname_has_prefix(sorted[lo + 1], name, i)) {
+		varnames.misses++ ;
 		PyErr_SetString(PyExc_ValueError,
 			"ambiguous abbreviation") ;
 		return -1 ;
 	}
 
-	while (node->varnum == -1 && node != NULL) {
-		foundNext = 0 ;
-		for (i = 0; i < 63; i++) {
-			if (node->edges[i] != NULL) {
-				node = node->edges[i] ;
-				foundNext = 1 ;
-				break ;
-			}
-		}
-		if (!foundNext) {
-			PyErr_SetString(PyExc_ValueError,
-				"internal error; can't find variable") ;
-			return -1 ;
-		}
-	}
-	return node->varnum ;
+	varnames.hits++ ;
+	return sorted[lo] ;
 }
 
-static PyObject *
-_st_display(PyObject *self, PyObject *args)
+static int
+missing_index(ST_double z)
 {
-	char *toDisplay ;
-	
-	if (!PyArg_ParseTuple(args, "s", &toDisplay))
-		return NULL ;
-	
-	SF_display(toDisplay) ;
-	
-	Py_INCREF(Py_None) ;
-	return Py_None ;
+	/* Stata's 27 regular missing values ., .a, ..., .z have the bit
+	patterns 0x7fe0000000000000 + (k << 40), k = 0, ..., 26. Anything
+	else in the missing range is treated as . (as in get_missing). */
+	unsigned long long bits ;
+	long long k ;
+
+	memcpy(&bits, &z, sizeof(bits)) ;
+	k = (long long) (bits >> 40) - 0x7fe000 ;
+	if (k < 0 || k > 26)
+		return 0 ;
+	return (int) k ;
 }
 
-static PyObject *
-_st_error(PyObject *self, PyObject *args)
+/* Stata's value for MISSING_VALS[k] */
+static ST_double
+missing_value(int k)
 {
-	char *toDisplay ;
-	
-	if (!PyArg_ParseTuple(args, "s", &toDisplay))
-		return NULL ;
-	
-	SF_error(toDisplay) ;
-	
-	Py_INCREF(Py_None) ;
-	return Py_None ;
+	unsigned long long bits ;
+	ST_double z ;
+
+	bits = 0x7fe0000000000000ULL + ((unsigned long long) k << 40) ;
+	memcpy(&z, &bits, sizeof(z)) ;
+	return z ;
 }
 
-static PyObject *
-_st_data(PyObject *self, PyObject *args)
+/* MissingValue type, mimicking some of the properties of Stata's 27
+regular missing values ., .a, ..., .z. Only the 27 instances made when
+the module is initialized exist; they are kept in Py_MissingVals. */
+typedef struct
 {
-	ST_int i, j, nobs ;
-	ST_double z ;
-	ST_retcode rc ;
-	PyObject *mv ;
+	PyObject_HEAD
+	int index ;
+	double value ;
+	PyObject *name ;
+	Py_hash_t hash ;
+} MissingValueObject ;
 
-	if (!PyArg_ParseTuple(args, "ii", &i, &j))
-		return NULL ;
+static PyTypeObject MissingValueType ;
 
-	/* check that variable and observation numbers make sense */
-	nobs = SF_nobs() ;
-	if (i < -nobs || i >= nobs) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata observation number out of range") ;
-		return NULL ;
-	}
-	if (j < -num_stata_vars || j >= num_stata_vars) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata variable number out of range") ;
-		return NULL ;
-	}
+#define MissingValue_Check(op) (Py_TYPE(op) == &MissingValueType)
+#define MV_VALUE(op) (((MissingValueObject *) (op))->value)
 
-	/* convert negative indices to positive */
-	if (i < 0)
-		i = nobs + i ;
-	if (j < 0)
-		j = num_stata_vars + j ;
+static PyObject *
+MissingValue_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+	int index ;
+	static char *kwlist[] = {"index", NULL} ;
 
-	/* check to make sure variable is numeric */
-	if (SF_isstr(j + 1)) {
-		PyErr_SetString(PyExc_TypeError, 
-			"Stata variable is string") ;
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "i", kwlist, &index))
 		return NULL ;
-	}
-
-	/* Using i + 1 and j + 1 since python index starts from 0.
-	Also switch order of i and j because plugin uses opposite order */
-	rc = SF_vdata(j + 1, i + 1, &z) ;
-	if (rc) {
-		PyErr_SetString(PyExc_Exception, 
-			"error in retrieving Stata numeric value") ;
+	if (index < 0 || index > 26) {
+		PyErr_SetString(PyExc_ValueError,
+			"index should be in range(27)") ;
 		return NULL ;
 	}
+	Py_INCREF(Py_MissingVals[index]) ;
+	return Py_MissingVals[index] ;
+}
 
-	if (SF_is_missing(z)) {
-		/* must be large float */
-		mv = PyObject_CallObject(Py_GetMissing, Py_BuildValue("(d)", z)) ;
-		Py_INCREF(mv) ; 
-		return mv ;
-	}
-	
-	return PyFloat_FromDouble(z) ;
+static void
+MissingValue_dealloc(MissingValueObject *self)
+{
+	Py_XDECREF(self->name) ;
+	PyObject_Del(self) ;
 }
 
 static PyObject *
-_st_store(PyObject *self, PyObject *args)
+MissingValue_repr(MissingValueObject *self)
 {
-	ST_int i, j, nobs ;
-	ST_double val ;
-	ST_retcode rc ;
-	Py_ssize_t nargs ;
-	PyObject *pyob ;
-	
-	nargs = PyTuple_Size(args) ;
-	if (nargs != 3) {
-		PyErr_SetString(PyExc_TypeError,
-			"function takes exactly 3 arguments") ;
-		return NULL ;
+	Py_INCREF(self->name) ;
+	return self->name ;
+}
+
+static Py_hash_t
+MissingValue_hash(MissingValueObject *self)
+{
+	return self->hash ;
+}
+
+static PyObject *
+MissingValue_richcompare(PyObject *self, PyObject *other, int op)
+{
+	double x, y ;
+	int result ;
+	PyObject *value, *cmp ;
+
+	x = MV_VALUE(self) ;
+	if (MissingValue_Check(other)) {
+		y = MV_VALUE(other) ;
 	}
-	
-	/* check if value is float, None, or instance of MissingValueCls */
-	if (!PyArg_ParseTuple(args, "iid", &i, &j, &val)) { /* test for float */
-		PyErr_Clear() ;
-		if (!PyArg_ParseTuple(args, "iiO", &i, &j, &pyob)) {
-			/* probably only get here if 1st or 2nd arg not int  */
-			return NULL ;
-		}
-		/* check whether pyob is MissingValue or None or something else */
-		if (PyObject_IsInstance(pyob, Py_MissingValueCls)) {
-			val = PyFloat_AsDouble(PyObject_GetAttrString(pyob, "value")) ;
-		}
-		else if (pyob == Py_None) {
-			val = SV_missval ;
-		}
-		else {
-			PyErr_SetString(PyExc_TypeError, 
-				"set value should be float, None, or a missing value") ;
+	else if (PyFloat_CheckExact(other)) {
+		y = PyFloat_AS_DOUBLE(other) ;
+	}
+	else {
+		/* anything else compares as self.value would */
+		value = PyFloat_FromDouble(x) ;
+		if (value == NULL)
 			return NULL ;
-		}
+		cmp = PyObject_RichCompare(value, other, op) ;
+		Py_DECREF(value) ;
+		return cmp ;
 	}
 
-	/* check that variable and observation numbers make sense */
-	nobs = SF_nobs() ;
-	if (i < -nobs || i >= nobs) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata observation number out of range") ;
-		return NULL ;
-	}
-	if (j < -num_stata_vars || j >= num_stata_vars) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata variable number out of range") ;
-		return NULL ;
+	switch (op) {
+		case Py_LT: result = x <  y ; break ;
+		case Py_LE: result = x <= y ; break ;
+		case Py_EQ: result = x == y ; break ;
+		case Py_NE: result = x != y ; break ;
+		case Py_GT: result = x >  y ; break ;
+		default:    result = x >= y ; break ;
 	}
+	return PyBool_FromLong(result) ;
+}
 
-	/* convert negative indices to positive */
-	if (i < 0)
-		i = nobs + i ;
-	if (j < 0)
-		j = num_stata_vars + j ;
+/* arithmetic with a missing value gives . */
+static PyObject *
+MissingValue_absorb(PyObject *self, PyObject *other)
+{
+	Py_INCREF(Py_MissingVals[0]) ;
+	return Py_MissingVals[0] ;
+}
 
-	/* check to make sure variable is numeric */
-	if (SF_isstr(j + 1)) {
-		PyErr_SetString(PyExc_TypeError, 
-			"Stata variable is string") ;
-		return NULL ;
-	}
+static PyObject *
+MissingValue_divmod(PyObject *self, PyObject *other)
+{
+	return PyTuple_Pack(2, Py_MissingVals[0], Py_MissingVals[0]) ;
+}
 
-	/* Using i + 1 and j + 1 since python index starts from 0.
-	Also switch order of i and j because plugin uses opposite order. */
-	rc = SF_vstore(j + 1, i + 1, val) ; 
-	if (rc) {
-		PyErr_SetString(PyExc_Exception, 
-			"error in setting Stata numeric value") ;
-		return NULL ;
-	}
-	
-	Py_INCREF(Py_None) ;
-	return Py_None ;
+static PyObject *
+MissingValue_pow(PyObject *self, PyObject *other, PyObject *mod)
+{
+	Py_INCREF(Py_MissingVals[0]) ;
+	return Py_MissingVals[0] ;
 }
 
 static PyObject *
-_st_sdata(PyObject *self, PyObject *args)
+MissingValue_unary(PyObject *self)
 {
-	ST_int i, j, nobs ;
-	char s[245] ;
-	ST_retcode rc ;
+	Py_INCREF(Py_MissingVals[0]) ;
+	return Py_MissingVals[0] ;
+}
 
-	if (!PyArg_ParseTuple(args, "ii", &i, &j))
+static PyObject *
+MissingValue_self(PyObject *self)
+{
+	Py_INCREF(self) ;
+	return self ;
+}
+
+static int
+MissingValue_bool(PyObject *self)
+{
+	return 1 ;
+}
+
+static PyObject *
+MissingValue_round(PyObject *self, PyObject *args)
+{
+	PyObject *ndigits = NULL ;
+
+	if (!PyArg_ParseTuple(args, "|O:__round__", &ndigits))
 		return NULL ;
+	Py_INCREF(self) ;
+	return self ;
+}
 
-	/* check that variable and observation numbers make sense */
-	nobs = SF_nobs() ;
-	if (i < -nobs || i >= nobs) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata observation number out of range") ;
+/* pickle, copy, and deepcopy give the same instance, MISSING_VALS[k] */
+static PyObject *
+MissingValue_reduce(MissingValueObject *self, PyObject *unused)
+{
+	return Py_BuildValue("(O(i))", (PyObject *) Py_TYPE(self), self->index) ;
+}
+
+static PyNumberMethods MissingValue_as_number = {
+	MissingValue_absorb,     /* nb_add */
+	MissingValue_absorb,     /* nb_subtract */
+	MissingValue_absorb,     /* nb_multiply */
+	MissingValue_absorb,     /* nb_remainder */
+	MissingValue_divmod,     /* nb_divmod */
+	MissingValue_pow,        /* nb_power */
+	MissingValue_unary,      /* nb_negative */
+	MissingValue_unary,      /* nb_positive */
+	MissingValue_self,       /* nb_absolute */
+	MissingValue_bool,       /* nb_bool */
+	0,                       /* nb_invert */
+	0,                       /* nb_lshift */
+	0,                       /* nb_rshift */
+	0,                       /* nb_and */
+	0,                       /* nb_xor */
+	0,                       /* nb_or */
+	0,                       /* nb_int */
+	0,                       /* nb_reserved */
+	0,                       /* nb_float */
+	0,                       /* nb_inplace_add */
+	0,                       /* nb_inplace_subtract */
+	0,                       /* nb_inplace_multiply */
+	0,                       /* nb_inplace_remainder */
+	0,                       /* nb_inplace_power */
+	0,                       /* nb_inplace_lshift */
+	0,                       /* nb_inplace_rshift */
+	0,                       /* nb_inplace_and */
+	0,                       /* nb_inplace_xor */
+	0,                       /* nb_inplace_or */
+	MissingValue_absorb,     /* nb_floor_divide */
+	MissingValue_absorb,     /* nb_true_divide */
+} ;
+
+static PyMethodDef MissingValue_methods[] = {
+	{"__round__", MissingValue_round, METH_VARARGS, NULL},
+	{"__reduce__", (PyCFunction) MissingValue_reduce, METH_NOARGS, NULL},
+	{NULL, NULL, 0, NULL} /* Sentinel */
+} ;
+
+static PyMemberDef MissingValue_members[] = {
+	{"value", T_DOUBLE, offsetof(MissingValueObject, value), READONLY,
+	 "float used by Stata for this missing value"},
+	{"name", T_OBJECT, offsetof(MissingValueObject, name), READONLY,
+	 "name of missing value, i.e., \".\", \".a\", ..., \".z\""},
+	{"index", T_INT, offsetof(MissingValueObject, index), READONLY,
+	 "position of missing value in MISSING_VALS"},
+	{NULL} /* Sentinel */
+} ;
+
+static PyTypeObject MissingValueType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"stata_plugin.MissingValue",            /* tp_name */
+	sizeof(MissingValueObject),             /* tp_basicsize */
+	0,                                      /* tp_itemsize */
+	(destructor) MissingValue_dealloc,      /* tp_dealloc */
+	0,                                      /* tp_print */
+	0,                                      /* tp_getattr */
+	0,                                      /* tp_setattr */
+	0,                                      /* tp_reserved */
+	(reprfunc) MissingValue_repr,           /* tp_repr */
+	&MissingValue_as_number,                /* tp_as_number */
+	0,                                      /* tp_as_sequence */
+	0,                                      /* tp_as_mapping */
+	(hashfunc) MissingValue_hash,           /* tp_hash */
+	0,                                      /* tp_call */
+	(reprfunc) MissingValue_repr,           /* tp_str */
+	0,                                      /* tp_getattro */
+	0,                                      /* tp_setattro */
+	0,                                      /* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,                     /* tp_flags */
+	"A class to mimic some of the properties of Stata's missing values.\n\n"
+	"The class is intended for mimicking only the 27 regular missing\n"
+	"values ., .a, .b, .c, etc.\n\n"
+	"Users wanting MissingValue instances should access members of\n"
+	"MISSING_VALS. MissingValue(index) returns MISSING_VALS[index].",
+	                                        /* tp_doc */
+	0,                                      /* tp_traverse */
+	0,                                      /* tp_clear */
+	MissingValue_richcompare,               /* tp_richcompare */
+	0,                                      /* tp_weaklistoffset */
+	0,                                      /* tp_iter */
+	0,                                      /* tp_iternext */
+	MissingValue_methods,                   /* tp_methods */
+	MissingValue_members,                   /* tp_members */
+	0,                                      /* tp_getset */
+	0,                                      /* tp_base */
+	0,                                      /* tp_dict */
+	0,                                      /* tp_descr_get */
+	0,                                      /* tp_descr_set */
+	0,                                      /* tp_dictoffset */
+	0,                                      /* tp_init */
+	0,                                      /* tp_alloc */
+	MissingValue_new,                       /* tp_new */
+} ;
+
+/* Make the 27 MissingValue instances and put them in Py_MissingVals;
+returns tuple of the instances, or NULL on error */
+static PyObject *
+make_missing_vals(void)
+{
+	MissingValueObject *mv ;
+	PyObject *value, *vals ;
+	char name[3] ;
+	int k ;
+
+	vals = PyTuple_New(27) ;
+	if (vals == NULL)
 		return NULL ;
+	for (k = 0; k < 27; k++) {
+		mv = PyObject_New(MissingValueObject, &MissingValueType) ;
+		if (mv == NULL) {
+			Py_DECREF(vals) ;
+			return NULL ;
+		}
+		mv->index = k ;
+		mv->value = missing_value(k) ;
+		name[0] = '.' ;
+		name[1] = k == 0 ? '\0' : (char) ('a' + k - 1) ;
+		name[2] = '\0' ;
+		mv->name = PyUnicode_FromString(name) ;
+		value = PyFloat_FromDouble(mv->value) ;
+		mv->hash = value == NULL ? -1 : PyObject_Hash(value) ;
+		Py_XDECREF(value) ;
+		PyTuple_SET_ITEM(vals, k, (PyObject *) mv) ;
+		if (mv->name == NULL || mv->hash == -1) {
+			Py_DECREF(vals) ;
+			return NULL ;
+		}
 	}
-	if (j < -num_stata_vars || j >= num_stata_vars) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata variable number out of range") ;
-		return NULL ;
+	for (k = 0; k < 27; k++) {
+		Py_MissingVals[k] = PyTuple_GET_ITEM(vals, k) ;
+		Py_INCREF(Py_MissingVals[k]) ;
 	}
+	return vals ;
+}
 
-	/* convert negative indices to positive */
-	if (i < 0)
-		i = nobs + i ;
+/* Return new reference to MissingValue instance for missing value z,
+decoded from bits of z with no call into Python */
+static PyObject *
+missing_object(ST_double z)
+{
+	PyObject *mv = Py_MissingVals[missing_index(z)] ;
+
+	Py_INCREF(mv) ;
+	return mv ;
+}
+
+/* Return Stata value of MissingValue instance pyob */
+static ST_double
+missing_as_double(PyObject *pyob)
+{
+	PyObject *value ;
+	ST_double z ;
+
+	if (MissingValue_Check(pyob))
+		return MV_VALUE(pyob) ;
+
+	value = PyObject_GetAttrString(pyob, "value") ;
+	if (value == NULL) {
+		PyErr_Clear() ;
+		return SV_missval ;
+	}
+	z = PyFloat_AsDouble(value) ;
+	Py_DECREF(value) ;
+	return z ;
+}
+
+/* Observation selection used by the bulk transfer functions.
+An observation spec is either a Python range object or an object
+supporting the buffer protocol holding C integers (e.g., array('l')). */
+typedef struct
+{
+	Py_ssize_t count ;
+	Py_ssize_t start ;
+	Py_ssize_t step ;
+	int has_view ;
+	Py_buffer view ;
+} obs_spec ;
+
+static int
+get_range_attr(PyObject *range, char *name, Py_ssize_t *value)
+{
+	PyObject *attr ;
+
+	attr = PyObject_GetAttrString(range, name) ;
+	if (attr == NULL)
+		return -1 ;
+	*value = PyLong_AsSsize_t(attr) ;
+	Py_DECREF(attr) ;
+	if (*value == -1 && PyErr_Occurred())
+		return -1 ;
+	return 0 ;
+}
+
+static int
+obs_spec_init(PyObject *pyob, obs_spec *spec)
+{
+	spec->has_view = 0 ;
+
+	if (PyObject_TypeCheck(pyob, &PyRange_Type)) {
+		if (get_range_attr(pyob, "start", &spec->start) ||
+				get_range_attr(pyob, "step", &spec->step))
+			return -1 ;
+		spec->count = PyObject_Size(pyob) ;
+		if (spec->count < 0)
+			return -1 ;
+		return 0 ;
+	}
+
+	if (PyObject_GetBuffer(pyob, &spec->view,
+			PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+		PyErr_SetString(PyExc_TypeError,
+			"observations should be range or buffer of int") ;
+		return -1 ;
+	}
+	if (spec->view.format == NULL ||
+			strchr("ilqn", spec->view.format[0]) == NULL ||
+			(spec->view.itemsize != 4 && spec->view.itemsize != 8)) {
+		PyBuffer_Release(&spec->view) ;
+		PyErr_SetString(PyExc_TypeError,
+			"observation buffer should hold signed ints") ;
+		return -1 ;
+	}
+	spec->has_view = 1 ;
+	spec->count = spec->view.len / spec->view.itemsize ;
+	return 0 ;
+}
+
+static void
+obs_spec_release(obs_spec *spec)
+{
+	if (spec->has_view) {
+		PyBuffer_Release(&spec->view) ;
+		spec->has_view = 0 ;
+	}
+}
+
+/* Return 0-based observation number of k-th entry of spec,
+or -1 with IndexError set if out of range. */
+static Py_ssize_t
+obs_spec_item(obs_spec *spec, Py_ssize_t k, Py_ssize_t nobs)
+{
+	Py_ssize_t i ;
+
+	if (!spec->has_view)
+		i = spec->start + k * spec->step ;
+	else if (spec->view.itemsize == 4)
+		i = (Py_ssize_t) ((int *) spec->view.buf)[k] ;
+	else
+		i = (Py_ssize_t) ((long long *) spec->view.buf)[k] ;
+
+	/* convert negative index to positive */
+	if (i < 0)
+		i = nobs + i ;
+	if (i < 0 || i >= nobs) {
+		PyErr_SetString(PyExc_IndexError,
+			"Stata observation number out of range") ;
+		return -1 ;
+	}
+	return i ;
+}
+
+/* Check all entries of spec before anything is written, so that a bad
+index does not leave a store half done. Returns -1 with IndexError set
+if any entry is out of range. */
+static int
+obs_spec_check(obs_spec *spec, Py_ssize_t nobs)
+{
+	Py_ssize_t k ;
+
+	if (spec->count == 0)
+		return 0 ;
+
+	/* valid indices form an interval, so checking ends of range is enough */
+	if (!spec->has_view) {
+		if (obs_spec_item(spec, 0, nobs) < 0 ||
+				obs_spec_item(spec, spec->count - 1, nobs) < 0)
+			return -1 ;
+		return 0 ;
+	}
+
+	for (k = 0; k < spec->count; k++) {
+		if (obs_spec_item(spec, k, nobs) < 0)
+			return -1 ;
+	}
+	return 0 ;
+}
+
+/* Check variable index and convert negative index to positive.
+Returns -1 with Python error set if index out of range or variable
+is not of requested type (string or numeric). */
+static ST_int
+get_bulk_varnum(ST_int j, int want_str)
+{
+	if (j < -num_stata_vars || j >= num_stata_vars) {
+		PyErr_SetString(PyExc_IndexError,
+			"Stata variable number out of range") ;
+		return -1 ;
+	}
 	if (j < 0)
 		j = num_stata_vars + j ;
 
-	/* check to make sure variable is string */
-	if (!SF_isstr(j + 1)) {
-		PyErr_SetString(PyExc_TypeError, 
+	if (want_str && !VAR_ISSTR(j)) {
+		PyErr_SetString(PyExc_TypeError,
 			"Stata variable is not string") ;
+		return -1 ;
+	}
+	if (!want_str && VAR_ISSTR(j)) {
+		PyErr_SetString(PyExc_TypeError,
+			"Stata variable is string") ;
+		return -1 ;
+	}
+	return j ;
+}
+
+/* Check observation and variable index of a single value, and convert 
+negative indices to positive. Returns -1 with Python error set if either
+index is out of range or variable is not of requested type. */
+static int
+get_cell(ST_int *i, ST_int *j, int want_str)
+{
+	if (*i < -context.nobs || *i >= context.nobs) {
+		PyErr_SetString(PyExc_IndexError, 
+			"Stata observation number out of range") ;
+		return -1 ;
+	}
+	if (*i < 0)
+		*i = context.nobs + *i ;
+	
+	*j = get_bulk_varnum(*j, want_str) ;
+	return *j < 0 ? -1 : 0 ;
+}
+
+static PyObject *
+_st_display(PyObject *self, PyObject *args)
+{
+	char *toDisplay ;
+	
+	if (!PyArg_ParseTuple(args, "s", &toDisplay))
+		return NULL ;
+	
+	SF_display(toDisplay) ;
+	
+	Py_INCREF(Py_None) ;
+	return Py_None ;
+}
+
+static PyObject *
+_st_error(PyObject *self, PyObject *args)
+{
+	char *toDisplay ;
+	
+	if (!PyArg_ParseTuple(args, "s", &toDisplay))
+		return NULL ;
+	
+	SF_error(toDisplay) ;
+	
+	Py_INCREF(Py_None) ;
+	return Py_None ;
+}
+
+static PyObject *
+_st_data(PyObject *self, PyObject *args)
+{
+	ST_int i, j ;
+	ST_double z ;
+	ST_retcode rc ;
+
+	if (!PyArg_ParseTuple(args, "ii", &i, &j))
+		return NULL ;
+
+	/* check that variable and observation numbers make sense */
+	if (get_cell(&i, &j, 0))
+		return NULL ;
+
+	/* Using i + 1 and j + 1 since python index starts from 0.
+	Also switch order of i and j because plugin uses opposite order */
+	rc = SF_vdata(j + 1, i + 1, &z) ;
+	if (rc) {
+		PyErr_SetString(PyExc_Exception, 
+			"error in retrieving Stata numeric value") ;
+		return NULL ;
+	}
+
+	if (SF_is_missing(z)) {
+		/* must be large float */
+		return missing_object(z) ;
+	}
+	
+	return PyFloat_FromDouble(z) ;
+}
+
+static PyObject *
+_st_store(PyObject *self, PyObject *args)
+{
+	ST_int i, j ;
+	ST_double val ;
+	ST_retcode rc ;
+	Py_ssize_t nargs ;
+	PyObject *pyob ;
+	
+	nargs = PyTuple_Size(args) ;
+	if (nargs != 3) {
+		PyErr_SetString(PyExc_TypeError,
+			"function takes exactly 3 arguments") ;
+		return NULL ;
+	}
+	
+	/* check if value is float, None, or instance of MissingValueCls */
+	if (!PyArg_ParseTuple(args, "iid", &i, &j, &val)) { /* test for float */
+		PyErr_Clear() ;
+		if (!PyArg_ParseTuple(args, "iiO", &i, &j, &pyob)) {
+			/* probably only get here if 1st or 2nd arg not int  */
+			return NULL ;
+		}
+		/* check whether pyob is MissingValue or None or something else */
+		if (PyObject_IsInstance(pyob, Py_MissingValueCls)) {
+			val = missing_as_double(pyob) ;
+		}
+		else if (pyob == Py_None) {
+			val = SV_missval ;
+		}
+		else {
+			PyErr_SetString(PyExc_TypeError, 
+				"set value should be float, None, or a missing value") ;
+			return NULL ;
+		}
+	}
+
+	/* check that variable and observation numbers make sense */
+	if (get_cell(&i, &j, 0))
+		return NULL ;
+
+	/* Using i + 1 and j + 1 since python index starts from 0.
+	Also switch order of i and j because plugin uses opposite order. */
+	rc = SF_vstore(j + 1, i + 1, val) ; 
+	if (rc) {
+		PyErr_SetString(PyExc_Exception, 
+			"error in setting Stata numeric value") ;
+		return NULL ;
+	}
+	
+	Py_INCREF(Py_None) ;
+	return Py_None ;
+}
+
+static PyObject *
+_st_sdata(PyObject *self, PyObject *args)
+{
+	ST_int i, j ;
+	char s[245] ;
+	ST_retcode rc ;
+
+	if (!PyArg_ParseTuple(args, "ii", &i, &j))
+		return NULL ;
+
+	/* check that variable and observation numbers make sense */
+	if (get_cell(&i, &j, 1))
+		return NULL ;
+
+	/* Using i + 1 and j + 1 since python index starts from 0.
+	Also switch order of i and j because plugin uses opposite order. */
+	rc = SF_sdata(j + 1, i + 1, s) ;
+	if (rc) {
+		PyErr_SetString(PyExc_Exception,
+			"error in retrieving Stata string value") ;
+		return NULL ;
+	}
+	
+	return PyUnicode_FromString(s) ;
+}
+
+static PyObject *
+_st_sstore(PyObject *self, PyObject *args)
+{
+	ST_int i, j ;
+	char *s ;
+	ST_retcode rc ;
+
+	if (!PyArg_ParseTuple(args, "iis", &i, &j, &s))
+		return NULL ;
+
+	/* check that variable and observation numbers make sense */
+	if (get_cell(&i, &j, 1))
+		return NULL ;
+
+	/* Using i + 1 and j + 1 since python index starts from 0.
+	Also switch order of i and j because plugin uses opposite order. */
+	rc = SF_sstore(j + 1, i + 1, s) ;
+	if (rc) {
+		PyErr_SetString(PyExc_Exception, 
+			"error in setting Stata string value") ;
 		return NULL ;
 	}
+	
+	Py_INCREF(Py_None) ;
+	return Py_None ;
+}
+
+static PyObject *
+_st_data_array(PyObject *self, PyObject *args)
+{
+	ST_int j ;
+	ST_double z ;
+	ST_retcode rc ;
+	Py_ssize_t k, i, nobs, nmiss ;
+	PyObject *obsob, *valob, *missob ;
+	Py_buffer values, missing ;
+	double *out ;
+	unsigned char *codes ;
+	obs_spec obs ;
+
+	missob = Py_None ;
+	if (!PyArg_ParseTuple(args, "iOO|O", &j, &obsob, &valob, &missob))
+		return NULL ;
+
+	j = get_bulk_varnum(j, 0) ;
+	if (j < 0)
+		return NULL ;
+
+	if (obs_spec_init(obsob, &obs))
+		return NULL ;
+
+	if (PyObject_GetBuffer(valob, &values,
+			PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+		obs_spec_release(&obs) ;
+		return NULL ;
+	}
+	if (values.format == NULL || strcmp(values.format, "d") != 0 ||
+			values.len / values.itemsize < obs.count) {
+		PyErr_SetString(PyExc_TypeError,
+			"values should be writable buffer of doubles, "
+			"at least as long as observations") ;
+		PyBuffer_Release(&values) ;
+		obs_spec_release(&obs) ;
+		return NULL ;
+	}
+
+	codes = NULL ;
+	if (missob != Py_None) {
+		if (PyObject_GetBuffer(missob, &missing,
+				PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) != 0) {
+			PyBuffer_Release(&values) ;
+			obs_spec_release(&obs) ;
+			return NULL ;
+		}
+		if (missing.itemsize != 1 || missing.len < obs.count) {
+			PyErr_SetString(PyExc_TypeError,
+				"missing should be writable byte buffer, "
+				"at least as long as observations") ;
+			PyBuffer_Release(&missing) ;
+			PyBuffer_Release(&values) ;
+			obs_spec_release(&obs) ;
+			return NULL ;
+		}
+		codes = (unsigned char *) missing.buf ;
+	}
+
+	/* one loop over observations; missing values are left in
+	values as Stata's large floats and, if requested, their codes
+	are recorded (0 for non-missing, k + 1 for MISSING_VALS[k]) */
+	out = (double *) values.buf ;
+	nobs = context.nobs ;
+	nmiss = 0 ;
+	for (k = 0; k < obs.count; k++) {
+		i = obs_spec_item(&obs, k, nobs) ;
+		if (i < 0)
+			break ;
+		rc = SF_vdata(j + 1, (ST_int) i + 1, &z) ;
+		if (rc) {
+			PyErr_SetString(PyExc_Exception,
+				"error in retrieving Stata numeric value") ;
+			break ;
+		}
+		out[k] = z ;
+		if (SF_is_missing(z)) {
+			nmiss++ ;
+			if (codes != NULL)
+				codes[k] = (unsigned char) (missing_index(z) + 1) ;
+		}
+		else if (codes != NULL) {
+			codes[k] = 0 ;
+		}
+	}
+
+	if (codes != NULL)
+		PyBuffer_Release(&missing) ;
+	PyBuffer_Release(&values) ;
+	obs_spec_release(&obs) ;
+
+	if (k < obs.count)
+		return NULL ;
+
+	return PyLong_FromSsize_t(nmiss) ;
+}
+
+static PyObject *
+_st_data_block(PyObject *self, PyObject *args)
+{
+	ST_int j ;
+	ST_double z ;
+	ST_retcode rc ;
+	Py_ssize_t k, c, i, nobs, nvars, nmiss, pos, rowstep, colstep ;
+	int colmajor, ok ;
+	PyObject *obsob, *varob, *valob, *missob, *seq ;
+	Py_buffer values, missing ;
+	ST_int *varnums ;
+	double *out ;
+	unsigned char *codes ;
+	obs_spec obs ;
+
+	missob = Py_None ;
+	colmajor = 0 ;
+	if (!PyArg_ParseTuple(args, "OOO|Oi",
+			&obsob, &varob, &valob, &missob, &colmajor))
+		return NULL ;
+
+	/* variable numbers; checked and converted to positive here */
+	seq = PySequence_Fast(varob, "varnums should be a sequence of int") ;
+	if (seq == NULL)
+		return NULL ;
+	nvars = PySequence_Fast_GET_SIZE(seq) ;
+	varnums = (ST_int *) malloc((nvars ? nvars : 1) * sizeof(ST_int)) ;
+	if (varnums == NULL) {
+		Py_DECREF(seq) ;
+		return PyErr_NoMemory() ;
+	}
+	for (c = 0; c < nvars; c++) {
+		j = (ST_int) PyLong_AsLong(PySequence_Fast_GET_ITEM(seq, c)) ;
+		if (j == -1 && PyErr_Occurred())
+			break ;
+		j = get_bulk_varnum(j, 0) ;
+		if (j < 0)
+			break ;
+		varnums[c] = j ;
+	}
+	Py_DECREF(seq) ;
+	if (c < nvars) {
+		free(varnums) ;
+		return NULL ;
+	}
+
+	if (obs_spec_init(obsob, &obs)) {
+		free(varnums) ;
+		return NULL ;
+	}
+
+	if (PyObject_GetBuffer(valob, &values,
+			PyBUF_WRITABLE | PyBUF_ANY_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+		obs_spec_release(&obs) ;
+		free(varnums) ;
+		return NULL ;
+	}
+	if (values.format == NULL || strcmp(values.format, "d") != 0 ||
+			values.len / values.itemsize < obs.count * nvars) {
+		PyErr_SetString(PyExc_TypeError,
+			"values should be writable buffer of doubles, "
+			"at least as long as observations times variables") ;
+		PyBuffer_Release(&values) ;
+		obs_spec_release(&obs) ;
+		free(varnums) ;
+		return NULL ;
+	}
+
+	codes = NULL ;
+	if (missob != Py_None) {
+		if (PyObject_GetBuffer(missob, &missing,
+				PyBUF_WRITABLE | PyBUF_ANY_CONTIGUOUS) != 0) {
+			PyBuffer_Release(&values) ;
+			obs_spec_release(&obs) ;
+			free(varnums) ;
+			return NULL ;
+		}
+		if (missing.itemsize != 1 || missing.len < obs.count * nvars) {
+			PyErr_SetString(PyExc_TypeError,
+				"missing should be writable byte buffer, "
+				"at least as long as observations times variables") ;
+			PyBuffer_Release(&missing) ;
+			PyBuffer_Release(&values) ;
+			obs_spec_release(&obs) ;
+			free(varnums) ;
+			return NULL ;
+		}
+		codes = (unsigned char *) missing.buf ;
+	}
+
+	/* Stata stores data by variable, so the outer loop is always over
+	variables; only the position written to depends on the layout */
+	if (colmajor) {
+		rowstep = 1 ;
+		colstep = obs.count ;
+	}
+	else {
+		rowstep = nvars ;
+		colstep = 1 ;
+	}
+
+	out = (double *) values.buf ;
+	nobs = context.nobs ;
+	nmiss = 0 ;
+	ok = obs_spec_check(&obs, nobs) == 0 ;
+	for (c = 0; ok && c < nvars; c++) {
+		j = varnums[c] ;
+		for (k = 0; k < obs.count; k++) {
+			i = obs_spec_item(&obs, k, nobs) ;
+			rc = SF_vdata(j + 1, (ST_int) i + 1, &z) ;
+			if (rc) {
+				PyErr_SetString(PyExc_Exception,
+					"error in retrieving Stata numeric value") ;
+				ok = 0 ;
+				break ;
+			}
+			pos = k * rowstep + c * colstep ;
+			out[pos] = z ;
+			if (SF_is_missing(z)) {
+				nmiss++ ;
+				if (codes != NULL)
+					codes[pos] = (unsigned char) (missing_index(z) + 1) ;
+			}
+			else if (codes != NULL) {
+				codes[pos] = 0 ;
+			}
+		}
+	}
+
+	if (codes != NULL)
+		PyBuffer_Release(&missing) ;
+	PyBuffer_Release(&values) ;
+	obs_spec_release(&obs) ;
+	free(varnums) ;
+
+	if (!ok)
+		return NULL ;
+
+	return PyLong_FromSsize_t(nmiss) ;
+}
+
+/* Return k-th item of a 1-d numeric buffer as double. The format
+is checked beforehand with buffer_is_numeric. */
+static double
+buffer_item(Py_buffer *view, Py_ssize_t k)
+{
+	char *p = (char *) view->buf + k * view->strides[0] ;
+	char fmt = view->format[0] ;
+
+	if (fmt == '@' || fmt == '=')
+		fmt = view->format[1] ;
+
+	switch (fmt) {
+		case 'd': return *(double *) p ;
+		case 'f': return (double) *(float *) p ;
+		case 'b': return (double) *(signed char *) p ;
+		case 'B': return (double) *(unsigned char *) p ;
+		case '?': return (double) *(unsigned char *) p ;
+		case 'h': return (double) *(short *) p ;
+		case 'H': return (double) *(unsigned short *) p ;
+		case 'i': return (double) *(int *) p ;
+		case 'I': return (double) *(unsigned int *) p ;
+		case 'l': return (double) *(long *) p ;
+		case 'L': return (double) *(unsigned long *) p ;
+		case 'q': return (double) *(long long *) p ;
+		case 'Q': return (double) *(unsigned long long *) p ;
+		case 'n': return (double) *(Py_ssize_t *) p ;
+		case 'N': return (double) *(size_t *) p ;
+	}
+	return 0.0 ;
+}
+
+static int
+buffer_is_numeric(Py_buffer *view)
+{
+	char *fmt = view->format ;
+
+	if (fmt == NULL || view->ndim != 1)
+		return 0 ;
+	if (fmt[0] == '@' || fmt[0] == '=')
+		fmt++ ;
+	return fmt[0] != '\0' && fmt[1] == '\0' &&
+		strchr("dfbB?hHiIlLqQnN", fmt[0]) != NULL ;
+}
+
+static PyObject *
+_st_store_array(PyObject *self, PyObject *args)
+{
+	ST_int j ;
+	ST_double z, current ;
+	ST_retcode rc ;
+	Py_ssize_t k, i, nobs, nwritten ;
+	int ok, changed = 0 ;
+	PyObject *obsob, *valob, *missob ;
+	Py_buffer values, missing ;
+	unsigned char *codes ;
+	obs_spec obs ;
+
+	missob = Py_None ;
+	if (!PyArg_ParseTuple(args, "iOO|Oi", &j, &obsob, &valob, &missob, 
+			&changed))
+		return NULL ;
+
+	j = get_bulk_varnum(j, 0) ;
+	if (j < 0)
+		return NULL ;
+
+	if (obs_spec_init(obsob, &obs))
+		return NULL ;
+
+	if (PyObject_GetBuffer(valob, &values, PyBUF_STRIDES | PyBUF_FORMAT)) {
+		obs_spec_release(&obs) ;
+		return NULL ;
+	}
+	if (!buffer_is_numeric(&values)) {
+		PyErr_SetString(PyExc_TypeError,
+			"values should be 1-dimensional buffer of numbers") ;
+		PyBuffer_Release(&values) ;
+		obs_spec_release(&obs) ;
+		return NULL ;
+	}
+	if (values.shape[0] != obs.count) {
+		PyErr_SetString(PyExc_ValueError,
+			"length of values does not match number of observations") ;
+		PyBuffer_Release(&values) ;
+		obs_spec_release(&obs) ;
+		return NULL ;
+	}
+
+	codes = NULL ;
+	if (missob != Py_None) {
+		if (PyObject_GetBuffer(missob, &missing, PyBUF_C_CONTIGUOUS)) {
+			PyBuffer_Release(&values) ;
+			obs_spec_release(&obs) ;
+			return NULL ;
+		}
+		codes = (unsigned char *) missing.buf ;
+		if (missing.itemsize != 1 || missing.len != obs.count) {
+			PyErr_SetString(PyExc_ValueError,
+				"missing should be byte buffer with same "
+				"length as values") ;
+			codes = NULL ;
+		}
+		else {
+			/* check codes before anything is written */
+			for (k = 0; k < obs.count; k++) {
+				if (codes[k] > 27) {
+					PyErr_SetString(PyExc_ValueError,
+						"missing-value codes should be 0 to 27") ;
+					codes = NULL ;
+					break ;
+				}
+			}
+		}
+		if (codes == NULL) {
+			PyBuffer_Release(&missing) ;
+			PyBuffer_Release(&values) ;
+			obs_spec_release(&obs) ;
+			return NULL ;
+		}
+	}
+
+	nobs = context.nobs ;
+	nwritten = 0 ;
+	ok = obs_spec_check(&obs, nobs) == 0 ;
+	for (k = 0; ok && k < obs.count; k++) {
+		i = obs_spec_item(&obs, k, nobs) ;
+		if (codes != NULL && codes[k])
+			z = missing_value(codes[k] - 1) ;
+		else
+			z = buffer_item(&values, k) ;
+		/* if requested, values the same as those stored (bit for 
+		bit) are not written again */
+		if (changed && SF_vdata(j + 1, (ST_int) i + 1, &current) == 0 &&
+				memcmp(&current, &z, sizeof(ST_double)) == 0)
+			continue ;
+		rc = SF_vstore(j + 1, (ST_int) i + 1, z) ;
+		if (rc) {
+			PyErr_Format(PyExc_Exception,
+				"error in setting Stata numeric value; "
+				"%zd values were written", nwritten) ;
+			ok = 0 ;
+		}
+		else
+			nwritten++ ;
+	}
+
+	if (codes != NULL)
+		PyBuffer_Release(&missing) ;
+	PyBuffer_Release(&values) ;
+	obs_spec_release(&obs) ;
+
+	if (!ok)
+		return NULL ;
+
+	if (changed)
+		return PyLong_FromSsize_t(nwritten) ;
+	
+	Py_INCREF(Py_None) ;
+	return Py_None ;
+}
+
+/* Table of Python strings made by _st_sdata_list, so that repeated
+values of a string variable share one object instead of each being
+decoded again. String variables usually have few distinct values; once
+the table is full, further distinct values are simply not interned. */
+#define STR_TABLE_SIZE 4096 /* must be power of 2 */
+#define STR_TABLE_MAX 3072
+
+typedef struct
+{
+	unsigned long hash ;
+	char *s ;
+	PyObject *str ;
+} str_entry ;
+
+typedef struct
+{
+	Py_ssize_t used ;
+	str_entry *entries ;
+} str_table ;
+
+static int
+str_table_init(str_table *table)
+{
+	table->used = 0 ;
+	table->entries = (str_entry *) calloc(STR_TABLE_SIZE, sizeof(str_entry)) ;
+	if (table->entries == NULL) {
+		PyErr_NoMemory() ;
+		return -1 ;
+	}
+	return 0 ;
+}
+
+static void
+str_table_free(str_table *table)
+{
+	Py_ssize_t k ;
+
+	for (k = 0; k < STR_TABLE_SIZE; k++) {
+		if (table->entries[k].str != NULL) {
+			free(table->entries[k].s) ;
+			Py_DECREF(table->entries[k].str) ;
+		}
+	}
+	free(table->entries) ;
+}
+
+/* Return new reference to Python str for C string s, reusing
+the object made for an earlier equal value if there is one. */
+static PyObject *
+str_table_get(str_table *table, const char *s)
+{
+	unsigned long hash = 2166136261UL ; /* FNV-1a */
+	size_t len, k ;
+	const char *c ;
+	str_entry *entry ;
+	PyObject *str ;
+
+	for (c = s; *c; c++)
+		hash = (hash ^ (unsigned char) *c) * 16777619UL ;
+	len = c - s ;
+
+	k = hash & (STR_TABLE_SIZE - 1) ;
+	while (table->entries[k].str != NULL) {
+		entry = &table->entries[k] ;
+		if (entry->hash == hash && strcmp(entry->s, s) == 0) {
+			Py_INCREF(entry->str) ;
+			return entry->str ;
+		}
+		k = (k + 1) & (STR_TABLE_SIZE - 1) ;
+	}
+
+	str = PyUnicode_FromStringAndSize(s, len) ;
+	if (str == NULL || table->used >= STR_TABLE_MAX)
+		return str ;
+
+	entry = &table->entries[k] ;
+	entry->s = (char *) malloc(len + 1) ;
+	if (entry->s == NULL)
+		return str ;
+	memcpy(entry->s, s, len + 1) ;
+	entry->hash = hash ;
+	Py_INCREF(str) ;
+	entry->str = str ;
+	table->used++ ;
+	return str ;
+}
+
+static PyObject *
+_st_sdata_list(PyObject *self, PyObject *args)
+{
+	ST_int j ;
+	ST_retcode rc ;
+	Py_ssize_t k, i, nobs ;
+	char s[245] ;
+	PyObject *obsob, *list, *str ;
+	obs_spec obs ;
+	str_table table ;
+
+	if (!PyArg_ParseTuple(args, "iO", &j, &obsob))
+		return NULL ;
+
+	j = get_bulk_varnum(j, 1) ;
+	if (j < 0)
+		return NULL ;
+
+	if (obs_spec_init(obsob, &obs))
+		return NULL ;
+
+	list = PyList_New(obs.count) ;
+	if (list == NULL || str_table_init(&table)) {
+		Py_XDECREF(list) ;
+		obs_spec_release(&obs) ;
+		return NULL ;
+	}
+
+	nobs = context.nobs ;
+	for (k = 0; k < obs.count; k++) {
+		i = obs_spec_item(&obs, k, nobs) ;
+		if (i < 0)
+			break ;
+		rc = SF_sdata(j + 1, (ST_int) i + 1, s) ;
+		if (rc) {
+			PyErr_SetString(PyExc_Exception,
+				"error in retrieving Stata string value") ;
+			break ;
+		}
+		str = str_table_get(&table, s) ;
+		if (str == NULL)
+			break ;
+		PyList_SET_ITEM(list, k, str) ;
+	}
+
+	str_table_free(&table) ;
+	obs_spec_release(&obs) ;
+
+	if (k < obs.count) {
+		Py_DECREF(list) ;
+		return NULL ;
+	}
+
+	return list ;
+}
+
+static PyObject *
+_st_sstore_list(PyObject *self, PyObject *args)
+{
+	ST_int j ;
+	ST_retcode rc ;
+	Py_ssize_t k, i, nobs, nwritten ;
+	int ok, changed = 0 ;
+	char *s, current[245] ;
+	PyObject *obsob, *strob, *seq, *item, *prev ;
+	obs_spec obs ;
+
+	if (!PyArg_ParseTuple(args, "iOO|i", &j, &obsob, &strob, &changed))
+		return NULL ;
+
+	j = get_bulk_varnum(j, 1) ;
+	if (j < 0)
+		return NULL ;
+
+	seq = PySequence_Fast(strob, "strings should be a sequence of str") ;
+	if (seq == NULL)
+		return NULL ;
+
+	if (obs_spec_init(obsob, &obs)) {
+		Py_DECREF(seq) ;
+		return NULL ;
+	}
+
+	nobs = context.nobs ;
+	ok = 1 ;
+	if (PySequence_Fast_GET_SIZE(seq) != obs.count) {
+		PyErr_SetString(PyExc_ValueError,
+			"length of strings does not match number of observations") ;
+		ok = 0 ;
+	}
+	/* check strings and indices before anything is written */
+	for (k = 0; ok && k < obs.count; k++) {
+		if (!PyUnicode_Check(PySequence_Fast_GET_ITEM(seq, k))) {
+			PyErr_SetString(PyExc_TypeError,
+				"strings should be a sequence of str") ;
+			ok = 0 ;
+		}
+	}
+	if (ok)
+		ok = obs_spec_check(&obs, nobs) == 0 ;
+
+	/* repeated objects are encoded only once */
+	prev = NULL ;
+	s = NULL ;
+	nwritten = 0 ;
+	for (k = 0; ok && k < obs.count; k++) {
+		i = obs_spec_item(&obs, k, nobs) ;
+		item = PySequence_Fast_GET_ITEM(seq, k) ;
+		if (item != prev) {
+			s = (char *) PyUnicode_AsUTF8(item) ;
+			if (s == NULL) {
+				ok = 0 ;
+				break ;
+			}
+			prev = item ;
+		}
+		/* if requested, strings the same as those stored are not 
+		written again */
+		if (changed && SF_sdata(j + 1, (ST_int) i + 1, current) == 0 &&
+				strcmp(current, s) == 0)
+			continue ;
+		rc = SF_sstore(j + 1, (ST_int) i + 1, s) ;
+		if (rc) {
+			PyErr_Format(PyExc_Exception,
+				"error in setting Stata string value; "
+				"%zd values were written", nwritten) ;
+			ok = 0 ;
+		}
+		else
+			nwritten++ ;
+	}
+
+	obs_spec_release(&obs) ;
+	Py_DECREF(seq) ;
+
+	if (!ok)
+		return NULL ;
+
+	if (changed)
+		return PyLong_FromSsize_t(nwritten) ;
+	
+	Py_INCREF(Py_None) ;
+	return Py_None ;
+}
+
+static PyObject *
+_st_context(PyObject *self, PyObject *args)
+{
+	ST_int j ;
+	PyObject *isstr ;
+	char *flags ;
+	
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+	
+	isstr = PyBytes_FromStringAndSize(NULL, (Py_ssize_t) context.nvar) ;
+	if (isstr == NULL)
+		return NULL ;
+	flags = PyBytes_AS_STRING(isstr) ;
+	for (j = 0; j < context.nvar; j++)
+		flags[j] = VAR_ISSTR(j) ? 1 : 0 ;
+	
+	return Py_BuildValue("(lllllN)", num_plugin_calls, (long) context.nobs, 
+		(long) context.nvar, (long) context.in1, (long) context.in2, isstr) ;
+}
+
+static PyObject *
+_st_ncalls(PyObject *self, PyObject *args)
+{
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+	
+	return PyLong_FromLong(num_plugin_calls) ;
+}
+
+static PyObject *
+st_nobs(PyObject *self, PyObject *args)
+{
+	ST_int nobs ;
+
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+	
+	nobs = context.nobs ;
+	
+	return PyLong_FromLong((long) nobs) ;
+}
+
+static PyObject *
+st_nvar(PyObject *self, PyObject *args)
+{
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+	
+	return PyLong_FromLong((long) num_stata_vars) ;
+}
+
+static PyObject *
+st_ifobs(PyObject *self, PyObject *args)
+{
+	ST_int j, nobs ;
+	
+	if (!PyArg_ParseTuple(args, "i", &j))
+		return NULL ;
+	
+	/* check to make sure observation number makes sense */
+	nobs = context.nobs ;
+	if (j < -nobs || j >= nobs) {
+		PyErr_SetString(PyExc_IndexError, 
+			"Stata observation number out of range") ;
+		return NULL ;
+	}
+
+	/* convert negative index to positive */
+	if (j < 0)
+		j = nobs + j ;
+
+	/* j + 1 since python index starts from 0 */		
+	if (SF_ifobs(j + 1)) {
+		Py_INCREF(Py_True) ;
+		return Py_True ;
+	}
+	else {
+		Py_INCREF(Py_False) ;
+		return Py_False ;
+	}
+}
+
+static PyObject *
+st_in1(PyObject *self, PyObject *args)
+{
+	ST_int n ;
+	
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+
+	n = context.in1 ;
+	
+	/* n - 1 since python indexing starts from 0 */
+	return PyLong_FromLong((long) n - 1) ;
+}
+
+static PyObject *
+st_in2(PyObject *self, PyObject *args)
+{
+	ST_int n ;
+	
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+
+	n = context.in2 ;
+	
+	/* Unlike stata_in1() function above, do not adjust by - 1.
+	Python indexes will often be used like x[n1:n2] or
+	range(n1, n2), which means n1 up to but not including n2. */
+	return PyLong_FromLong((long) n) ;
+}
+
+/* Operand of _st_arith and _st_math: a buffer of doubles or a number
+(noting whether it was an int), and an optional buffer of missing-value
+codes */
+typedef struct
+{
+	double *values ;
+	double scalar ;
+	int is_int ;
+	unsigned char *codes ;
+	Py_buffer view ;
+	Py_buffer codes_view ;
+} arith_operand ;
+
+static int
+arith_operand_init(PyObject *valob, PyObject *codesob, Py_ssize_t n,
+                   arith_operand *operand)
+{
+	operand->values = NULL ;
+	operand->codes = NULL ;
+	operand->is_int = PyLong_Check(valob) ;
+	if (PyFloat_Check(valob) || PyLong_Check(valob)) {
+		operand->scalar = PyFloat_AsDouble(valob) ;
+		if (operand->scalar == -1.0 && PyErr_Occurred())
+			return -1 ;
+	}
+	else {
+		if (PyObject_GetBuffer(valob, &operand->view,
+				PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0)
+			return -1 ;
+		if (operand->view.format == NULL || 
+				strcmp(operand->view.format, "d") != 0 ||
+				operand->view.len / operand->view.itemsize < n) {
+			PyErr_SetString(PyExc_TypeError,
+				"operands should be numbers or buffers of doubles, "
+				"at least as long as out") ;
+			return -1 ;
+		}
+		operand->values = (double *) operand->view.buf ;
+	}
+	if (codesob != Py_None) {
+		if (PyObject_GetBuffer(codesob, &operand->codes_view,
+				PyBUF_C_CONTIGUOUS) != 0)
+			return -1 ;
+		if (operand->codes_view.itemsize != 1 ||
+				operand->codes_view.len < n) {
+			PyErr_SetString(PyExc_TypeError,
+				"missing should be byte buffer, "
+				"at least as long as out") ;
+			return -1 ;
+		}
+		operand->codes = (unsigned char *) operand->codes_view.buf ;
+	}
+	return 0 ;
+}
+
+/* Python's float floor division and modulo, as in floatobject.c */
+static double
+py_mod(double x, double y)
+{
+	double mod = fmod(x, y) ;
+
+	if (mod) {
+		if ((y < 0) != (mod < 0))
+			mod += y ;
+	}
+	else {
+		mod = copysign(0.0, y) ;
+	}
+	return mod ;
+}
+
+static double
+py_floordiv(double x, double y)
+{
+	double mod, div, floordiv ;
+
+	mod = fmod(x, y) ;
+	div = (x - mod) / y ;
+	if (mod && ((y < 0) != (mod < 0)))
+		div -= 1.0 ;
+	if (div) {
+		floordiv = floor(div) ;
+		if (div - floordiv > 0.5)
+			floordiv += 1.0 ;
+	}
+	else {
+		floordiv = copysign(0.0, x / y) ;
+	}
+	return floordiv ;
+}
+
+static const char *arith_ops[] = {
+	"+", "-", "*", "/", "//", "%", "**",
+	"<", "<=", "==", "!=", ">", ">=", NULL
+} ;
+
+static PyObject *
+_st_arith(PyObject *self, PyObject *args)
+{
+	char *op ;
+	int code ;
+	double x, y, z ;
+	Py_ssize_t i, n, nmiss ;
+	PyObject *xob, *xmissob, *yob, *ymissob, *outob, *outmissob ;
+	Py_buffer outview, outmissview ;
+	arith_operand left, right ;
+	double *out ;
+	unsigned char *outcodes ;
+
+	if (!PyArg_ParseTuple(args, "sOOOOOO", &op, &xob, &xmissob, 
+			&yob, &ymissob, &outob, &outmissob))
+		return NULL ;
+
+	for (code = 0; arith_ops[code] != NULL; code++) {
+		if (strcmp(op, arith_ops[code]) == 0)
+			break ;
+	}
+	if (arith_ops[code] == NULL) {
+		PyErr_SetString(PyExc_ValueError, "unknown operator") ;
+		return NULL ;
+	}
+
+	if (PyObject_GetBuffer(outob, &outview,
+			PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0)
+		return NULL ;
+	if (PyObject_GetBuffer(outmissob, &outmissview,
+			PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) != 0) {
+		PyBuffer_Release(&outview) ;
+		return NULL ;
+	}
+	n = outview.len / outview.itemsize ;
+
+	/* buffers not yet acquired have obj == NULL and are 
+	ignored by PyBuffer_Release */
+	left.view.obj = left.codes_view.obj = NULL ;
+	right.view.obj = right.codes_view.obj = NULL ;
+	if (outview.format == NULL || strcmp(outview.format, "d") != 0 ||
+			outmissview.itemsize != 1 || outmissview.len < n) {
+		PyErr_SetString(PyExc_TypeError,
+			"out should be writable buffer of doubles, and out "
+			"missing a writable byte buffer at least as long") ;
+		nmiss = -1 ;
+	}
+	else if (arith_operand_init(xob, xmissob, n, &left) ||
+			arith_operand_init(yob, ymissob, n, &right)) {
+		nmiss = -1 ;
+	}
+	else {
+		/* one loop; comparisons use Stata's ordering of the values
+		as stored, with no missing values in the result, while 
+		arithmetic gives . if either operand is missing or the 
+		result is outside of the non-missing range */
+		out = (double *) outview.buf ;
+		outcodes = (unsigned char *) outmissview.buf ;
+		nmiss = 0 ;
+		for (i = 0; i < n; i++) {
+			x = left.values ? left.values[i] : left.scalar ;
+			y = right.values ? right.values[i] : right.scalar ;
+			if (code < 7 && ((left.codes && left.codes[i]) ||
+					(right.codes && right.codes[i]))) {
+				z = missing_value(0) ;
+				outcodes[i] = 1 ;
+				nmiss++ ;
+				out[i] = z ;
+				continue ;
+			}
+			switch (code) {
+				case 0: z = x + y ; break ;
+				case 1: z = x - y ; break ;
+				case 2: z = x * y ; break ;
+				case 3: z = y == 0.0 ? NAN : x / y ; break ;
+				case 4: z = y == 0.0 ? NAN : py_floordiv(x, y) ; break ;
+				case 5: z = y == 0.0 ? NAN : py_mod(x, y) ; break ;
+				case 6: z = pow(x, y) ; break ;
+				case 7: z = x <  y ; break ;
+				case 8: z = x <= y ; break ;
+				case 9: z = x == y ; break ;
+				case 10: z = x != y ; break ;
+				case 11: z = x >  y ; break ;
+				default: z = x >= y ; break ;
+			}
+			if (!(z >= -1.7976931348623157e+308 && 
+					z <= 8.988465674311579e+307)) {
+				z = missing_value(0) ;
+				outcodes[i] = 1 ;
+				nmiss++ ;
+			}
+			else {
+				outcodes[i] = 0 ;
+			}
+			out[i] = z ;
+		}
+	}
+
+	PyBuffer_Release(&left.view) ;
+	PyBuffer_Release(&left.codes_view) ;
+	PyBuffer_Release(&right.view) ;
+	PyBuffer_Release(&right.codes_view) ;
+	PyBuffer_Release(&outmissview) ;
+	PyBuffer_Release(&outview) ;
+	if (nmiss < 0)
+		return NULL ;
+	return PyLong_FromSsize_t(nmiss) ;
+}
+
+/* Native kernels for stata_math, with the same steps as the Python 
+functions in stata_math.py, so that results are the same. Floating 
+point contraction (e.g., into fused multiply-add) would change results, 
+so it is turned off. */
+#if defined(__GNUC__) && !defined(__clang__)
+#pragma GCC optimize ("fp-contract=off")
+#else
+#pragma STDC FP_CONTRACT OFF
+#endif
+
+#define MATH_PI 3.141592653589793238462643383279502884197
+#define MATH_LOGPI 1.144729885849400174143427351353058711647
+#define MATH_LIMIT 8.988465674311579e+307
+
+/* errors in kernels, raised after the loop as the Python functions would */
+#define MATH_DOMAIN_ERROR 1
+#define MATH_ZERO_DIVISION 2
+#define MATH_FLOOR_OVERFLOW 4
+
+/* Python's math.lgamma, which does not use the C library's lgamma;
+Lanczos' approximation, as in CPython's mathmodule.c */
+#define LANCZOS_N 13
+static const double lanczos_g = 6.024680040776729583740234375 ;
+static const double lanczos_num_coeffs[LANCZOS_N] = {
+	23531376880.410759688572007674451636754734846804940,
+	42919803642.649098768957899047001988850926355848959,
+	35711959237.355668049440185451547166705960488635843,
+	17921034426.037209699919755754458931112671403265390,
+	6039542586.3520280050642916443072979210699388420708,
+	1439720407.3117216736632230727949123939715485786772,
+	248874557.86205415651146038641322942321632125127801,
+	31426415.585400194380614231628318205362874684987640,
+	2876370.6289353724412254090516208496135991145378768,
+	186056.26539522349504029498971604569928220784236328,
+	8071.6720023658162106380029022722506138218516325024,
+	210.82427775157934587250973392071336271166969580291,
+	2.5066282746310002701649081771338373386264310793408
+} ;
+static const double lanczos_den_coeffs[LANCZOS_N] = {
+	0.0, 39916800.0, 120543840.0, 150917976.0, 105258076.0, 45995730.0,
+	13339535.0, 2637558.0, 357423.0, 32670.0, 1925.0, 66.0, 1.0
+} ;
+
+static double
+lanczos_sum(double x)
+{
+	double num = 0.0, den = 0.0 ;
+	int i ;
+
+	if (x < 5.0) {
+		for (i = LANCZOS_N; --i >= 0; ) {
+			num = num * x + lanczos_num_coeffs[i] ;
+			den = den * x + lanczos_den_coeffs[i] ;
+		}
+	}
+	else {
+		for (i = 0; i < LANCZOS_N; i++) {
+			num = num / x + lanczos_num_coeffs[i] ;
+			den = den / x + lanczos_den_coeffs[i] ;
+		}
+	}
+	return num / den ;
+}
 
-	/* Using i + 1 and j + 1 since python index starts from 0.
-	Also switch order of i and j because plugin uses opposite order. */
-	rc = SF_sdata(j + 1, i + 1, s) ;
-	if (rc) {
-		PyErr_SetString(PyExc_Exception,
-			"error in retrieving Stata string value") ;
-		return NULL ;
-	}
-	
-	return PyUnicode_FromString(s) ;
+static double
+m_sinpi(double x)
+{
+	double y, r ;
+	int n ;
+
+	y = fmod(fabs(x), 2.0) ;
+	n = (int) round(2.0 * y) ;
+	switch (n) {
+		case 0: r = sin(MATH_PI * y) ; break ;
+		case 1: r = cos(MATH_PI * (y - 0.5)) ; break ;
+		case 2: r = sin(MATH_PI * (1.0 - y)) ; break ;
+		case 3: r = -cos(MATH_PI * (y - 1.5)) ; break ;
+		default: r = sin(MATH_PI * (y - 2.0)) ; break ;
+	}
+	return copysign(1.0, x) * r ;
 }
 
-static PyObject *
-_st_sstore(PyObject *self, PyObject *args)
+/* for finite x that is not zero or a negative integer */
+static double
+m_lgamma(double x)
 {
-	ST_int i, j, nobs ;
-	char *s ;
-	ST_retcode rc ;
+	double r, absx ;
+
+	if (x == floor(x) && x <= 2.0)
+		return 0.0 ;
+	absx = fabs(x) ;
+	if (absx < 1e-20)
+		return -log(absx) ;
+	r = log(lanczos_sum(absx)) - lanczos_g ;
+	r += (absx - 0.5) * (log(absx + lanczos_g - 0.5) - 1) ;
+	if (x < 0.0)
+		r = MATH_LOGPI - log(fabs(m_sinpi(absx))) - log(absx) - r ;
+	return r ;
+}
 
-	if (!PyArg_ParseTuple(args, "iis", &i, &j, &s))
-		return NULL ;
+/* digamma and trigamma for x that is not zero or a negative integer,
+as _digamma and _trigamma in stata_math.py */
+static double
+math_digamma(double x)
+{
+	double value = 0.0, flrx, y ;
 
-	/* check that variable and observation numbers make sense */
-	nobs = SF_nobs() ;
-	if (i < -nobs || i >= nobs) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata observation number out of range") ;
-		return NULL ;
+	if (x <= 0) {
+		flrx = floor(x) ;
+		if (x - flrx != 0.5)
+			value -= MATH_PI / tan(MATH_PI * x) ;
+		x = 1 - x ;
 	}
-	if (j < -num_stata_vars || j >= num_stata_vars) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata variable number out of range") ;
-		return NULL ;
+	while (x < 8) {
+		value -= 1. / x ;
+		x += 1 ;
 	}
-
-	/* convert negative indices to positive */
-	if (i < 0)
-		i = nobs + i ;
-	if (j < 0)
-		j = num_stata_vars + j ;
-
-	/* check to make sure variable is string */
-	if (!SF_isstr(j + 1)) {
-		PyErr_SetString(PyExc_TypeError, 
-			"Stata variable is not string") ;
-		return NULL ;
+	value += log(x) - 0.5 / x ;
+	if (x < 1e10) {
+		y = 1. / (x * x) ;
+		value -= y * (1./12 - y * (1./120 - y * (1./252 - y * (1./240 - 
+			y * (5./660 - y * (691./32760 - y * 1./12)))))) ;
 	}
+	return value ;
+}
 
-	/* Using i + 1 and j + 1 since python index starts from 0.
-	Also switch order of i and j because plugin uses opposite order. */
-	rc = SF_sstore(j + 1, i + 1, s) ;
-	if (rc) {
-		PyErr_SetString(PyExc_Exception, 
-			"error in setting Stata string value") ;
-		return NULL ;
-	}
-	
-	Py_INCREF(Py_None) ;
-	return Py_None ;
+static double
+math_trigamma(double x, int *error)
+{
+	double value = 0.0, y, s ;
+	int flip = 0 ;
+	/* Python's ** calls pow, which can differ from s * s in the last
+	bit; a volatile exponent keeps the compiler from using s * s */
+	volatile double two = 2.0 ;
+
+	if (x <= 0) {
+		s = pow(sin(MATH_PI * x), two) ;
+		if (s == 0.0)
+			*error |= MATH_ZERO_DIVISION ;
+		value -= MATH_PI * MATH_PI / s ;
+		x = 1 - x ;
+		flip = 1 ;
+	}
+	while (x < 15) {
+		if (x * x == 0.0)
+			*error |= MATH_ZERO_DIVISION ;
+		value += 1. / (x * x) ;
+		x += 1 ;
+	}
+	y = 1. / (x * x) ;
+	value += 0.5*y + (1. + y*(1./6 + y*(-1./30 + y*(1./42 + y*(-1./30 + 
+		y*(5./66)))))) / x ;
+	return flip ? -value : value ;
 }
 
-static PyObject *
-st_nobs(PyObject *self, PyObject *args)
+/* index in MISSING_VALS of the MissingValue given by get_missing */
+static int
+get_missing_index(double z)
 {
-	ST_int nobs ;
+	if (!(z > MATH_LIMIT && z <= 9.045521364627034e+307))
+		return 0 ;
+	return missing_index(z) ;
+}
 
-	if (!PyArg_ParseTuple(args, ""))
-		return NULL ;
-	
-	nobs = SF_nobs() ;
-	
-	return PyLong_FromLong((long) nobs) ;
+/* missing-value code (0 if non-missing) for a result, as when 
+converting results of the Python functions to StataVarVals */
+static int
+result_code(double z)
+{
+	if (z >= -1.7976931348623157e+308 && z <= MATH_LIMIT)
+		return 0 ;
+	return get_missing_index(z) + 1 ;
 }
 
-static PyObject *
-st_nvar(PyObject *self, PyObject *args)
+/* missing-value code of an operand that the math functions treat as 
+missing: its own code, if it has one, otherwise as in get_missing */
+static int
+operand_code(double z, unsigned char code)
 {
-	if (!PyArg_ParseTuple(args, ""))
-		return NULL ;
-	
-	return PyLong_FromLong((long) num_stata_vars) ;
+	if (code)
+		return code ;
+	return get_missing_index(z) + 1 ;
+}
+
+static const char *math_funcs[] = {
+	"cloglog", "digamma", "invlogit", "lngamma", "reldif", "round", 
+	"trigamma", NULL
+} ;
+
+/* loop over n values; returns number of missing values in result */
+static Py_ssize_t
+math_kernel(int func, arith_operand *left, arith_operand *right,
+            double *out, unsigned char *outcodes, Py_ssize_t n, int *error)
+{
+	Py_ssize_t i, nmiss = 0 ;
+	double x, y, z, e, t ;
+	int xcode, ycode, code ;
+
+	for (i = 0; i < n; i++) {
+		x = left->values ? left->values[i] : left->scalar ;
+		xcode = left->codes ? left->codes[i] : 0 ;
+		if (xcode || !(x >= -MATH_LIMIT && x <= MATH_LIMIT))
+			xcode = operand_code(x, (unsigned char) xcode) ;
+		ycode = 0 ;
+		y = 0.0 ;
+		if (func == 4 || func == 5) {
+			y = right->values ? right->values[i] : right->scalar ;
+			ycode = right->codes ? right->codes[i] : 0 ;
+			if (ycode || !(y >= -MATH_LIMIT && y <= MATH_LIMIT))
+				ycode = operand_code(y, (unsigned char) ycode) ;
+		}
+		code = 0 ;
+		z = 0.0 ;
+		switch (func) {
+			case 0: /* cloglog */
+				if (xcode || !(0 < x && x < 1)) {
+					code = 1 ;
+					break ;
+				}
+				t = log(1 - x) ;
+				if (t == 0.0)
+					*error |= MATH_DOMAIN_ERROR ;
+				z = log(-t) ;
+				break ;
+			case 1: /* digamma */
+				if (xcode || (x <= 0 && x == floor(x)))
+					code = 1 ;
+				else
+					z = math_digamma(x) ;
+				break ;
+			case 2: /* invlogit */
+				if (xcode)
+					code = 1 ;
+				else if (x >= 40)
+					z = 1.0 ;
+				else if (x <= -750)
+					z = 0.0 ;
+				else {
+					e = exp(x) ;
+					z = e / (1 + e) ;
+				}
+				break ;
+			case 3: /* lngamma */
+				if (xcode || (x <= 0 && x == floor(x)) || x >= 1.282e+305)
+					code = 1 ;
+				else {
+					z = m_lgamma(x) ;
+					if (!(z >= -MATH_LIMIT && z <= MATH_LIMIT))
+						code = 1 ;
+				}
+				break ;
+			case 4: /* reldif */
+				if (xcode || ycode) {
+					/* 0 if both are the same missing value */
+					code = (xcode == ycode) ? 0 : 1 ;
+					z = 0.0 ;
+				}
+				else if (x == y)
+					z = 0.0 ;
+				else
+					z = fabs(x - y) / (fabs(y) + 1) ;
+				break ;
+			case 5: /* round */
+				if (ycode)
+					code = 1 ;
+				else if (xcode)
+					code = xcode ;
+				else if (y == 0)
+					z = x ;
+				else {
+					t = x / y + 0.5 ;
+					if (isinf(t))
+						*error |= MATH_FLOOR_OVERFLOW ;
+					/* math.floor gives int, so zero is never negative */
+					z = (floor(t) + 0.0) * y ;
+					if (right->is_int)
+						z += 0.0 ;
+				}
+				break ;
+			default: /* trigamma */
+				if (xcode || (x <= 0 && x == floor(x)))
+					code = 1 ;
+				else
+					z = math_trigamma(x, error) ;
+				break ;
+		}
+		if (!code)
+			code = result_code(z) ;
+		if (code) {
+			z = missing_value(code - 1) ;
+			nmiss++ ;
+		}
+		out[i] = z ;
+		outcodes[i] = (unsigned char) code ;
+	}
+	return nmiss ;
 }
 
 static PyObject *
-st_ifobs(PyObject *self, PyObject *args)
+_st_math(PyObject *self, PyObject *args)
 {
-	ST_int j, nobs ;
-	
-	if (!PyArg_ParseTuple(args, "i", &j))
+	char *funcname ;
+	int func, error = 0 ;
+	Py_ssize_t n, nmiss ;
+	PyObject *xob, *xmissob, *yob, *ymissob, *outob, *outmissob ;
+	Py_buffer outview, outmissview ;
+	arith_operand left, right ;
+
+	if (!PyArg_ParseTuple(args, "sOOOOOO", &funcname, &xob, &xmissob, 
+			&yob, &ymissob, &outob, &outmissob))
 		return NULL ;
-	
-	/* check to make sure observation number makes sense */
-	nobs = SF_nobs() ;
-	if (j < -nobs || j >= nobs) {
-		PyErr_SetString(PyExc_IndexError, 
-			"Stata observation number out of range") ;
+
+	for (func = 0; math_funcs[func] != NULL; func++) {
+		if (strcmp(funcname, math_funcs[func]) == 0)
+			break ;
+	}
+	if (math_funcs[func] == NULL) {
+		PyErr_SetString(PyExc_ValueError, "unknown function") ;
 		return NULL ;
 	}
 
-	/* convert negative index to positive */
-	if (j < 0)
-		j = nobs + j ;
+	if (PyObject_GetBuffer(outob, &outview,
+			PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0)
+		return NULL ;
+	if (PyObject_GetBuffer(outmissob, &outmissview,
+			PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) != 0) {
+		PyBuffer_Release(&outview) ;
+		return NULL ;
+	}
+	n = outview.len / outview.itemsize ;
 
-	/* j + 1 since python index starts from 0 */		
-	if (SF_ifobs(j + 1)) {
-		Py_INCREF(Py_True) ;
-		return Py_True ;
+	left.view.obj = left.codes_view.obj = NULL ;
+	right.view.obj = right.codes_view.obj = NULL ;
+	if (outview.format == NULL || strcmp(outview.format, "d") != 0 ||
+			outmissview.itemsize != 1 || outmissview.len < n) {
+		PyErr_SetString(PyExc_TypeError,
+			"out should be writable buffer of doubles, and out "
+			"missing a writable byte buffer at least as long") ;
+		nmiss = -1 ;
 	}
-	else {
-		Py_INCREF(Py_False) ;
-		return Py_False ;
+	else if (arith_operand_init(xob, xmissob, n, &left) ||
+			arith_operand_init(yob, ymissob, n, &right)) {
+		nmiss = -1 ;
 	}
+	else {
+		/* the loop uses no Python objects, so other threads 
+		can run meanwhile */
+		Py_BEGIN_ALLOW_THREADS
+		nmiss = math_kernel(func, &left, &right, (double *) outview.buf,
+			(unsigned char *) outmissview.buf, n, &error) ;
+		Py_END_ALLOW_THREADS
+		if (error & MATH_ZERO_DIVISION)
+			PyErr_SetString(PyExc_ZeroDivisionError,
+				"float division by zero") ;
+		else if (error & MATH_DOMAIN_ERROR)
+			PyErr_SetString(PyExc_ValueError, "math domain error") ;
+		else if (error & MATH_FLOOR_OVERFLOW)
+			PyErr_SetString(PyExc_OverflowError,
+				"cannot convert float infinity to integer") ;
+		if (error)
+			nmiss = -1 ;
+	}
+
+	PyBuffer_Release(&left.view) ;
+	PyBuffer_Release(&left.codes_view) ;
+	PyBuffer_Release(&right.view) ;
+	PyBuffer_Release(&right.codes_view) ;
+	PyBuffer_Release(&outmissview) ;
+	PyBuffer_Release(&outview) ;
+	if (nmiss < 0)
+		return NULL ;
+	return PyLong_FromSsize_t(nmiss) ;
 }
 
 static PyObject *
-st_in1(PyObject *self, PyObject *args)
+_st_touse(PyObject *self, PyObject *args)
 {
-	ST_int n ;
-	
-	if (!PyArg_ParseTuple(args, ""))
+	ST_int i, in1, in2, nobs ;
+	Py_ssize_t count ;
+	PyObject *maskob ;
+	Py_buffer mask ;
+	unsigned char *flags ;
+
+	if (!PyArg_ParseTuple(args, "O", &maskob))
 		return NULL ;
 
-	n = SF_in1() ;
-	
-	/* n - 1 since python indexing starts from 0 */
-	return PyLong_FromLong((long) n - 1) ;
-}
+	if (PyObject_GetBuffer(maskob, &mask,
+			PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) != 0)
+		return NULL ;
 
-static PyObject *
-st_in2(PyObject *self, PyObject *args)
-{
-	ST_int n ;
-	
-	if (!PyArg_ParseTuple(args, ""))
+	nobs = context.nobs ;
+	if (mask.itemsize != 1 || mask.len < nobs) {
+		PyErr_SetString(PyExc_TypeError,
+			"mask should be writable byte buffer, "
+			"at least as long as number of observations") ;
+		PyBuffer_Release(&mask) ;
 		return NULL ;
+	}
 
-	n = SF_in2() ;
-	
-	/* Unlike stata_in1() function above, do not adjust by - 1.
-	Python indexes will often be used like x[n1:n2] or
-	range(n1, n2), which means n1 up to but not including n2. */
-	return PyLong_FromLong((long) n) ;
+	/* in1 and in2 of the context are 1-based and inclusive */
+	in1 = context.in1 - 1 ;
+	in2 = context.in2 ;
+	flags = (unsigned char *) mask.buf ;
+	count = 0 ;
+	for (i = 0; i < nobs; i++) {
+		if (i >= in1 && i < in2 && SF_ifobs(i + 1)) {
+			flags[i] = 1 ;
+			count++ ;
+		}
+		else {
+			flags[i] = 0 ;
+		}
+	}
+
+	PyBuffer_Release(&mask) ;
+
+	return PyLong_FromSsize_t(count) ;
 }
 
 static PyObject *
@@ -549,10 +2332,7 @@ st_matrix_el(PyObject *self, PyObject *args)
 		}
 
 		if (SF_is_missing(val)) {
-			pyob = PyObject_CallObject(
-				Py_GetMissing, Py_BuildValue("(d)", val)) ;
-			Py_INCREF(pyob) ;
-			return pyob ;
+			return missing_object(val) ;
 		}
 	
 		return PyFloat_FromDouble(val) ;
@@ -567,7 +2347,7 @@ st_matrix_el(PyObject *self, PyObject *args)
 			}
 			/* check whether pyob is MissingValue or None or something else */
 			if (PyObject_IsInstance(pyob, Py_MissingValueCls)) {
-				val = PyFloat_AsDouble(PyObject_GetAttrString(pyob, "value")) ;
+				val = missing_as_double(pyob) ;
 			}
 			else if (pyob == Py_None) {
 				val = SV_missval ;
@@ -769,10 +2549,7 @@ st_numscalar(PyObject *self, PyObject *args)
 		}
 		
 		if (SF_is_missing(value)) {
-			pyob = PyObject_CallObject(
-				Py_GetMissing, Py_BuildValue("(d)", value)) ;
-			Py_INCREF(pyob) ;
-			return pyob ;
+			return missing_object(value) ;
 		}
 		
 		return PyFloat_FromDouble(value) ;
@@ -787,8 +2564,7 @@ st_numscalar(PyObject *self, PyObject *args)
 			}
 			/* check whether pyob is MissingValue or None or something else */
 			if (PyObject_IsInstance(pyob, Py_MissingValueCls)) {
-				value = PyFloat_AsDouble(
-					PyObject_GetAttrString(pyob, "value")) ;
+				value = missing_as_double(pyob) ;
 			}
 			else if (pyob == Py_None) {
 				value = SV_missval ;
@@ -833,6 +2609,10 @@ get_st_varnum(PyObject *arg)
 		else {
 			varnum = findvar(varname, 1) ;
 			/* findvar will set Python error string if warranted */
+			
+			/* findvar gives 0-based index; make it 1-based, as below */
+			if (varnum >= 0)
+				varnum = varnum + 1 ;
 		}
 	}
 	else {
@@ -864,7 +2644,7 @@ st_isstrvar(PyObject *self, PyObject *args)
 	if (varnum < 0) 
 		return NULL ;
 		
-	if (SF_isstr((ST_int) varnum)) {
+	if (VAR_ISSTR(varnum - 1)) {
 		Py_INCREF(Py_True) ;
 		return Py_True ;
 	}
@@ -884,7 +2664,7 @@ st_isnumvar(PyObject *self, PyObject *args)
 	if (varnum < 0)
 		return NULL ;
 		
-	if (!SF_isstr((ST_int) varnum)) {
+	if (!VAR_ISSTR(varnum - 1)) {
 		Py_INCREF(Py_True) ;
 		return Py_True ;
 	}
@@ -894,6 +2674,22 @@ st_isnumvar(PyObject *self, PyObject *args)
 	}
 }
 
+static PyObject *
+_st_varindex_stats(PyObject *self, PyObject *args)
+{
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL ;
+
+	return Py_BuildValue("{s:l,s:n,s:d,s:l,s:l,s:l,s:l}",
+		"nvars", varnames.nvars,
+		"bytes", (Py_ssize_t) varnames.bytes,
+		"build_time", varnames.build_time,
+		"reuses", varnames.reuses,
+		"builds", varnames.builds,
+		"hits", varnames.hits,
+		"misses", varnames.misses) ;
+}
+
 static PyObject * 
 st_varindex(PyObject *self, PyObject *args)
 {
@@ -946,8 +2742,11 @@ st_varname(PyObject *self, PyObject *args)
 		return NULL ;
 	}
 	
-	/* varnum - 1 since python indexing starts from 0 */
-	return PyUnicode_FromString(varnames[varnum]) ;
+	/* convert negative index to positive */
+	if (varnum < 0)
+		varnum = num_stata_vars + varnum ;
+
+	return PyUnicode_FromString(VARNAME(varnum)) ;
 }
 
 static PyObject *
@@ -1018,7 +2817,7 @@ st_format(PyObject *self, PyObject *args)
 		}
 		/* check whether pyob is MissingValue or None or something else */
 		if (PyObject_IsInstance(pyob, Py_MissingValueCls)) {
-			value = PyFloat_AsDouble(PyObject_GetAttrString(pyob, "value")) ;
+			value = missing_as_double(pyob) ;
 		}
 		else if (pyob == Py_None) {
 			value = SV_missval ;
@@ -1054,6 +2853,33 @@ st_format(PyObject *self, PyObject *args)
 }
 
 static PyMethodDef StataMethods[] = {
+	{"_st_arith", _st_arith, METH_VARARGS,
+	 "Element-wise arithmetic or comparison on buffers of doubles,\n"
+	 "in a single loop, with Stata's rules for missing values\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "op : str\n"
+	 "    one of +, -, *, /, //, %, **, <, <=, ==, !=, >, >=\n"
+	 "x : buffer of doubles (e.g., array('d')), or number\n"
+	 "xmissing : buffer of bytes, or None\n"
+	 "    missing-value codes for `x`:\n"
+	 "    0 if non-missing, k + 1 for MISSING_VALS[k]\n"
+	 "y : buffer of doubles, or number\n"
+	 "ymissing : buffer of bytes, or None\n"
+	 "    missing-value codes for `y`\n"
+	 "out : writable buffer of doubles\n"
+	 "    receives result; buffers `x` and `y` should be\n"
+	 "    at least as long\n"
+	 "outmissing : writable buffer of bytes\n"
+	 "    receives missing-value codes for result;\n"
+	 "    arithmetic gives . (code 1) where either operand is\n"
+	 "    missing, or the result is not a non-missing value\n"
+	 "    (e.g., after division by zero); comparisons use the\n"
+	 "    values as stored, with missing values greater than\n"
+	 "    all numbers, and give 1.0 or 0.0\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "int (number of missing values in result)"},
 	{"st_cols", st_cols, METH_VARARGS,
 	 "Get number of columns in given matrix.\n\n"
 	 "Parameters\n"
@@ -1062,6 +2888,15 @@ static PyMethodDef StataMethods[] = {
 	 "Returns\n"
 	 "-------\n"
 	 "int"},
+	{"_st_context", _st_context, METH_VARARGS,
+	 "Get the information about the data set gathered at the start\n"
+	 "of the current plugin call.\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "tuple of (number of plugin calls, number of observations,\n"
+	 "number of variables, in1, in2, bytes with 1 for each string\n"
+	 "variable and 0 for each numeric variable); in1 and in2 are\n"
+	 "1-based and inclusive, as in Stata"},
 	{"_st_data", _st_data, METH_VARARGS,
 	 "Retrieve value in given observation and Stata numeric variable\n\n"
 	 "Parameters\n"
@@ -1071,6 +2906,43 @@ static PyMethodDef StataMethods[] = {
 	 "Returns\n"
 	 "-------\n"
 	 "float or MissingValue instance"},
+	{"_st_data_array", _st_data_array, METH_VARARGS,
+	 "Copy values of one Stata numeric variable into a buffer of\n"
+	 "doubles, in a single loop over the given observations\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "varnum : int\n"
+	 "obsnums : range, or buffer of int (e.g., array('l'))\n"
+	 "values : writable buffer of doubles (e.g., array('d'))\n"
+	 "    at least as long as `obsnums`;\n"
+	 "    missing values are copied as Stata's large floats\n"
+	 "missing : writable buffer of bytes (e.g., bytearray)\n"
+	 "    optional;\n"
+	 "    receives a missing-value code for each observation:\n"
+	 "    0 if non-missing, k + 1 for MISSING_VALS[k]\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "int (number of missing values)"},
+	{"_st_data_block", _st_data_block, METH_VARARGS,
+	 "Retrieve values of several Stata numeric variables in given\n"
+	 "observations into one contiguous buffer\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "obsnums : range, or buffer of int (e.g., array('l'))\n"
+	 "varnums : sequence of int\n"
+	 "values : writable buffer of float (e.g., array('d')),\n"
+	 "    with at least len(obsnums) * len(varnums) entries\n"
+	 "missing : writable buffer of bytes (e.g., bytearray), or None\n"
+	 "    optional;\n"
+	 "    if given, filled with missing-value codes:\n"
+	 "    0 if non-missing, k + 1 for MISSING_VALS[k]\n"
+	 "colmajor : int\n"
+	 "    optional;\n"
+	 "    if non-zero, values of each variable are contiguous;\n"
+	 "    otherwise (the default) values of each observation are\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "int (number of missing values)"},
 	{"_st_display", _st_display, METH_VARARGS,
 	 "Display text in results window.\n"
 	 "Any included smcl is interpreted.\n\n"
@@ -1189,6 +3061,33 @@ static PyMethodDef StataMethods[] = {
 	 "    Returns\n"
 	 "    -------\n"
 	 "    None"},
+	{"_st_math", _st_math, METH_VARARGS,
+	 "Element-wise stata_math function on buffers of doubles, with\n"
+	 "the same results as the Python functions. The GIL is released\n"
+	 "during the loop, so calls on parts of the buffers can run in\n"
+	 "parallel in threads.\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "func : str\n"
+	 "    one of cloglog, digamma, invlogit, lngamma, reldif,\n"
+	 "    round, trigamma\n"
+	 "x : buffer of doubles (e.g., array('d')), or number\n"
+	 "xmissing : buffer of bytes, or None\n"
+	 "    missing-value codes for `x`:\n"
+	 "    0 if non-missing, k + 1 for MISSING_VALS[k]\n"
+	 "y : buffer of doubles, or number\n"
+	 "    second argument of reldif and round, ignored otherwise;\n"
+	 "    for round, an int gives results as with an int `y`\n"
+	 "ymissing : buffer of bytes, or None\n"
+	 "    missing-value codes for `y`\n"
+	 "out : writable buffer of doubles\n"
+	 "    receives result; buffers `x` and `y` should be\n"
+	 "    at least as long\n"
+	 "outmissing : writable buffer of bytes\n"
+	 "    receives missing-value codes for result\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "int (number of missing values in result)"},
 	{"st_matrix_el", st_matrix_el, METH_VARARGS,
 	 "with 3 arguments:\n"
 	 "    Retrieve value in given matrix row and column\n\n"
@@ -1211,6 +3110,14 @@ static PyMethodDef StataMethods[] = {
 	 "    Returns\n"
 	 "    -------\n"
 	 "    None"},
+	{"_st_ncalls", _st_ncalls, METH_VARARGS,
+	 "Get the number of times the plugin has been called. The\n"
+	 "variables and observations of the data set can change only\n"
+	 "between calls, so information about them can be kept for\n"
+	 "as long as this number is unchanged.\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "int"},
 	{"st_nobs", st_nobs, METH_VARARGS,
 	 "Get the number of observations in the current Stata data set\n\n"
 	 "Returns\n"
@@ -1255,6 +3162,16 @@ static PyMethodDef StataMethods[] = {
 	 "Returns\n"
 	 "-------\n"
 	 "str"},
+	{"_st_sdata_list", _st_sdata_list, METH_VARARGS,
+	 "Retrieve values of one Stata string variable in a single loop\n"
+	 "over the given observations; repeated values share one str\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "varnum : int\n"
+	 "obsnums : range, or buffer of int (e.g., array('l'))\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "list of str"},
 	{"_st_sstore", _st_sstore, METH_VARARGS,
 	 "Set value in given Stata string variable and observation\n\n"
 	 "Parameters\n"
@@ -1265,6 +3182,22 @@ static PyMethodDef StataMethods[] = {
 	 "Returns\n"
 	 "-------\n"
 	 "None"},
+	{"_st_sstore_list", _st_sstore_list, METH_VARARGS,
+	 "Set values of one Stata string variable in a single loop\n"
+	 "over the given observations\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "varnum : int\n"
+	 "obsnums : range, or buffer of int (e.g., array('l'))\n"
+	 "strings : sequence of str, with same length as `obsnums`\n"
+	 "changed : int\n"
+	 "    optional;\n"
+	 "    if nonzero, strings equal to those already stored\n"
+	 "    are not written again\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "None, or if `changed` is nonzero, int number of\n"
+	 "values written"},
 	{"_st_store", _st_store, METH_VARARGS,
 	 "Set value in given Stata numeric variable and observation\n\n"
 	 "Parameters\n"
@@ -1275,6 +3208,40 @@ static PyMethodDef StataMethods[] = {
 	 "Returns\n"
 	 "-------\n"
 	 "None"},
+	{"_st_store_array", _st_store_array, METH_VARARGS,
+	 "Set values of one Stata numeric variable from a buffer of\n"
+	 "numbers, in a single loop over the given observations\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "varnum : int\n"
+	 "obsnums : range, or buffer of int (e.g., array('l'))\n"
+	 "values : 1-dimensional buffer of numbers\n"
+	 "    (e.g., array.array, memoryview, numpy array)\n"
+	 "    with same length as `obsnums`\n"
+	 "missing : buffer of bytes (e.g., bytearray)\n"
+	 "    optional;\n"
+	 "    missing-value code for each observation:\n"
+	 "    0 to use value, k + 1 to store MISSING_VALS[k]\n"
+	 "changed : int\n"
+	 "    optional;\n"
+	 "    if nonzero, values identical to those already stored\n"
+	 "    are not written again\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "None, or if `changed` is nonzero, int number of\n"
+	 "values written"},
+	{"_st_touse", _st_touse, METH_VARARGS,
+	 "Mark the observations satisfying the `if` condition and\n"
+	 "`in` range (specified when Python was invoked), in a\n"
+	 "single loop over observations\n\n"
+	 "Parameters\n"
+	 "----------\n"
+	 "mask : writable buffer of bytes (e.g., bytearray),\n"
+	 "    at least as long as number of observations;\n"
+	 "    receives 1 for each marked observation, 0 otherwise\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "int (number of marked observations)"},
 	{"st_varindex", st_varindex, METH_VARARGS,
 	 "Find the index of the given Stata variable\n\n"
 	 "Parameters\n"
@@ -1287,6 +3254,20 @@ static PyMethodDef StataMethods[] = {
 	 "Returns\n"
 	 "-------\n"
 	 "int"},
+	{"_st_varindex_stats", _st_varindex_stats, METH_VARARGS,
+	 "Report on the index used to look up Stata variable names,\n"
+	 "which is kept between invocations and rebuilt only when\n"
+	 "the variable names change\n\n"
+	 "Returns\n"
+	 "-------\n"
+	 "dict with keys\n"
+	 "    'nvars' : number of names in index\n"
+	 "    'bytes' : memory used by index\n"
+	 "    'build_time' : seconds (of processor time) taken to build index\n"
+	 "    'reuses' : number of invocations that reused index\n"
+	 "    'builds' : number of invocations that built index\n"
+	 "    'hits' : number of names looked up and found\n"
+	 "    'misses' : number of names looked up and not found"},
 	{"st_varname", st_varname, METH_VARARGS,
 	 "Return the name of the Stata variable at the given index\n\n"
 	 "Parameters\n"
@@ -1310,7 +3291,27 @@ static struct PyModuleDef statamodule = {
 PyMODINIT_FUNC
 PyInit_stata_plugin(void)
 {
-	return PyModule_Create(&statamodule) ;
+	PyObject *module, *vals ;
+
+	if (PyType_Ready(&MissingValueType) < 0)
+		return NULL ;
+
+	module = PyModule_Create(&statamodule) ;
+	if (module == NULL)
+		return NULL ;
+
+	vals = make_missing_vals() ;
+	if (vals == NULL) {
+		Py_DECREF(module) ;
+		return NULL ;
+	}
+	Py_INCREF(&MissingValueType) ;
+	PyModule_AddObject(module, "MissingValue", 
+		(PyObject *) &MissingValueType) ;
+	Py_INCREF(Py_MissingVals[0]) ;
+	PyModule_AddObject(module, "MISSING", Py_MissingVals[0]) ;
+	PyModule_AddObject(module, "MISSING_VALS", vals) ;
+	return module ;
 }
 
 static int 
@@ -1416,7 +3417,8 @@ initialize_plugin(void)
 static int
 initialize_missing(void)
 {
-	PyObject *miModule ;
+	PyObject *miModule, *missVals ;
+	int k ;
 			
 	/* define missing value objects (i.e., make these known to C code) */
 	miModule = PyImport_ImportModule("stata_missing") ;
@@ -1428,15 +3430,72 @@ initialize_missing(void)
 	}
 	Py_MISSING = PyObject_GetAttrString(miModule, "MISSING") ;
 	Py_MissingValueCls = PyObject_GetAttrString(miModule, "MissingValue") ;
-	Py_GetMissing = PyObject_GetAttrString(miModule, "get_missing") ;
+
+	/* keep the 27 missing values, so that they can be looked up by 
+	index rather than by calling stata_missing.get_missing */
+	missVals = PyObject_GetAttrString(miModule, "MISSING_VALS") ;
+	Py_DECREF(miModule) ;
+	if (Py_MISSING == NULL || Py_MissingValueCls == NULL || 
+			missVals == NULL || !PyTuple_Check(missVals) || 
+			PyTuple_GET_SIZE(missVals) != 27) {
+		PyErr_Clear() ;
+		Py_XDECREF(missVals) ;
+		Py_CLEAR(Py_MISSING) ;
+		SF_error("could not find missing values in stata_missing module") ;
+		SF_error("\n") ;
+		return 601 ;
+	}
+	/* the instances are those made in PyInit_stata_plugin, which 
+	already holds a reference to each */
+	for (k = 0; k < 27; k++)
+		Py_MissingVals[k] = PyTuple_GET_ITEM(missVals, k) ;
+	Py_DECREF(missVals) ;
 	return 0 ;
 }
 
+/* Read whole file into *buf, growing buffer as needed; returns number
+of characters read, or -1 if file could not be read */
+static long
+read_names_file(char *path, char **buf, size_t *bufsize)
+{
+	FILE *fp ;
+	size_t len, n ;
+	char *bigger ;
+
+	fp = fopen(path, "r") ;
+	if (fp == NULL)
+		return -1 ;
+
+	len = 0 ;
+	for (;;) {
+		if (len + 1024 + 2 > *bufsize) {
+			bigger = (char *) realloc(*buf, 2 * (len + 1024 + 2)) ;
+			if (bigger == NULL) {
+				fclose(fp) ;
+				return -1 ;
+			}
+			*buf = bigger ;
+			*bufsize = 2 * (len + 1024 + 2) ;
+		}
+		n = fread(*buf + len, 1, 1024, fp) ;
+		len += n ;
+		if (n < 1024)
+			break ;
+	}
+	fclose(fp) ;
+	return (long) len ;
+}
+
 static void
 setup_varnames(void)
 {
-	int rc, i, j ;
-	char lname[17], varnamei[33], nvar[6], varnum[6], *end = NULL ;
+	int rc ;
+	char nvar[6], path[1025], *end = NULL ;
+	static char *text = NULL ;
+	static size_t textsize = 0 ;
+	size_t len, k, n ;
+	long nread, nnames ;
+	char *bigger ;
 	/* nvar[6] covers max no. of Stata vars, 32767 */
 	
 	/* this block sets num_stata_vars */
@@ -1444,28 +3503,93 @@ setup_varnames(void)
 	rc = SF_macro_use("__pynallvars", nvar, 5) ;
 	num_stata_vars = strtol(nvar, &end, 10) ;
 	/* if nvar string not exhausted, set num_stata_vars to 0 */
-	if (*end)
+	if (*end || num_stata_vars < 0)
 		num_stata_vars = 0 ;
 
-	/* put all Stata variable names in **varnames 
-	   and make trie tree of names */
-	lname[0] = '\0' ;
-	strcat(lname, "__pyallvars") ;
-	lname[16] = '\0' ;
+	/* All Stata variable names come in one space-delimited local,
+	   or, if too long for a macro, in a file named in another local.
+	   The buffer is reused between calls. */
+	n = 33 * num_stata_vars + 2 ;
+	if (n > textsize) {
+		bigger = (char *) realloc(text, n) ;
+		if (bigger == NULL) {
+			num_stata_vars = 0 ;
+			return ;
+		}
+		text = bigger ;
+		textsize = n ;
+	}
 
-	varnames_trie = trie_initialize(NULL) ;
-	for (i = 0; i < num_stata_vars; i++) {
-		sprintf(varnum, "%d", i) ;
-		for (j = 0; j < 6 && (lname[11+j] = varnum[j]) != '\0'; j++)
-			;
-		rc = SF_macro_use(lname, varnamei, 32) ;
-		if (rc) {
-			varnames[i][0] = '\0' ;
-			continue ;
+	len = 0 ;
+	if (num_stata_vars > 0) {
+		path[0] = path[1024] = '\0' ;
+		rc = SF_macro_use("__pyallvarsfile", path, 1024) ;
+		if (!rc && path[0] != '\0') {
+			nread = read_names_file(path, &text, &textsize) ;
+			len = nread < 0 ? 0 : (size_t) nread ;
+		}
+		else {
+			text[0] = text[textsize - 1] = '\0' ;
+			rc = SF_macro_use("__pyallvars", text, (int) textsize - 2) ;
+			len = rc ? 0 : strlen(text) ;
+		}
+	}
+
+	/* one pass to put list in the form used by the index: each
+	   name followed by a single space */
+	nnames = 0 ;
+	n = 0 ;
+	for (k = 0; k < len; k++) {
+		if (isspace((unsigned char) text[k])) {
+			if (n > 0 && text[n - 1] != ' ') {
+				text[n++] = ' ' ;
+				nnames++ ;
+			}
+		}
+		else {
+			text[n++] = text[k] ;
+		}
+	}
+	if (n > 0 && text[n - 1] != ' ') {
+		text[n++] = ' ' ;
+		nnames++ ;
+	}
+
+	if (varname_index_update(text, n, nnames))
+		num_stata_vars = 0 ;
+	else
+		num_stata_vars = varnames.nvars ;
+}
+
+/* Gather information about the data set for the current plugin call. 
+If the memory for variable types can't be allocated, they are left to 
+be looked up from Stata when needed. */
+static void
+setup_context(void)
+{
+	ST_int j ;
+	unsigned char *bigger ;
+	
+	context.nobs = SF_nobs() ;
+	context.nvar = (ST_int) num_stata_vars ;
+	context.in1 = SF_in1() ;
+	context.in2 = SF_in2() ;
+	
+	if ((size_t) context.nvar > context.size) {
+		bigger = (unsigned char *) realloc(context.isstr, context.nvar) ;
+		if (bigger == NULL) {
+			free(context.isstr) ;
+			context.isstr = NULL ;
+			context.size = 0 ;
+			return ;
 		}
-		strcpy(varnames[i], varnamei) ;
-		varnames_trie = trie_add_word(varnames_trie, varnamei, i) ;
+		context.isstr = bigger ;
+		context.size = (size_t) context.nvar ;
 	}
+	if (context.isstr == NULL)
+		return ;
+	for (j = 0; j < context.nvar; j++)
+		context.isstr[j] = SF_isstr(j + 1) ? 1 : 0 ;
 }
 
 STDLL
@@ -1486,6 +3610,8 @@ stata_call(int argc, char *argv[])
 	}
 
 	setup_varnames() ;
+	setup_context() ;
+	num_plugin_calls++ ;
 	
 	/* decide if run file or run interaction session */
 	if (argc >= 1 && *argv[0] != '\0') {
@@ -1495,11 +3621,8 @@ stata_call(int argc, char *argv[])
 		run_interactive() ;
 	}
 
-	/* free memory in varnames_trie, since memory 
-	will be reallocated on next plugin call */
-	if (num_stata_vars > 0) {
-		trie_free(varnames_trie) ;
-	}
+	/* variable name index is not freed; it is reused
+	on next plugin call if variables are unchanged */
 	
 	return 0 ;
 }
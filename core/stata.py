@@ -1,29 +1,36 @@
 import sys
 import collections
+import operator
 import re
+from array import array
+from contextlib import contextmanager
+from itertools import compress, islice
 from math import ceil, log, floor
 
-from stata_missing import MissingValue, MISSING
+from stata_missing import MissingValue, MISSING, MISSING_VALS
 from stata_plugin import *
 from stata_plugin import (
-    _st_data, _st_store, _st_sdata, _st_sstore, _st_display, _st_error
+    _st_data, _st_store, _st_sdata, _st_sstore, _st_display, _st_error,
+    _st_data_array, _st_data_block, _st_store_array, _st_sdata_list, 
+    _st_sstore_list, _st_touse, _st_varindex_stats, _st_ncalls, _st_context
 )
-from stata_variable import StataVariable
+from stata_variable import StataVariable, StataVarVals, StataMask, _wrap
 
 
 __version__ = "0.2.0"
 
 
 __all__ = [
-    'st_cols', '_st_data', 'st_data', 'st_format', 'st_global', 
-    'st_ifobs', 'st_in1', 'st_in2', 'st_isfmt', 'st_islmname', 
+    'st_cols', '_st_data', 'st_data', 'st_data_array', 'st_data_block', 
+    'st_format', 'st_global', 'st_ifobs', 'st_in1', 'st_in2', 'st_isfmt', 'st_islmname', 
     'st_ismissing', 'st_isname', 'st_isnumfmt', 'st_isnumvar', 
     'st_isstrfmt', 'st_isstrvar', 'st_isvarname', 'st_local', 
     'st_matrix', 'st_matrix_el', 'st_mirror', 'st_nobs', 
     'st_numscalar', 'st_nvar', 'st_rows', '_st_sdata', 
-    'st_sdata', '_st_sstore', 'st_sstore', '_st_store', 
-    'st_store', 'st_varindex', 'st_varname', 'st_view', 
-    'st_viewobs', 'st_viewvars'
+    'st_sdata', 'st_sdata_list', '_st_sstore', 'st_sstore', 
+    'st_sstore_list', '_st_store', 
+    'st_store', 'st_store_array', 'st_touse', 'st_touse_obs', 
+    'st_varindex', 'st_varname', 'st_view', 'st_viewobs', 'st_viewvars'
 ]
 
 
@@ -216,13 +223,8 @@ def st_islmname(name):
     return True if VALID_LMNAME_RE.match(name) else False
 
 
-def _parse_obs_cols_vals(obs, cols, value=None):
-    """helper for st_data, st_sdata, st_store, and st_sstore"""
-    if isinstance(obs, int):
-        obs = (obs,)
-    if (not isinstance(obs, collections.Iterable) or 
-            not all(isinstance(o, int) for o in obs)):
-        raise TypeError("observations should be int or iterable of ints")
+def _parse_cols(cols):
+    """helper for _parse_obs_cols_vals and st_data_block"""
     if isinstance(cols, int) or isinstance(cols, str):
         cols = (cols,)
     if (not isinstance(cols, collections.Iterable) or 
@@ -231,17 +233,31 @@ def _parse_obs_cols_vals(obs, cols, value=None):
     
     # If entry in cols is str, break apart and apply st_findindex.
     # Either way, unpack into flat list.
-    cols = [item 
+    return [item 
         for c in cols 
             for item in 
                 ((st_varindex(name, True) for name in c.split())
                  if isinstance(c, str) else (c,))]
+
+
+def _parse_obs_cols_vals(obs, cols, value=None):
+    """helper for st_data, st_sdata, st_store, and st_sstore"""
+    if isinstance(obs, int):
+        obs = (obs,)
+    if (not isinstance(obs, collections.Iterable) or 
+            not all(isinstance(o, int) for o in obs)):
+        raise TypeError("observations should be int or iterable of ints")
+    cols = _parse_cols(cols)
     
     # checking vals
     if value is not None:
         nobs = len(obs)
         ncols = len(cols)
         
+        # an iterator of rows is checked as it is written (see _store_rows)
+        if isinstance(value, collections.Iterator) and nobs > 1:
+            return obs, cols, value
+        
         def tuple_maker(x):
             if isinstance(x, str) or not isinstance(x, collections.Iterable):
                 return (x,)
@@ -295,7 +311,152 @@ def st_data(obsnums, vars):
     if not all(st_isnumvar(v) for v in vars):
         raise TypeError("only numeric Stata variables allowed")
     
-    return [[_st_data(i,j) for j in vars] for i in obsnums]
+    if not vars:
+        return [[] for i in obsnums]
+    
+    return _block_to_lists(*_data_block(obsnums, vars), size=len(vars))
+
+
+def _data_block(obsnums, varnums, colmajor=False):
+    """helper for st_data, st_data_block, and StataView.to_list;
+    returns array of values, bytearray of missing-value codes, 
+    and number of missing values
+    
+    """
+    if not isinstance(obsnums, range):
+        obsnums = array('l', obsnums)
+    n = len(obsnums) * len(varnums)
+    values = array('d', [0.0]) * n
+    missing = bytearray(n)
+    nmiss = _st_data_block(obsnums, varnums, values, missing, colmajor)
+    return values, missing, nmiss
+
+
+def _block_to_lists(values, missing, nmiss, size):
+    """helper for st_data and StataView.to_list;
+    splits block of values into lists of length `size`,
+    with MissingValue instances in place of missing values
+    
+    """
+    if nmiss:
+        values = [MISSING_VALS[m - 1] if m else v 
+                  for v, m in zip(values, missing)]
+    else:
+        values = values.tolist()
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def st_data_block(obsnums, vars, colmajor=False):
+    """Return numeric data in given observations and Stata variables 
+    as one contiguous array.
+    
+    Values are copied in a single plugin call, which is much faster 
+    than `st_data` for many observations or variables.
+    
+    Parameters
+    ----------
+    obsnums : int, slice, range, iterable of int, or None
+        if None, all observations are used
+    vars : int, str, or iterable of int or str
+        integers denote column numbers
+        strings should be Stata variable names or 
+          unambiguous abbreviations
+    colmajor : bool
+        optional
+        default value is False
+        if False, values are in row-major order, i.e., the value for
+          the i-th observation and j-th variable is at i * nvars + j;
+        if True, values are in column-major order, i.e., that value
+          is at j * nobs + i
+    
+    Returns
+    -------
+    Tuple (values, missing), where `values` is an array.array of
+    float (typecode 'd') and `missing` is a bytearray of missing-value
+    codes in the same layout: 0 for non-missing values, and k + 1 
+    where the value is MISSING_VALS[k]. Missing values appear in 
+    `values` as Stata's large floats.
+    
+    """
+    obsnums, _ = _parse_bulk_obs_var(obsnums, 0)
+    vars = _parse_cols(vars)
+    values, missing, _ = _data_block(obsnums, vars, colmajor)
+    return values, missing
+
+
+def _parse_bulk_obs_var(obsnums, var, nvals=None):
+    """helper for bulk transfer functions like st_data_array;
+    returns observation spec accepted by the plugin and a single
+    variable index
+
+    for stores, `nvals` is the number of values to be stored, and
+    None or an int in `obsnums` gives the first observation
+
+    """
+    if nvals is not None and (obsnums is None or isinstance(obsnums, int)):
+        start = 0 if obsnums is None else obsnums
+        if start < 0:
+            start += st_nobs()
+        obsnums = range(start, start + nvals)
+    elif obsnums is None:
+        obsnums = range(st_nobs())
+    elif isinstance(obsnums, int):
+        obsnums = (obsnums,)
+    elif isinstance(obsnums, slice):
+        obsnums = range(*obsnums.indices(st_nobs()))
+
+    if not isinstance(obsnums, range):
+        if not isinstance(obsnums, collections.Iterable):
+            raise TypeError("observations should be int, slice, or "
+                            "iterable of int")
+        try:
+            obsnums = array('l', obsnums)
+        except TypeError:
+            raise TypeError("observations should be int, slice, or "
+                            "iterable of int")
+
+    if isinstance(var, str):
+        var = st_varindex(var, True)
+    elif not isinstance(var, int):
+        raise TypeError("variable should be specified with single int or str")
+
+    return obsnums, var
+
+
+def st_data_array(var, obsnums=None):
+    """Return numeric data of a single Stata variable as a typed array.
+
+    Values are copied in a single loop inside the plugin, which is
+    much faster than `st_data` for many observations.
+
+    Parameters
+    ----------
+    var : int or str
+        integers denote column numbers
+        strings should be Stata variable names or
+          unambiguous abbreviations
+    obsnums : int, slice, range, iterable of int, or None
+        optional
+        default value is None
+        if not specified, or is None, all observations are used;
+        ranges and slices are passed to the plugin without being
+          expanded into individual indices
+
+    Returns
+    -------
+    Tuple (values, missing), where `values` is an array.array of
+    float (typecode 'd') and `missing` is a bytearray of missing-value
+    codes, one for each observation: 0 for non-missing values, and
+    k + 1 where the value is MISSING_VALS[k]. Missing values appear
+    in `values` as Stata's large floats.
+
+    """
+    obsnums, var = _parse_bulk_obs_var(obsnums, var)
+    n = len(obsnums)
+    values = array('d', [0.0]) * n
+    missing = bytearray(n)
+    _st_data_array(var, obsnums, values, missing)
+    return values, missing
 
 
 def st_sdata(obsnums, vars):
@@ -347,11 +508,233 @@ def st_store(obs, cols, vals):
     if not all(st_isnumvar(c) for c in cols):
         raise TypeError("only numeric Stata variables allowed")
     
+    if isinstance(vals, collections.Iterator):
+        _store_rows(obs, cols, vals)
+        return
+    
     for obs_num, value_row in zip(obs, vals):
         for col_num, value in zip(cols, value_row):
             _st_store(obs_num, col_num, value)
 
 
+def _values_to_array(values):
+    """helper for st_store_array; converts an iterable of numbers,
+    MissingValue instances, or None into an array of float and a
+    bytearray of missing-value codes
+
+    """
+    n = len(values)
+    floats = array('d', [0.0]) * n
+    missing = bytearray(n)
+    for i, v in enumerate(values):
+        if v is None:
+            missing[i] = 1
+        elif isinstance(v, MissingValue):
+            missing[i] = v.index + 1
+        else:
+            floats[i] = v
+    return floats, missing
+
+
+def _prepare_columns(varnums, columns):
+    """helper for _store_columns; converts one column (sequence or 
+    StataVarVals) per variable in `varnums` to what the plugin stores: 
+    a list of str for a string variable, and an array of float with 
+    a bytearray of missing-value codes (or None) for a numeric one
+    
+    All columns are converted before anything is written, so a bad 
+    value raises an error with nothing written.
+    
+    """
+    isstr = _data_context().isstr
+    prepared = []
+    for var, column in zip(varnums, columns):
+        if isstr[var]:
+            if not isinstance(column, (list, tuple)):
+                column = list(column)
+            if not all(isinstance(s, str) for s in column):
+                raise TypeError("only str allowed for string variables")
+            prepared.append((column, None))
+            continue
+        missing = None
+        if isinstance(column, StataVarVals):
+            column, missing = column._arrays()
+        if not isinstance(column, array):
+            column, missing = _values_to_array(list(column))
+        prepared.append((column, missing))
+    return prepared
+
+
+def _store_columns(obsnums, varnums, columns, written=0):
+    """helper for _store_rows and StataView.store_chunks; replaces 
+    values in observations `obsnums` with one plugin call per variable,
+    from one column (sequence or StataVarVals) per variable in `varnums`
+    
+    Every column is converted before the first one is stored, so a 
+    bad value leaves nothing of the block written. Its TypeError or 
+    ValueError is raised again with a message that says how many 
+    rows, `written`, were written before the block.
+    
+    """
+    try:
+        prepared = _prepare_columns(varnums, columns)
+    except (TypeError, ValueError) as e:
+        msg = "{}; the first {} rows were written".format(e, written)
+        raise type(e)(msg)
+    isstr = _data_context().isstr
+    for var, (column, missing) in zip(varnums, prepared):
+        if isstr[var]:
+            _st_sstore_list(var, obsnums, column)
+        else:
+            _st_store_array(var, obsnums, column, missing)
+
+
+class _WriteCount():
+    """Numbers of values compared and written by a StataMirror in 
+    `changed_only` mode
+    
+    """
+    def __init__(self):
+        self.compared = 0
+        self.written = 0
+        
+    def __repr__(self):
+        return "<{} values compared, {} written>".format(
+            self.compared, self.written
+        )
+
+
+_END = object()
+
+def _store_rows(obsnums, varnums, rows, size=65536):
+    """helper for writing an iterator of rows without building all of
+    them first; rows are written in blocks of `size`, one plugin call
+    per variable per block
+    
+    Each block is checked before it is written, including that there 
+    are no rows beyond the last block, so a ValueError for a wrong 
+    number of rows or columns, or a TypeError or ValueError for a bad 
+    value, leaves only whole blocks written, and its message says how 
+    many rows were written.
+    
+    """
+    nrows, ncols = len(obsnums), len(varnums)
+    if not isinstance(obsnums, (range, array)):
+        obsnums = array('l', obsnums)
+    rows = iter(rows)
+    written = 0
+    while True:
+        wanted = min(size, nrows - written)
+        block = [
+            (row,) if isinstance(row, str) or 
+                      not isinstance(row, collections.Iterable) 
+            else row
+            for row in islice(rows, wanted)
+        ]
+        if len(block) < wanted:
+            msg = "value has {} rows, expected {}; the first {} were written"
+            raise ValueError(
+                msg.format(written + len(block), nrows, written)
+            )
+        if written + wanted == nrows and next(rows, _END) is not _END:
+            msg = "value has more than {} rows; the first {} were written"
+            raise ValueError(msg.format(nrows, written))
+        for i, row in enumerate(block):
+            if not hasattr(row, "__len__"):
+                row = block[i] = tuple(row)
+            if len(row) != ncols:
+                msg = ("inner dimensions do not match number of columns "
+                       "in row {}; the first {} rows were written")
+                raise ValueError(msg.format(written + i, written))
+        end = written + wanted
+        _store_columns(obsnums[written:end], varnums, list(zip(*block)), 
+                       written)
+        written = end
+        if written == nrows:
+            return
+
+
+def st_store_array(var, values, obsnums=None, missing=None, 
+                   changed_only=False):
+    """Replace numeric data of a single Stata variable from a
+    sequence or buffer of numbers.
+    
+    Buffers such as array.array, memoryview, or numpy arrays are 
+    written in a single loop inside the plugin, which is much faster 
+    than `st_store` for many observations.
+    
+    Parameters
+    ----------
+    var : int or str
+        integers denote column numbers
+        strings should be Stata variable names or 
+          unambiguous abbreviations
+    values : buffer of numbers, or iterable of numbers,
+            MissingValue instances, or None
+    obsnums : int, slice, range, iterable of int, or None
+        optional
+        default value is None
+        if int, the first observation to replace, with 
+          len(values) observations replaced in all;
+        if not specified, or is None, replacement starts 
+          at the first observation
+    missing : buffer of bytes (e.g., bytearray)
+        optional
+        default value is None
+        missing-value code for each observation:
+          0 to use the value in `values`, and k + 1 to 
+          store MISSING_VALS[k] instead
+    changed_only : bool
+        optional
+        default value is False
+        if True, each value is compared with the one already 
+          stored, and is written only if they differ
+        
+    Returns
+    -------
+    None, or if `changed_only` is True, int number of values written
+    
+    """
+    try:
+        memoryview(values)
+    except TypeError:
+        if missing is not None:
+            raise TypeError("missing codes require values in a buffer")
+        values, missing = _values_to_array(list(values))
+    
+    obsnums, var = _parse_bulk_obs_var(obsnums, var, len(values))
+    if changed_only:
+        return _st_store_array(var, obsnums, values, missing, 1)
+    _st_store_array(var, obsnums, values, missing)
+
+
+def st_sdata_list(var, obsnums=None):
+    """Return string data of a single Stata variable as a list.
+    
+    Values are copied in a single loop inside the plugin, which is 
+    much faster than `st_sdata` for many observations. Repeated 
+    values share a single str object.
+    
+    Parameters
+    ----------
+    var : int or str
+        integers denote column numbers
+        strings should be Stata variable names or 
+          unambiguous abbreviations
+    obsnums : int, slice, range, iterable of int, or None
+        optional
+        default value is None
+        if not specified, or is None, all observations are used
+        
+    Returns
+    -------
+    List of str, one for each observation.
+    
+    """
+    obsnums, var = _parse_bulk_obs_var(obsnums, var)
+    return _st_sdata_list(var, obsnums)
+
+
 def st_sstore(obsnums, vars, values):
     """Replace data in given observations and Stata string variables
     
@@ -377,21 +760,100 @@ def st_sstore(obsnums, vars, values):
     if not all(st_isstrvar(v) for v in vars):
         raise TypeError("only string Stata variables allowed")
     
+    if isinstance(values, collections.Iterator):
+        _store_rows(obsnums, vars, values)
+        return
+    
     for obs, val_row in zip(obsnums, values):
         for col, val in zip(vars, val_row):
             _st_sstore(obs, col, val)
 
+
+def st_sstore_list(var, values, obsnums=None, changed_only=False):
+    """Replace string data of a single Stata variable from a 
+    sequence of str.
+    
+    Values are written in a single loop inside the plugin, which is 
+    much faster than `st_sstore` for many observations.
+    
+    Parameters
+    ----------
+    var : int or str
+        integers denote column numbers
+        strings should be Stata variable names or 
+          unambiguous abbreviations
+    values : sequence of str
+    obsnums : int, slice, range, iterable of int, or None
+        optional
+        default value is None
+        if int, the first observation to replace, with 
+          len(values) observations replaced in all;
+        if not specified, or is None, replacement starts 
+          at the first observation
+    changed_only : bool
+        optional
+        default value is False
+        if True, each value is compared with the one already 
+          stored, and is written only if they differ
         
-def st_view(rownums=None, varnums=None, selectvar=""):
+    Returns
+    -------
+    None, or if `changed_only` is True, int number of values written
+    
+    """
+    if not isinstance(values, (list, tuple)):
+        values = list(values)
+    
+    obsnums, var = _parse_bulk_obs_var(obsnums, var, len(values))
+    if changed_only:
+        return _st_sstore_list(var, obsnums, values, 1)
+    _st_sstore_list(var, obsnums, values)
+
+        
+def st_touse():
+    """Return marker of observations satisfying the `if` condition 
+    and `in` range specified when Python was invoked.
+    
+    The condition is evaluated for all observations in a single
+    plugin call, rather than with one call of `st_ifobs` for each.
+    
+    Returns
+    -------
+    bytearray, with one entry per observation:
+    1 if observation satisfies `if` and `in`, 0 otherwise
+    
+    """
+    mask = bytearray(st_nobs())
+    _st_touse(mask)
+    return mask
+
+
+def st_touse_obs():
+    """Return numbers of observations satisfying the `if` condition 
+    and `in` range specified when Python was invoked.
+    
+    Returns
+    -------
+    array.array of int (typecode 'l'), in increasing order
+    
+    """
+    mask = st_touse()
+    return array('l', compress(range(len(mask)), mask))
+
+
+def st_view(rownums=None, varnums=None, selectvar="", touse=False):
     """Return a view onto current Stata data
     
     Parameters
     ----------
-    rownums : int, iterable of int, None, or MissingValue instance
+    rownums : int, iterable of int, StataMask, None, 
+              or MissingValue instance
         optional
         default value is None
         if not specified, or is None or MissingValue instance,
             a view on all observations will be returned
+        if a StataMask, it must have one value per observation,
+            and the observations where it is true are used
     varnums : int, iterable of int, None, or MissingValue instance
         optional
         default value is None
@@ -409,6 +871,12 @@ def st_view(rownums=None, varnums=None, selectvar=""):
         if specified as None or a MissingValue instance, all
             rows in `rownums` will be included where _none_ 
             of the `varnums` variables have missing values
+    touse : bool
+        optional
+        default value is False
+        if True, only rows in `rownums` that satisfy the `if` 
+            condition and `in` range specified when Python was
+            invoked will be included
     
     Returns
     -------
@@ -418,19 +886,17 @@ def st_view(rownums=None, varnums=None, selectvar=""):
     nobs = st_nobs()
     nvar = st_nvar()
     
-    if not st_ismissing(rownums):
+    if isinstance(rownums, StataMask):
+        if len(rownums) != nobs:
+            msg = "mask has length {}, need {}"
+            raise ValueError(msg.format(len(rownums), nobs))
+        rownums = rownums.indices()
+    elif not st_ismissing(rownums):
         if isinstance(rownums, int):
             rownums = (rownums,)
         elif not isinstance(rownums, collections.Iterable):
             raise TypeError("rownums should be int or iterable of int")
-        else:
-            if not hasattr(rownums, "__len__"):  # a test for persistence
-                rownums = tuple(rownums)
-            if not all(isinstance(r, int) for r in rownums):
-                raise TypeError("rownums must be integers")
-            if not all(-nobs <= r < nobs for r in rownums):
-                raise IndexError("rownums out of range")
-            rownums = tuple(r if r >= 0 else nobs + r for r in rownums)
+        rownums = _view_index(rownums, nobs, "rownums")
     else:
         rownums = None
     
@@ -439,30 +905,31 @@ def st_view(rownums=None, varnums=None, selectvar=""):
             varnums = (varnums,)
         elif not isinstance(varnums, collections.Iterable):
             raise TypeError("varnums should be int or iterable of int")
-        else:
-            if not hasattr(varnums, "__len__"):
-                varnums = tuple(rownums)
-            if not all(isinstance(c, int) for c in varnums):
-                raise TypeError("varnums must be integers")
-            if not all(-nvar <= c < nvar for c in varnums):
-                raise IndexError("varnums out of range")
-            varnums = tuple(c if c >= 0 else nvar + c for c in varnums)
+        varnums = _view_index(varnums, nvar, "varnums")
     else:
         varnums = None
+    
+    if touse:
+        mask = st_touse()
+        if rownums is None:
+            rownums = array('l', compress(range(nobs), mask))
+        else:
+            rownums = array('l', 
+                compress(rownums, map(mask.__getitem__, rownums)))
             
     if not selectvar == "":        
         if rownums is None:
-            rownums = tuple(range(nobs))
+            rownums = range(nobs)
         
         if st_ismissing(selectvar):
             numeric = tuple(
                 c for c in (range(nvar) if varnums is None else varnums)
                 if st_isnumvar(c)
             )
-            rownums = tuple(
+            rownums = array('l', (
                 r for r in rownums
                 if not any(st_ismissing(_st_data(r,c)) for c in numeric)
-            )
+            ))
         else:
             if isinstance(selectvar, str):
                 selectvar = st_varindex(selectvar, True)
@@ -470,50 +937,198 @@ def st_view(rownums=None, varnums=None, selectvar=""):
                 raise TypeError("selectvar misspecified; invalid type")
             elif not -nvar <= selectvar < nvar:
                 raise IndexError("selectvar index out of range")
-            rownums = tuple(
+            rownums = array('l', (
                 r for r in rownums if _st_data(r, selectvar) != 0
-            )
+            ))
             
     return StataView(rownums, varnums)
 
+
+def _view_index(index, size, name):
+    """helper for st_view;
+    checks row or column numbers, with negative numbers counting 
+    from `size`, and returns them as a range, if given a range of 
+    non-negative numbers, or as an array of int
+    
+    """
+    if isinstance(index, range):
+        if len(index) == 0:
+            return index
+        low, high = sorted((index[0], index[-1]))
+        if low < -size or high >= size:
+            raise IndexError(name + " out of range")
+        if low >= 0:
+            return index
+    else:
+        if not hasattr(index, "__len__"):  # a test for persistence
+            index = tuple(index)
+        if not all(isinstance(i, int) for i in index):
+            raise TypeError(name + " must be integers")
+        if not all(-size <= i < size for i in index):
+            raise IndexError(name + " out of range")
+    return array('l', (i if i >= 0 else size + i for i in index))
+
+
+def _compact_index(index):
+    """Row or column numbers as a range or an array of int"""
+    if isinstance(index, range) or (
+            isinstance(index, array) and index.typecode == 'l'):
+        return index
+    return array('l', index)
+
+
+def _count_distinct(index):
+    """Number of distinct values in a range or an array of int"""
+    if isinstance(index, range) or len(index) < 2:
+        return len(index)
+    # no set is needed if values are increasing
+    if all(map(operator.lt, index, islice(index, 1, None))):
+        return len(index)
+    return len(set(index))
+
+
+def _cell_index(context, rownum, colnum):
+    """Check observation and variable number of a single value against 
+    data set context, and convert negative numbers to positive
+    
+    """
+    if not isinstance(rownum, int) or not isinstance(colnum, int):
+        raise TypeError("observation and variable numbers should be int")
+    if not -context.nobs <= rownum < context.nobs:
+        raise IndexError("Stata observation number out of range")
+    if not -context.nvar <= colnum < context.nvar:
+        raise IndexError("Stata variable number out of range")
+    return rownum % context.nobs, colnum % context.nvar
+
+
+class _WriteBuffer():
+    """Single-value writes to the Stata data set held back until
+    flushed, then stored with one plugin call per variable
+    
+    """
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.pending = {}
+        
+    def get(self, rownum, colnum):
+        """Get single data value, pending or from Stata"""
+        context = _data_context()
+        rownum, colnum = _cell_index(context, rownum, colnum)
+        column = self.pending.get(colnum)
+        if column is not None and rownum in column:
+            return column[rownum]
+        if context.isstr[colnum]:
+            return _st_sdata(rownum, colnum)
+        return _st_data(rownum, colnum)
+        
+    def set(self, rownum, colnum, value):
+        """Hold single data value to be written, flushing all pending 
+        values if there are `size` of them
+        
+        """
+        context = _data_context()
+        rownum, colnum = _cell_index(context, rownum, colnum)
+        if context.isstr[colnum]:
+            if not isinstance(value, str):
+                raise TypeError("set value should be str")
+        elif value is None:
+            value = MISSING
+        elif isinstance(value, (int, float)):
+            value = float(value)
+        elif not isinstance(value, MissingValue):
+            raise TypeError(
+                "set value should be float, None, or a missing value"
+            )
+        column = self.pending.setdefault(colnum, {})
+        if rownum not in column:
+            self.count += 1
+        column[rownum] = value
+        if self.count >= self.size:
+            self.flush()
+            
+    def flush(self):
+        """Write all pending values, in order of observation"""
+        pending = self.pending
+        self.pending, self.count = {}, 0
+        isstr = _data_context().isstr
+        for colnum, column in pending.items():
+            obsnums = sorted(column)
+            values = [column[i] for i in obsnums]
+            if obsnums[-1] - obsnums[0] + 1 == len(obsnums):
+                obsnums = range(obsnums[0], obsnums[-1] + 1)
+            else:
+                obsnums = array('l', obsnums)
+            if isstr[colnum]:
+                _st_sstore_list(colnum, obsnums, values)
+            else:
+                _st_store_array(colnum, obsnums, *_values_to_array(values))
+                
+
+_DataContext = collections.namedtuple(
+    "_DataContext", ["ncalls", "nobs", "nvar", "in1", "in2", "isstr"]
+)
+
+_context = None
+
+def _data_context():
+    """Get a snapshot of the data set taken by the plugin at the start
+    of the current call: the call count, numbers of observations and 
+    variables, in1 and in2 (1-based and inclusive), and a bytes object
+    with 1 for each string variable and 0 for each numeric variable
+    
+    """
+    global _context
+    if _context is None or _context.ncalls != _st_ncalls():
+        _context = _DataContext(*_st_context())
+    return _context
+
             
 class StataView():
     """Python class of views onto the Stata dataset in memory"""
     def __init__(self, rownums=None, colnums=None):
+        # row and column numbers are kept as a range or an array of int;
+        # numbers of distinct observations and variables are counted 
+        # when first needed
         if rownums is None :
-            self._nobs = self._nrows = st_nobs()
-            rownums = tuple(range(self._nobs))
-        else:
-            # using set because there could be duplicates
-            self._nobs = len(set(rownums))
-            self._nrows = len(rownums)
-        
+            rownums = range(st_nobs())
         if colnums is None:
-            self._nvar = self._ncols = st_nvar()
-            colnums = tuple(range(self._nvar))
-        else:
-            self._nvar = len(set(colnums))
-            self._ncols = len(colnums)
+            colnums = range(st_nvar())
             
-        self._rownums = rownums
-        self._colnums = colnums
-        
-        self._formats = [
-            "%11s" if st_isstrvar(c) else "%9.0g" for c in colnums
-        ]
-        self._getters = [
-            _st_sdata if st_isstrvar(c) else _st_data for c in colnums
-        ]
-        self._setters = [
-            _st_sstore if st_isstrvar(c) else _st_store for c in colnums
-        ]
+        self._rownums = _compact_index(rownums)
+        self._colnums = _compact_index(colnums)
+        self._nrows = len(rownums)
+        self._ncols = len(colnums)
+        self._distinct = {}
+        self._buffer = None
+        
+        isstr = _data_context().isstr
+        isstr = [isstr[c] for c in colnums]
+        self._formats = ["%11s" if t else "%9.0g" for t in isstr]
+        self._getters = [_st_sdata if t else _st_data for t in isstr]
+        self._setters = [_st_sstore if t else _st_store for t in isstr]
                          
+    @property
+    def _nobs(self):
+        if "obs" not in self._distinct:
+            self._distinct["obs"] = _count_distinct(self._rownums)
+        return self._distinct["obs"]
+        
+    @property
+    def _nvar(self):
+        if "var" not in self._distinct:
+            self._distinct["var"] = _count_distinct(self._colnums)
+        return self._distinct["var"]
+        
     def __iter__(self):
         """return iterable of obs"""
         getters, cols, rows = self._getters, self._colnums, self._rownums
+        if self._buffer is not None:
+            getters = [self._buffer.get] * len(getters)
         return (tuple(g(r, c) for g,c in zip(getters, cols)) for r in rows)
     
     def __str__(self):
+        self._flush()
         getters, colnums, rownums = self._getters, self._colnums, self._rownums
         nrows, nobs = self._nrows, self._nobs
         ncols, nvar = self._ncols, self._nvar
@@ -579,8 +1194,168 @@ class StataView():
         List of lists, one sub-list per observation
         
         """
+        self._flush()
         getters, colnums, rownums = self._getters, self._colnums, self._rownums
-        return [[g(r, c) for g,c in zip(getters, colnums)] for r in rownums]
+        if not rownums or not colnums:
+            return [[] for r in rownums]
+        
+        # numeric columns come from one block in column-major order,
+        # string columns from one plugin call each
+        if not isinstance(rownums, range):
+            rownums = array('l', rownums)
+        numeric = [c for g, c in zip(getters, colnums) if g is _st_data]
+        if numeric:
+            numeric = iter(_block_to_lists(
+                *_data_block(rownums, numeric, True), size=len(rownums)
+            ))
+        columns = [
+            next(numeric) if g is _st_data else _st_sdata_list(c, rownums)
+            for g, c in zip(getters, colnums)
+        ]
+        return [list(row) for row in zip(*columns)]
+        
+    def iter_chunks(self, size=65536):
+        """Iterate over Stata data values in blocks of rows, 
+        column by column
+        
+        Each block is copied with one plugin call for all numeric 
+        columns and one for each string column, so that only one block
+        of values needs to be in memory at a time.
+        
+        Parameters
+        ----------
+        size : int
+            optional
+            default value is 65536
+            number of rows in each block; the last block may be shorter
+            
+        Returns
+        -------
+        Generator of lists, one per block, with one entry per column:
+        for numeric columns, a StataVarVals backed by an array of 
+        float and a bytearray of missing-value codes (as returned by
+        `st_data_array`); for string columns, a list of str
+        
+        """
+        if not isinstance(size, int):
+            raise TypeError("size should be int")
+        if size < 1:
+            raise ValueError("size should be positive")
+        return self._chunks(size)
+        
+    def _chunks(self, size):
+        self._flush()
+        getters, colnums, nrows = self._getters, self._colnums, self._nrows
+        numeric = [c for g, c in zip(getters, colnums) if g is _st_data]
+        for start in range(0, nrows, size):
+            rownums = self._row_range(start, min(start + size, nrows))
+            if not isinstance(rownums, range):
+                rownums = array('l', rownums)
+            n = len(rownums)
+            if numeric:
+                # one block in column-major order, split into columns
+                values, missing, nmiss = _data_block(rownums, numeric, True)
+                numeric_cols = iter([
+                    _wrap(values[i:i + n], missing[i:i + n] if nmiss else None)
+                    for i in range(0, len(values), n)
+                ])
+            yield [
+                next(numeric_cols) if g is _st_data 
+                else _st_sdata_list(c, rownums)
+                for g, c in zip(getters, colnums)
+            ]
+            
+    def _row_range(self, start, stop):
+        """Observation numbers of rows start to stop - 1 of view"""
+        return self._rownums[start:stop]
+        
+    def store_chunks(self, chunks):
+        """Replace Stata data values from blocks of rows, column by 
+        column, in the form given by `iter_chunks`, e.g., from a 
+        generator, without building all of the values first
+        
+        Each block is checked before it is written, so a ValueError
+        for a wrong number of rows or columns leaves only whole blocks 
+        written, and its message says how many rows were written.
+        
+        Parameters
+        ----------
+        chunks : iterable of blocks
+            each block a sequence with one entry per column: a sequence 
+              or StataVarVals of values for the block's rows; the 
+              blocks together should have one row per row of view 
+            
+        Returns
+        -------
+        None
+        
+        """
+        self._flush()
+        colnums, nrows, ncols = self._colnums, self._nrows, self._ncols
+        written = 0
+        for chunk in chunks:
+            if len(chunk) != ncols:
+                msg = ("block has {} columns, expected {}; "
+                       "the first {} rows were written")
+                raise ValueError(msg.format(len(chunk), ncols, written))
+            n = len(chunk[0]) if ncols else 0
+            if any(len(column) != n for column in chunk):
+                msg = ("columns of block have different lengths; "
+                       "the first {} rows were written")
+                raise ValueError(msg.format(written))
+            if written + n > nrows:
+                msg = "value has more than {} rows; the first {} were written"
+                raise ValueError(msg.format(nrows, written))
+            _store_columns(self._row_range(written, written + n), 
+                           colnums, chunk, written)
+            written += n
+        if written != nrows:
+            msg = "value has {} rows, expected {}; all {} were written"
+            raise ValueError(msg.format(written, nrows, written))
+        
+    @contextmanager
+    def buffered(self, size=65536):
+        """Hold back writes of single values to the Stata data set 
+        within a `with` block, and write them at the end of the block
+        
+        Pending values are kept by variable, a value written twice is
+        only stored once, and the values of each variable are stored 
+        with one plugin call. Reads of single values through this 
+        object (e.g., with `get` or iteration) give pending values; 
+        pending values are written before reading many values at once
+        (e.g., with `to_list`). Reads through other objects, or from 
+        Stata, see pending values only after they are written.
+        
+        Parameters
+        ----------
+        size : int
+            optional
+            default value is 65536
+            number of pending values at which all pending 
+              values are written
+            
+        Returns
+        -------
+        Context manager giving this object
+        
+        """
+        if not isinstance(size, int):
+            raise TypeError("size should be int")
+        if size < 1:
+            raise ValueError("size should be positive")
+        if self._buffer is not None:
+            raise ValueError("writes are already buffered")
+        self._buffer = _WriteBuffer(size)
+        try:
+            yield self
+        finally:
+            buffer, self._buffer = self._buffer, None
+            buffer.flush()
+            
+    def _flush(self):
+        """Write values held back by `buffered`, if any"""
+        if self._buffer is not None:
+            self._buffer.flush()
         
     def get(self, rownum, colnum):
         """Get single data value from view
@@ -600,6 +1375,10 @@ class StataView():
         """
         # use self._rownums[row] rather than row because self's rows
         # are not necessarily the same as Stata's observation numbers
+        if self._buffer is not None:
+            return self._buffer.get(
+                self._rownums[rownum], self._colnums[colnum]
+            )
         return self._getters[colnum](
             self._rownums[rownum], self._colnums[colnum]
         )
@@ -641,11 +1420,11 @@ class StataView():
         
     @property
     def rows(self):
-        return self._rownums
+        return tuple(self._rownums)
         
     @property
     def cols(self):
-        return self._colnums
+        return tuple(self._colnums)
         
     @property
     def nrows(self):
@@ -667,6 +1446,8 @@ class StataView():
         # It would be a little less permissive but 
         # easier and faster to test that rownums and 
         # colnums are the same. Which is better?
+        self._flush()
+        other._flush()
         rows1, cols1 = self._rownums, self._colnums
         rows2, cols2 = other._rownums, other._colnums
         getters, ncols = self._getters, self._ncols
@@ -687,18 +1468,26 @@ class StataView():
         """
         if next_index is None: return prior_index
         if isinstance(next_index, slice):
+            # a slice of a range is a range, without copying
             start, stop, step = next_index.indices(len(prior_index))
             final_index = prior_index[start:stop:step]
+        elif isinstance(next_index, StataMask):
+            if len(next_index) != len(prior_index):
+                msg = "mask has length {}, need {}"
+                raise ValueError(
+                    msg.format(len(next_index), len(prior_index)))
+            final_index = array('l', 
+                map(prior_index.__getitem__, next_index.indices()))
         elif isinstance(next_index, collections.Iterable):
             if not hasattr(next_index, "__len__"):
                 next_index = tuple(next_index)
             if not all(isinstance(i, int) for i in next_index):
                 raise TypeError("individual indices must be int")
-            final_index = tuple(prior_index[i] for i in next_index)
+            final_index = array('l', map(prior_index.__getitem__, next_index))
         else:
             if not isinstance(next_index, int):
                 raise TypeError("index must be slice, iterable of int, or int")
-            final_index = (prior_index[next_index],)
+            final_index = array('l', (prior_index[next_index],))
         return final_index
     
     def __getitem__(self, index):
@@ -724,6 +1513,12 @@ class StataView():
         if n_sel_rows == 0 or n_sel_cols == 0:
             return
         
+        # an iterator of rows is checked and written block by block
+        if isinstance(value, collections.Iterator) and n_sel_rows > 1:
+            self._flush()
+            _store_rows(sel_rows, sel_cols, value)
+            return
+        
         def tuple_maker(x):
             if isinstance(x, str) or not isinstance(x, collections.Iterable):
                 return (x,)
@@ -754,6 +1549,13 @@ class StataView():
         if not all(len(v) == n_sel_cols for v in value):
             raise ValueError("inner dimensions do not match number of columns")    
         
+        if self._buffer is not None:
+            setter = self._buffer.set
+            for row, i in zip(sel_rows, range(n_sel_rows)):
+                for col, j in zip(sel_cols, range(n_sel_cols)):
+                    setter(row, col, value[i][j])
+            return
+        
         setters = self._setters
         for row, i in zip(sel_rows, range(n_sel_rows)):
             for col, j in zip(sel_cols, range(n_sel_cols)):
@@ -774,7 +1576,7 @@ def st_viewvars(view_obj):
     """
     if not isinstance(view_obj, StataView):
         raise TypeError("argument should be a View")
-    return view_obj._colnums
+    return tuple(view_obj._colnums)
 
 
 def st_viewobs(view_obj):
@@ -791,7 +1593,7 @@ def st_viewobs(view_obj):
     """
     if not isinstance(view_obj, StataView):
         raise TypeError("argument should be a View")
-    return view_obj._rownums
+    return tuple(view_obj._rownums)
 
 
 def st_mirror():
@@ -807,48 +1609,152 @@ def st_mirror():
     
 class StataMirror(StataView):
     def __init__(self):
-        pass
+        self._meta = None
+        self._buffer = None
+        self._changed = None
+    
+    def _metadata(self):
+        """Dimensions of the data set, variable types, and variable 
+        indices already looked up, kept until the next plugin call,
+        before which they cannot change
+        
+        """
+        meta = self._meta
+        context = _data_context()
+        if meta is None or meta["ncalls"] != context.ncalls:
+            isstr = tuple(context.isstr)
+            meta = self._meta = {
+                "ncalls": context.ncalls,
+                "nobs": context.nobs,
+                "nvar": context.nvar,
+                "isstr": isstr,
+                "getters": [_st_sdata if t else _st_data for t in isstr],
+                "setters": [_st_sstore if t else _st_store for t in isstr],
+                "index": {}
+            }
+        return meta
     
     @property
     def _nobs(self):
-        return st_nobs()
+        return self._metadata()["nobs"]
     
     @property
     def _nvar(self):
-        return st_nvar()
+        return self._metadata()["nvar"]
     
     @property
     def _rownums(self):
-        return tuple(i for i in range(st_nobs()))
+        return range(self._metadata()["nobs"])
         
     @property
     def _colnums(self):
-        return tuple(i for i in range(st_nvar()))
+        return range(self._metadata()["nvar"])
         
     @property
     def _nrows(self):
-        return st_nobs()
+        return self._metadata()["nobs"]
         
     @property
     def _ncols(self):
-        return st_nvar()
+        return self._metadata()["nvar"]
         
     @property
     def _getters(self):
-        return [
-            _st_sdata if st_isstrvar(i) else _st_data 
-            for i in range(st_nvar())
-        ]
+        return self._metadata()["getters"]
         
     @property
     def _setters(self):
-        return [
-            _st_sstore if st_isstrvar(i) else _st_store 
-            for i in range(st_nvar())
-        ]
+        return self._metadata()["setters"]
         
     def __len__(self):
-        return st_nobs()
+        return self._metadata()["nobs"]
+        
+    def _getter(self, colnum):
+        """Function of (rownum, colnum) giving values of variable 
+        `colnum`, as with `get`, but without looking up the variable's 
+        type each time
+        
+        """
+        if self._buffer is not None:
+            return self._buffer.get
+        return self._metadata()["getters"][colnum]
+        
+    def _set(self, rownum, colnum, value):
+        """Set single data value for StataVariable, without the checks
+        of `__setitem__` if writes are buffered
+        
+        """
+        buffer = self._buffer
+        if buffer is None or (isinstance(value, collections.Iterable) and
+                              not isinstance(value, str)):
+            self[rownum, colnum] = value
+        else:
+            buffer.set(rownum, colnum, value)
+        
+    def _isstr(self, colnum):
+        """st_isstrvar, with types looked up once per plugin call"""
+        if isinstance(colnum, int):
+            isstr = self._metadata()["isstr"]
+            if -len(isstr) <= colnum < len(isstr):
+                return isstr[colnum]
+        return st_isstrvar(colnum)
+        
+    def _row_range(self, start, stop):
+        return range(start, stop)
+        
+    def _column(self, colnum, obsnums=None):
+        """Values of a variable for StataVariable: an array of float 
+        and a bytearray of missing-value codes for a numeric variable,
+        or a list of str and None for a string variable
+        
+        """
+        self._flush()
+        if self._isstr(colnum):
+            return st_sdata_list(colnum, obsnums), None
+        return st_data_array(colnum, obsnums)
+        
+    def _store_column(self, colnum, values, missing, obsnums=None):
+        """Replace values of a variable, as given by `_column`"""
+        self._flush()
+        changed = self._changed
+        only = changed is not None
+        if self._isstr(colnum):
+            written = st_sstore_list(colnum, values, obsnums, only)
+        elif isinstance(values, array):
+            written = st_store_array(colnum, values, obsnums, missing, only)
+        else:
+            written = st_store_array(colnum, values, obsnums, 
+                                     changed_only=only)
+        if only:
+            changed.compared += len(values)
+            changed.written += written
+            
+    @contextmanager
+    def changed_only(self):
+        """Within a `with` block, write only values that differ from 
+        those already stored when replacing whole variables, as in 
+        `m.varname_ = values`, `m.varname_ += 1`, or 
+        `m.varname_.values = values`
+        
+        Values are compared in the same loop inside the plugin that 
+        writes them. Numeric values are compared as stored, so for 
+        variables stored as float, int, etc., a new value that would 
+        be rounded to the existing value when stored is still written.
+        
+        Returns
+        -------
+        Context manager giving an object with attributes `compared` 
+        and `written`, the numbers of values compared and written 
+        within the block
+        
+        """
+        if self._changed is not None:
+            raise ValueError("already writing only changed values")
+        changed = self._changed = _WriteCount()
+        try:
+            yield changed
+        finally:
+            self._changed = None
 
     def __getattr__(self, name):
         """Provides shortcut to Stata variables by appending "_".
@@ -859,7 +1765,7 @@ class StataMirror(StataView):
             msg = "'{}' object has no attribute '{}'"
             raise AttributeError(msg.format(self.__class__.__name__, name))
             
-        varname = st_varname(st_varindex(name[:-1], True))
+        varname = st_varname(self.index(name[:-1]))
         
         return StataVariable(self, varname)
         
@@ -871,15 +1777,30 @@ class StataMirror(StataView):
         if not name.endswith("_"):
             self.__dict__[name] = value
         else:
+            nobs = len(self)
             if not isinstance(value, collections.Iterable):
-                if st_nobs() > 1:
+                if nobs > 1:
                     raise TypeError("iterable required")
                 value = (value,)
-            elif len(value) != st_nobs():
+            elif len(value) != nobs:
                 msg = "need iterable of length {}, got length {}"
-                raise ValueError(msg.format(st_nobs(), len(value)))
-            col = st_varindex(name[:-1], True)
-            setter = _st_sstore if st_isstrvar(col) else _st_store
+                raise ValueError(msg.format(nobs, len(value)))
+            col = self.index(name[:-1])
+            self._flush()
+            if (isinstance(value, StataVariable) and value.source is self
+                    and self.index(value.name) == col):
+                # e.g., after `m.varname_ += 1`, values already stored
+                return
+            if isinstance(value, StataVarVals):
+                StataVariable(self, st_varname(col))._store(value)
+                return
+            if self._changed is not None:
+                if self._isstr(col):
+                    self._store_column(col, value, None)
+                else:
+                    self._store_column(col, *_values_to_array(list(value)))
+                return
+            setter = self._setters[col]
             for i,v in enumerate(value):
                 setter(i, col, v)
         
@@ -909,7 +1830,10 @@ class StataMirror(StataView):
         int
         
         """
-        return st_varindex(varname, True)
+        index = self._metadata()["index"]
+        if varname not in index:
+            index[varname] = st_varindex(varname, True)
+        return index[varname]
         
     def get(self, rownum, colnum):
         """Get single data value from view
@@ -927,7 +1851,9 @@ class StataMirror(StataView):
         on data type of Stata variable
         
         """
-        if st_isstrvar(colnum): 
+        if self._buffer is not None:
+            return self._buffer.get(rownum, colnum)
+        if self._isstr(colnum): 
             return _st_sdata(rownum, colnum)
         else:
             return _st_data(rownum, colnum)
@@ -1181,11 +2107,13 @@ class StataMatrix():
                 return (x,)
             return tuple(x)
             
-        if isinstance(value, StataMatrix) or isinstance(value, StataView):
+        if isinstance(value, StataView):
+            if not all(st_isnumvar(c) for c in value._colnums):
+                raise TypeError("matrix values must be numeric; str not allowed")
+            value = value.to_list()
+        elif isinstance(value, StataMatrix):
             value = value.to_list()
             # No need to go through tuple_maker here, so maybe rewrite.
-            # If rewriting around tuple_maker, StataView variables should be
-            # checked to be sure they are numeric.
         
         # force input into 2d structure
         if isinstance(value, str):
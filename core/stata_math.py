@@ -1,10 +1,25 @@
+import functools
 import math
+import operator
+from array import array
+from itertools import compress, repeat
 
 from stata_missing import MissingValue, MISSING as mv, get_missing
-from stata_variable import StataVarVals
+from stata_variable import (
+    StataVarVals, _is_lazy, _lazy, _mask_of, _to_arrays, _wrap
+)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from stata_plugin import _st_math
+except ImportError:
+    _st_math = None
 
-__version__ = "0.1.0"
+
+__version__ = "0.2.0"
 
 
 def _is_missing(x):
@@ -18,6 +33,617 @@ def _is_missing(x):
         return True
     return False
 
+
+# Vectorized functions
+# --------------------
+# The functions below take StataVarVals element-wise over arrays of 
+# float. Values that are missing or outside a function's domain are 
+# flagged, replaced by a harmless value in the domain, and set to . 
+# (or their missing value) after the calculation, so the calculation 
+# itself needs no checks. The operations on arrays are done by numpy 
+# if it can be imported, otherwise by loops in C (map, zip, compress) 
+# over array('d') and bytes of flags. Either way, functions from the 
+# math module are applied to every value exactly as in the scalar 
+# functions, and numpy is used only for operations that are exactly 
+# rounded (arithmetic, sqrt, floor, etc.), so that results match the 
+# scalar functions exactly.
+
+_LIMIT = 8.988465674311579e+307
+
+# Stata's non-missing range, as in stata_variable
+_MIN_VALUE = -1.7976931348623157e+308
+_MAX_VALUE = 8.988465674311579e+307
+
+
+# tables for bytes.translate, for flags from missing-value codes, and
+# for negating flags
+_CODE_FLAGS = bytes([0]) + bytes([1]) * 255
+_NOT_FLAGS = bytes([1, 0]) + bytes(254)
+
+
+def _scalar_seq(a):
+    return a if isinstance(a, array) else repeat(a)
+    
+
+class _ArrayOps():
+    """Operations on array('d') of values and bytes of flags"""
+    
+    def array(self, values):
+        return values
+        
+    def full(self, n, value):
+        return array('d', [value]) * n
+        
+    def all_flags(self, n, flag):
+        return bytes([flag]) * n
+        
+    def missing_flags(self, v, missing):
+        if missing is None:
+            flags = bytes(len(v))
+        else:
+            flags = bytes(missing).translate(_CODE_FLAGS)
+        if len(v) and min(v) < -_LIMIT:
+            flags = self.or_(flags, self.flags(operator.lt, v, -_LIMIT))
+        return flags
+        
+    def invalid(self, v):
+        # quick check first; the sum is nan if any value is nan
+        total = sum(v)
+        if total == total and (len(v) == 0 or 
+                (min(v) >= -_LIMIT and max(v) <= _LIMIT)):
+            return bytes(len(v))
+        flags = map(operator.or_, 
+            map(operator.lt, v, repeat(-_LIMIT)), 
+            map(operator.gt, v, repeat(_LIMIT)))
+        if total != total:
+            flags = map(operator.or_, flags, map(operator.ne, v, v))
+        return bytes(flags)
+        
+    def flags(self, op, a, b):
+        return bytes(map(op, _scalar_seq(a), _scalar_seq(b)))
+        
+    def outside(self, v, lo, hi, lo_open, hi_open):
+        lo_op = operator.le if lo_open else operator.lt
+        hi_op = operator.ge if hi_open else operator.gt
+        if lo is None:
+            return self.flags(hi_op, v, hi)
+        if hi is None:
+            return self.flags(lo_op, v, lo)
+        return bytes(map(operator.or_, 
+            map(lo_op, v, repeat(lo)), map(hi_op, v, repeat(hi))))
+        
+    # and, or, and not of flags are done on all flags at once, through
+    # conversion to int and bytes.translate
+    
+    def and_(self, f, g):
+        value = int.from_bytes(f, "little") & int.from_bytes(g, "little")
+        return value.to_bytes(len(f), "little")
+        
+    def or_(self, f, g):
+        value = int.from_bytes(f, "little") | int.from_bytes(g, "little")
+        return value.to_bytes(len(f), "little")
+        
+    def not_(self, f):
+        return f.translate(_NOT_FLAGS)
+        
+    def any(self, f):
+        return 1 in f
+        
+    def positions(self, f):
+        return compress(range(len(f)), f)
+        
+    def select(self, values, f):
+        return list(compress(values, f))
+        
+    def copy(self, values):
+        return array('d', values)
+        
+    def floats(self, f):
+        return array('d', map(float, f))
+        
+    def to_bytes(self, f):
+        return bytes(f)
+        
+    def patch(self, values, f, fill):
+        return self.where(f, fill, values) if 1 in f else values
+        
+    def where(self, f, a, b):
+        result = array('d', b) if isinstance(b, array) else self.full(len(f), b)
+        if isinstance(a, array):
+            for i in compress(range(len(f)), f):
+                result[i] = a[i]
+        else:
+            for i in compress(range(len(f)), f):
+                result[i] = a
+        return result
+        
+    def apply(self, func, *args):
+        return array('d', map(func, *map(_scalar_seq, args)))
+        
+    binop = apply
+        
+    def ufunc(self, name, func, a):
+        return array('d', map(func, a))
+        
+    def maximum(self, v):
+        return max(v)
+        
+    def lookup(self, table, v):
+        return array('d', map(table.__getitem__, map(int, v)))
+        
+    def finish(self, result, invalid):
+        values, missing = _to_arrays(result)
+        if 1 in invalid:
+            if missing is None:
+                missing = bytearray(len(values))
+            dot = mv.value
+            for i in compress(range(len(invalid)), invalid):
+                values[i] = dot
+                missing[i] = 1
+        return values, missing
+        
+        
+class _NumpyOps():
+    """Operations on numpy arrays of values and of flags"""
+    
+    def array(self, values):
+        return numpy.frombuffer(values, dtype=float)
+        
+    def full(self, n, value):
+        return numpy.full(n, float(value))
+        
+    def all_flags(self, n, flag):
+        return numpy.full(n, flag, dtype=bool)
+        
+    def missing_flags(self, v, missing):
+        if missing is None:
+            flags = numpy.zeros(len(v), dtype=bool)
+        else:
+            flags = numpy.frombuffer(missing, dtype=numpy.uint8) != 0
+        return flags | (v < -_LIMIT)
+        
+    def invalid(self, v):
+        # written so that nan is flagged
+        return ~((v >= -_LIMIT) & (v <= _LIMIT))
+        
+    def flags(self, op, a, b):
+        return numpy.asarray(op(a, b), dtype=bool)
+        
+    def outside(self, v, lo, hi, lo_open, hi_open):
+        flags = numpy.zeros(len(v), dtype=bool)
+        if lo is not None:
+            flags |= (v <= lo) if lo_open else (v < lo)
+        if hi is not None:
+            flags |= (v >= hi) if hi_open else (v > hi)
+        return flags
+        
+    def and_(self, f, g):
+        return f & g
+        
+    def or_(self, f, g):
+        return f | g
+        
+    def not_(self, f):
+        return ~f
+        
+    def any(self, f):
+        return bool(f.any())
+        
+    def positions(self, f):
+        return numpy.flatnonzero(f).tolist()
+        
+    def select(self, values, f):
+        return values[f].tolist()
+        
+    def copy(self, values):
+        return values.copy()
+        
+    def floats(self, f):
+        return f.astype(float)
+        
+    def to_bytes(self, f):
+        return f.astype(numpy.uint8).tobytes()
+        
+    def patch(self, values, f, fill):
+        return numpy.where(f, fill, values) if f.any() else values
+        
+    def where(self, f, a, b):
+        return numpy.where(f, a, b).astype(float)
+        
+    def apply(self, func, *args):
+        n = max(len(a) for a in args if isinstance(a, numpy.ndarray))
+        seqs = [
+            a.tolist() if isinstance(a, numpy.ndarray) else repeat(a) 
+            for a in args
+        ]
+        return numpy.fromiter(map(func, *seqs), dtype=float, count=n)
+        
+    def binop(self, op, a, b):
+        if op in (operator.truediv, operator.mod) and numpy.any(b == 0):
+            raise ZeroDivisionError("float division by zero")
+        with numpy.errstate(all="ignore"):
+            return numpy.asarray(op(a, b), dtype=float)
+        
+    def maximum(self, v):
+        return float(v.max())
+        
+    def lookup(self, table, v):
+        return numpy.frombuffer(table, dtype=float)[v.astype(numpy.intp)]
+        
+    def ufunc(self, name, func, a):
+        result = getattr(numpy, name)(a)
+        if name in ("ceil", "floor", "trunc"):
+            if not numpy.isfinite(result).all():
+                # math's functions raise an error for inf and nan
+                return self.apply(func, a)
+            # math's functions give int, so zero is never negative
+            result += 0.0
+        return result
+        
+    def finish(self, result, invalid):
+        # results out of Stata's range are converted as in StataVarVals
+        out = ~((result >= _MIN_VALUE) & (result <= _MAX_VALUE)) & ~invalid
+        result = numpy.where(invalid, mv.value, result)
+        values = array('d', result.tobytes())
+        if not (invalid.any() or out.any()):
+            return values, None
+        missing = bytearray(invalid.astype(numpy.uint8).tobytes())
+        for i in numpy.flatnonzero(out).tolist():
+            value = _missing_of(values[i])
+            values[i] = value.value
+            missing[i] = value.index + 1
+        return values, missing
+        
+
+_ops = _ArrayOps() if numpy is None else _NumpyOps()
+
+
+def _values(x, n=None):
+    """Values of x, a StataVarVals or a scalar repeated n times, as an
+    array for _ops, and flags for values that the math functions treat
+    as missing
+    
+    """
+    ops = _ops
+    if isinstance(x, StataVarVals):
+        values, missing = x._arrays()
+        if not isinstance(values, array):
+            raise TypeError("int, float, or MissingValue instance required")
+        v = ops.array(values)
+        return v, ops.missing_flags(v, missing)
+    if x is None or isinstance(x, MissingValue):
+        return ops.full(n, (x or mv).value), ops.all_flags(n, True)
+    return ops.full(n, x), ops.all_flags(n, _is_missing(x))
+    
+def _missing_of(value):
+    """MissingValue for a float that the math functions treat as missing"""
+    return get_missing(value) if value == value else mv
+    
+def _as_missing(v, missing):
+    """Copy of values with those flagged as missing replaced by the 
+    value of their MissingValue
+    
+    """
+    v = _ops.copy(v)
+    for i in _ops.positions(missing):
+        v[i] = _missing_of(float(v[i])).value
+    return v
+    
+def _interval(lo=None, hi=None, lo_open=False, hi_open=False):
+    """Make a function giving flags for values outside of an interval"""
+    return lambda v: _ops.outside(v, lo, hi, lo_open, hi_open)
+    
+def _pole(v):
+    """Flags for zero and negative integers"""
+    ops = _ops
+    return ops.and_(
+        ops.flags(operator.le, v, 0),
+        ops.flags(operator.eq, v, ops.ufunc("floor", math.floor, v))
+    )
+    
+def _math(func):
+    """Make a kernel that applies a math function to each value"""
+    return lambda v: _ops.apply(func, v)
+    
+def _finish(result, invalid, keep=None, checked=False):
+    """Make StataVarVals from results, with . where flagged invalid. 
+    Where `keep`, a tuple of values and flags, flags missing values, 
+    give their own missing value instead of the default missing value.
+    If `checked` is True, results out of range also give . Otherwise, 
+    as with results of the scalar functions, results out of range are
+    converted as in StataVarVals.
+    
+    """
+    ops = _ops
+    if checked:
+        invalid = ops.or_(invalid, ops.invalid(result))
+    values, missing = ops.finish(result, invalid)
+    if keep is not None:
+        keep_values, keep_flags = keep
+        for i in ops.positions(keep_flags):
+            value = _missing_of(float(keep_values[i]))
+            if missing is None:
+                missing = bytearray(len(values))
+            values[i] = value.value
+            missing[i] = value.index + 1
+    return _wrap(values, missing)
+    
+def _vectorized(x, kernel, outside=None, safe=0.0, keep_missing=False, 
+                checked=False):
+    """Apply `kernel` to the values of StataVarVals x.
+    
+    Missing values, and values flagged by `outside` (a function giving
+    flags for values outside of the domain), are replaced with `safe` 
+    before applying `kernel`, and give . in the result, or their own 
+    missing value if `keep_missing` is True. If `checked` is True, 
+    results out of range also give .
+    
+    """
+    ops = _ops
+    v, missing = _values(x)
+    invalid = missing
+    w = ops.patch(v, invalid, safe)
+    if outside is not None:
+        flags = outside(w)
+        if ops.any(flags):
+            invalid = ops.or_(invalid, flags)
+            w = ops.patch(w, flags, safe)
+    keep = (v, missing) if keep_missing else None
+    return _finish(kernel(w), invalid, keep, checked)
+    
+def _vectorized2(x, y, kernel, outside=None, safe=(0.0, 0.0)):
+    """Apply `kernel` to the values of x and y, at least one of which 
+    is a StataVarVals, and the other possibly a scalar. Missing values
+    and values flagged by `outside` give . in the result (see 
+    _vectorized).
+    
+    """
+    ops = _ops
+    n = len(x) if isinstance(x, StataVarVals) else len(y)
+    (vx, x_missing), (vy, y_missing) = _values(x, n), _values(y, n)
+    invalid = ops.or_(x_missing, y_missing)
+    wx, wy = ops.patch(vx, invalid, safe[0]), ops.patch(vy, invalid, safe[1])
+    if outside is not None:
+        flags = outside(wx, wy)
+        if ops.any(flags):
+            invalid = ops.or_(invalid, flags)
+            wx, wy = ops.patch(wx, flags, safe[0]), ops.patch(wy, flags, safe[1])
+    return _finish(kernel(wx, wy), invalid)
+    
+def _digamma_kernel(x):
+    if numpy is None:
+        return _ops.apply(_digamma, x)
+    # the steps of _digamma, over arrays
+    with numpy.errstate(all="ignore"):
+        return _digamma_steps(x)
+        
+def _digamma_steps(x):
+    value = numpy.zeros(len(x))
+    neg = x <= 0
+    refl = neg & (x - numpy.floor(x) != 0.5)
+    tan = _ops.apply(math.tan, math.pi * x[refl])
+    value[refl] -= _ops.binop(operator.truediv, math.pi, tan)
+    x = numpy.where(neg, 1 - x, x)
+    small = x < 8
+    while small.any():
+        value[small] -= 1. / x[small]
+        x[small] += 1
+        small = x < 8
+    value += _ops.apply(math.log, x) - 0.5 / x
+    big = x >= 1e10
+    y = 1. / (x * x)
+    series = y * (1./12 - y * (1./120 - y * (1./252 - y * (1./240 - 
+        y * (5./660 - y * (691./32760 - y * 1./12))))))
+    return numpy.where(big, value, value - series)
+    
+def _trigamma_kernel(x):
+    if numpy is None:
+        return _ops.apply(_trigamma, x)
+    # the steps of _trigamma, over arrays
+    with numpy.errstate(all="ignore"):
+        return _trigamma_steps(x)
+        
+def _trigamma_steps(x):
+    value = numpy.zeros(len(x))
+    flip = x <= 0
+    pi = math.pi
+    sin = _ops.apply(math.sin, pi * x[flip])
+    value[flip] -= _ops.binop(operator.truediv, pi * pi, 
+                              _ops.apply(operator.pow, sin, 2))
+    x = numpy.where(flip, 1 - x, x)
+    small = x < 15
+    while small.any():
+        value[small] += _ops.binop(
+            operator.truediv, 1., x[small] * x[small])
+        x[small] += 1
+        small = x < 15
+    y = 1. / (x * x)
+    value += 0.5*y + (1. + y*(1./6 + y*(-1./30 + y*(1./42 + y*(-1./30 + y*(5./66)))))) / x
+    return numpy.where(flip, -value, value)
+    
+def _extreme(args, op):
+    """Element-wise max (op is operator.gt) or min (operator.lt) of 
+    args, at least one of which is a StataVarVals, ignoring missing 
+    values, as st_max and st_min do with scalars
+    
+    """
+    ops = _ops
+    vectors = [_values(a) for a in args if isinstance(a, StataVarVals)]
+    scalars = [
+        a for a in args if not isinstance(a, StataVarVals) and not _is_missing(a)
+    ]
+    if scalars:
+        extreme = max(scalars) if op is operator.gt else min(scalars)
+        vectors.append(_values(extreme, len(vectors[0][0])))
+    result, missing = vectors[0]
+    # a copy, since _finish sets missing values in place
+    result = ops.copy(result)
+    found = ops.not_(missing)
+    for v, missing in vectors[1:]:
+        valid = ops.not_(missing)
+        # as in Python's max and min, take later values only if greater
+        # (or less), or if there is not yet a non-missing value
+        take = ops.and_(valid, 
+            ops.or_(ops.not_(found), ops.flags(op, v, result)))
+        result = ops.where(take, v, result)
+        found = ops.or_(found, valid)
+    return _finish(result, ops.not_(found))
+    
+# Conditional functions
+# ---------------------
+# st_cond, st_clip, st_inlist, st_inrange, and st_missing take any mix
+# of StataVarVals (including StataMask) and scalars, and use the flags
+# and array operations of _ops above, so each step is one pass over 
+# the arrays. Missing values are kept as Stata's large floats, so 
+# selecting values (as in st_cond) keeps their missing-value codes. 
+# st_inlist, st_inrange, and st_missing give a StataMask; like 
+# comparisons, they evaluate StataVariable and StataVarExpr arguments 
+# right away.
+
+def _length(args):
+    """Length of the StataVarVals among args, or None if there are none"""
+    lengths = set(len(a) for a in args if isinstance(a, StataVarVals))
+    if len(lengths) > 1:
+        raise ValueError("StataVarVals arguments differ in length")
+    return lengths.pop() if lengths else None
+    
+def _is_str(x):
+    """Whether x is a string or StataVarVals of strings"""
+    if isinstance(x, StataVarVals):
+        return not isinstance(x._arrays()[0], array)
+    return isinstance(x, str)
+    
+def _items(x, n):
+    """Values of StataVarVals x, or scalar x repeated n times"""
+    return iter(x) if isinstance(x, StataVarVals) else repeat(x, n)
+    
+def _flag_mask(flags):
+    """StataMask from flags of _ops"""
+    return _mask_of(_ops.to_bytes(flags))
+    
+def _now(func):
+    """Decorator for functions giving a StataMask, so that StataVariable
+    and StataVarExpr arguments are evaluated right away
+    
+    """
+    @functools.wraps(func)
+    def eager_func(*args):
+        return func(*(_wrap(*a._arrays()) if _is_lazy(a) else a 
+                      for a in args))
+    return eager_func
+    
+# Native functions
+# ----------------
+# When running in Stata, cloglog, digamma, invlogit, lngamma, reldif, 
+# round, and trigamma of StataVarVals are calculated by the plugin's 
+# _st_math, in loops in C with the same steps as the scalar functions, 
+# so with the same results. _st_math releases the GIL, so with 
+# `threads` greater than 1, arrays of at least 2 * _MIN_PART values are
+# split into parts that are calculated at the same time in threads.
+
+threads = 1
+_MIN_PART = 16384
+
+# (number of threads, ThreadPoolExecutor), created when first needed
+_pool = (0, None)
+
+def _executor():
+    """ThreadPoolExecutor with `threads` workers"""
+    global _pool
+    count, executor = _pool
+    if count != threads:
+        from concurrent.futures import ThreadPoolExecutor
+        if executor is not None:
+            executor.shutdown(wait=False)
+        executor = ThreadPoolExecutor(max_workers=threads)
+        _pool = (threads, executor)
+    return executor
+    
+def _native_operand(x):
+    """Buffer of values (or a number) and buffer of missing-value codes
+    (or None) of x, for _st_math
+    
+    """
+    if isinstance(x, StataVarVals):
+        values, missing = x._arrays()
+        if not isinstance(values, array):
+            raise TypeError("int, float, or MissingValue instance required")
+        return values, missing
+    if x is None or isinstance(x, MissingValue):
+        return (x or mv).value, None
+    if not isinstance(x, int) and not isinstance(x, float):
+        raise TypeError("int, float, or MissingValue instance required")
+    return x, None
+    
+def _native(func, x, y=0.0):
+    """Calculate `func` (a name known to _st_math) of x, or of x and y, 
+    at least one of which is a StataVarVals
+    
+    """
+    n = len(x) if isinstance(x, StataVarVals) else len(y)
+    operands = _native_operand(x) + _native_operand(y)
+    result = array('d', [0.0]) * n
+    codes = bytearray(n)
+    parts = min(threads, n // _MIN_PART)
+    if parts <= 1:
+        nmiss = _st_math(func, *(operands + (result, codes)))
+    else:
+        buffers = [
+            memoryview(b) if isinstance(b, (array, bytes, bytearray)) else b
+            for b in operands + (result, codes)
+        ]
+        bounds = [n * i // parts for i in range(parts + 1)]
+        def calculate(start, stop):
+            return _st_math(func, *(
+                b[start:stop] if isinstance(b, memoryview) else b 
+                for b in buffers
+            ))
+        nmiss = sum(_executor().map(calculate, bounds[:-1], bounds[1:]))
+    return _wrap(result, codes if nmiss else None)
+    
+# Tables
+# ------
+# ln(n!) for integers n >= 0 is looked up in a table of math.lgamma 
+# values, grown as larger n are requested, up to _LNFACTORIAL_SIZE 
+# entries. lngamma(n) of positive integers n is ln((n - 1)!) and uses 
+# the same table. Results of comb are kept in an LRU cache of up to 
+# _COMB_CACHE_SIZE entries. Either way, values are the same as when 
+# calculated directly.
+
+_LNFACTORIAL_SIZE = 65536
+_COMB_CACHE_SIZE = 4096
+
+_lnfactorial_table = array('d')
+
+def _lnfactorials(size):
+    """Table of ln(n!) for n = 0, 1, ..., with at least `size` entries
+    (`size` should be at most _LNFACTORIAL_SIZE)
+    
+    """
+    table = _lnfactorial_table
+    if len(table) < size:
+        lgamma = math.lgamma
+        new_size = min(max(size, 2 * len(table), 256), _LNFACTORIAL_SIZE)
+        table.extend(lgamma(n + 1) for n in range(len(table), new_size))
+    return table
+    
+def _lnfactorial_lookup(n, found, other):
+    """ln(n!) looked up for integers n >= 0 flagged by `found`, and 
+    from other(), a function giving values for all positions, elsewhere
+    
+    """
+    ops = _ops
+    if not ops.any(found):
+        return other()
+    missed = ops.not_(found)
+    n = ops.patch(n, missed, 0.0)
+    value = ops.lookup(_lnfactorials(int(ops.maximum(n)) + 1), n)
+    if ops.any(missed):
+        value = ops.where(missed, other(), value)
+    return value
+    
+    
+@_lazy
 def st_abs(x):
     """Absolute value function.
     
@@ -32,13 +658,12 @@ def st_abs(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals(
-            [mv if _is_missing(v) else abs(v) for v in x.values]
-        )
+        return _vectorized(x, lambda v: _ops.ufunc("absolute", abs, v))
     if _is_missing(x):
         return mv
     return abs(x)
 
+@_lazy
 def st_acos(x):
     """Inverse cosine function.
     
@@ -53,14 +678,12 @@ def st_acos(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or not -1 <= v <= 1
-            else math.acos(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.acos), _interval(-1, 1))
     if _is_missing(x) or not -1 <= x <= 1:
         return mv
     return math.acos(x)
 
+@_lazy
 def st_acosh(x):
     """Inverse hyperbolic cosine function.
     
@@ -75,14 +698,12 @@ def st_acosh(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or v < 1
-            else math.acosh(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.acosh), _interval(1), safe=1.0)
     if _is_missing(x) or x < 1:
         return mv
     return math.acosh(x)
 
+@_lazy
 def st_asin(x):
     """Inverse sine function.
     
@@ -97,14 +718,12 @@ def st_asin(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or not -1 <= v <= 1
-            else math.asin(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.asin), _interval(-1, 1))
     if _is_missing(x) or not -1 <= x <= 1:
         return mv
     return math.asin(x)
 
+@_lazy
 def st_asinh(x):
     """Inverse hyperbolic sine function.
     
@@ -119,13 +738,12 @@ def st_asinh(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) else math.asinh(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.asinh))
     if _is_missing(x):
         return mv
     return math.asinh(x)
 
+@_lazy
 def st_atan(x):
     """Inverse tangent function.
     
@@ -140,9 +758,7 @@ def st_atan(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) else math.atan(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.atan))
     if _is_missing(x):
         return mv
     return math.atan(x)
@@ -152,6 +768,7 @@ def _atan2(x, y):
         return mv
     return math.atan2(x, y)
 
+@_lazy
 def st_atan2(x, y):
     """Two-parameter inverse tangent function.
     
@@ -169,22 +786,12 @@ def st_atan2(x, y):
     x and y are both non-missing, MISSING (".") otherwise.
     
     """
-    if isinstance(x, StataVarVals):
-        if isinstance(y, StataVarVals):
-            return StataVarVals([
-                _atan2(vx, vy) for vx, vy in zip(x.values, y.values)
-            ])
-        elif _is_missing(y):
-            return StataVarVals([mv for v in x.values])
-        else:
-            return StataVarVals([_atan2(v, y) for v in x.values])
-    if isinstance(y, StataVarVals):
-        if _is_missing(x):
-            return StataVarVals([mv for v in y.values])
-        else:
-            return StataVarVals([_atan2(x, v) for v in y.values])
+    if isinstance(x, StataVarVals) or isinstance(y, StataVarVals):
+        return _vectorized2(
+            x, y, lambda vx, vy: _ops.apply(math.atan2, vx, vy))
     return _atan2(x, y)
     
+@_lazy
 def st_atanh(x):
     """Inverse hyperbolic tangent function.
     
@@ -199,10 +806,8 @@ def st_atanh(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or not -1 < v < 1
-            else math.atanh(v) for v in x.values
-        ])
+        return _vectorized(
+            x, _math(math.atanh), _interval(-1, 1, True, True))
     if _is_missing(x) or not -1 < x < 1:
         return mv
     return math.atanh(x)
@@ -218,6 +823,7 @@ def _ceil(x):
         return get_missing(x)
     return math.ceil(x)
     
+@_lazy
 def st_ceil(x):
     """Ceiling function.
     
@@ -235,8 +841,51 @@ def st_ceil(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_ceil(v) for v in x.values])
+        return _vectorized(
+            x, lambda v: _ops.ufunc("ceil", math.ceil, v), keep_missing=True)
     return _ceil(x)
+    
+def _clip(x, a, b):
+    if _is_missing(x):
+        return mv
+    has_a, has_b = not _is_missing(a), not _is_missing(b)
+    if has_a and has_b and a > b:
+        return mv
+    if has_a and x < a:
+        return a
+    if has_b and x > b:
+        return b
+    return x
+    
+@_lazy
+def st_clip(x, a, b):
+    """Clip function.
+    
+    Parameters
+    ----------
+    x : float, int, MissingValue instance, or None
+    a : float, int, MissingValue instance, or None
+    b : float, int, MissingValue instance, or None
+    
+    Returns
+    -------
+    x if a < x < b, a if x <= a, b if x >= b. 
+    A missing a or b is taken as no bound on that side.
+    MISSING (".") if x is missing or a > b.
+    
+    """
+    n = _length((x, a, b))
+    if n is None:
+        return _clip(x, a, b)
+    ops = _ops
+    (vx, x_missing), (va, a_missing), (vb, b_missing) = (
+        _values(x, n), _values(a, n), _values(b, n))
+    below = ops.and_(ops.not_(a_missing), ops.flags(operator.lt, vx, va))
+    above = ops.and_(ops.not_(b_missing), ops.flags(operator.gt, vx, vb))
+    result = ops.where(above, vb, ops.where(below, va, vx))
+    crossed = ops.and_(ops.not_(ops.or_(a_missing, b_missing)), 
+                       ops.flags(operator.gt, va, vb))
+    return _finish(result, ops.or_(x_missing, crossed))
 
 def _cloglog(x):
     if _is_missing(x) or not 0 < x < 1:
@@ -244,6 +893,13 @@ def _cloglog(x):
     log = math.log
     return log(-log(1 - x))
     
+def _cloglog_kernel(x):
+    ops = _ops
+    log = math.log
+    inner = ops.apply(log, ops.binop(operator.sub, 1, x))
+    return ops.apply(log, ops.binop(operator.mul, inner, -1))
+    
+@_lazy
 def st_cloglog(x):
     """Complementary log log function.
     
@@ -258,14 +914,23 @@ def st_cloglog(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_cloglog(v) for v in x.values])
+        if _st_math is not None:
+            return _native("cloglog", x)
+        return _vectorized(x, _cloglog_kernel, 
+            _interval(0, 1, True, True), safe=0.5)
     return _cloglog(x)
 
 def _comb(n, k):
     if (_is_missing(n) or not 1 <= n <= 1e+305 or not n == math.floor(n) or 
             _is_missing(k) or not 0 <= k <= n or not k == math.floor(k)):
         return mv
+    # ints and floats that are equal give equal results (and share
+    # cache entries) only if n - 1, n - 2, ... are exact as floats
+    if n < 9007199254740992:
+        return _comb_cached(n, k)
+    return _comb_product(n, k)
     
+def _comb_product(n, k):
     try:
         numer = 1.0
         denom = 1.0
@@ -285,6 +950,14 @@ def _comb(n, k):
         return int(value)
     return value
     
+_comb_cached = functools.lru_cache(maxsize=_COMB_CACHE_SIZE)(_comb_product)
+    
+def _comb_value(n, k):
+    # _comb for the vectorized path, with the float value of MISSING
+    value = _comb(n, k)
+    return mv.value if value is mv else value
+    
+@_lazy
 def st_comb(n, k):
     """Combinatorial function.
     
@@ -299,22 +972,50 @@ def st_comb(n, k):
     MISSING (".") otherwise
     
     """
-    if isinstance(n, StataVarVals):
-        if isinstance(k, StataVarVals):
-            return StataVarVals([
-                _comb(vn, vk) for vn, vk in zip(n.values, k.values)
-            ])
-        elif _is_missing(k):
-            return StataVarVals([mv for v in n.values])
-        else:
-            return StataVarVals([_comb(v, k) for v in n.values])
-    if isinstance(k, StataVarVals):
-        if _is_missing(n):
-            return StataVarVals([mv for v in k.values])
-        else:
-            return StataVarVals([_comb(n, v) for v in k.values])
+    if isinstance(n, StataVarVals) or isinstance(k, StataVarVals):
+        return _vectorized2(
+            n, k, lambda vn, vk: _ops.apply(_comb_value, vn, vk))
     return _comb(n, k)
 
+def _cond(x, a, b, c=None):
+    if _is_missing(x):
+        return a if c is None else c
+    return a if x != 0 else b
+    
+@_lazy
+def st_cond(x, a, b, c=None):
+    """Conditional function.
+    
+    Parameters
+    ----------
+    x : float, int, MissingValue instance, or None
+    a : float, int, str, MissingValue instance, or None
+    b : float, int, str, MissingValue instance, or None
+    c : float, int, str, MissingValue instance, or None
+        optional
+        if not specified, or None, a is used where x is missing
+    
+    Returns
+    -------
+    a if x is non-missing and not zero, b if x is zero, 
+    c if x is missing (a if c is not given).
+    
+    """
+    n = _length((x, a, b, c))
+    if n is None:
+        return _cond(x, a, b, c)
+    if any(_is_str(y) for y in (a, b, c)):
+        return StataVarVals(list(map(_cond, _items(x, n), _items(a, n), 
+                                     _items(b, n), _items(c, n))))
+    ops = _ops
+    vx, x_missing = _values(x, n)
+    result = ops.where(
+        ops.flags(operator.ne, vx, 0), _values(a, n)[0], _values(b, n)[0])
+    if c is not None and ops.any(x_missing):
+        result = ops.where(x_missing, _values(c, n)[0], result)
+    return _finish(result, ops.all_flags(n, False))
+    
+@_lazy
 def st_cos(x):
     """Cosine function.
     
@@ -330,10 +1031,7 @@ def st_cos(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or not -1e+18 <= v <= 1e+18
-            else math.cos(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.cos), _interval(-1e+18, 1e+18))
     if _is_missing(x) or not -1e+18 <= x <= 1e+18:
         return mv
     return math.cos(x)
@@ -345,6 +1043,7 @@ def _cosh(x):
     v = math.cosh(x)
     return v if -8.988465674311579e+307 <= v <= 8.988465674311579e+307 else mv
 
+@_lazy
 def st_cosh(x):
     """Hyperbolic cosine function.
     
@@ -365,7 +1064,8 @@ def st_cosh(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_cosh(v) for v in x.values])
+        return _vectorized(
+            x, _math(math.cosh), _interval(-709.8, 709.8), checked=True)
     return _cosh(x)
     
 def _digamma(x):    
@@ -407,6 +1107,7 @@ def _digamma(x):
         
     return value
 
+@_lazy
 def st_digamma(x):
     """Digamma (psi) function, the derivative of `st_lngamma`.
     
@@ -421,9 +1122,12 @@ def st_digamma(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_digamma(v) for v in x.values])
+        if _st_math is not None:
+            return _native("digamma", x)
+        return _vectorized(x, _digamma_kernel, _pole, safe=1.0)
     return _digamma(x)
 
+@_lazy
 def st_exp(x):
     """Exponential function.
     
@@ -444,10 +1148,8 @@ def st_exp(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or v > 709.09
-            else min(mv, math.exp(v)) for v in x.values
-        ])
+        return _vectorized(
+            x, _math(math.exp), _interval(hi=709.09), checked=True)
     if _is_missing(x) or x > 709.09:
         return mv
     return min(mv, math.exp(x))
@@ -463,6 +1165,7 @@ def _floor(x):
         return get_missing(x)
     return math.floor(x)
 
+@_lazy
 def st_floor(x):
     """Floor function.
     
@@ -480,9 +1183,79 @@ def st_floor(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_floor(v) for v in x.values])
+        return _vectorized(
+            x, lambda v: _ops.ufunc("floor", math.floor, v), keep_missing=True)
     return _floor(x)
     
+def _inlist(z, *args):
+    z = mv if z is None else z
+    return int(any(z == (mv if a is None else a) for a in args))
+    
+@_now
+def st_inlist(z, *args):
+    """In-list function.
+    
+    Parameters
+    ----------
+    z : float, int, str, MissingValue instance, or None
+    a : float, int, str, MissingValue instance, or None
+        (1 or more such inputs allowed)
+    
+    Returns
+    -------
+    1 if z is equal to any of a1, a2, ..., 0 otherwise.
+    Missing values are equal to the same missing value.
+    With StataVarVals arguments, returns a StataMask.
+    
+    """
+    if len(args) == 0:
+        raise TypeError("need at least 2 arguments")
+    n = _length((z,) + args)
+    if n is None:
+        return _inlist(z, *args)
+    if any(_is_str(y) for y in (z,) + args):
+        return _mask_of(map(_inlist, _items(z, n), 
+                            *(_items(a, n) for a in args)))
+    ops = _ops
+    vz = _values(z, n)[0]
+    found = ops.all_flags(n, False)
+    for a in args:
+        found = ops.or_(found, ops.flags(operator.eq, vz, _values(a, n)[0]))
+    return _flag_mask(found)
+    
+def _inrange(z, a, b):
+    if _is_missing(z):
+        return 0
+    return int((_is_missing(a) or a <= z) and (_is_missing(b) or z <= b))
+    
+@_now
+def st_inrange(z, a, b):
+    """In-range function.
+    
+    Parameters
+    ----------
+    z : float, int, MissingValue instance, or None
+    a : float, int, MissingValue instance, or None
+    b : float, int, MissingValue instance, or None
+    
+    Returns
+    -------
+    1 if z is non-missing and a <= z <= b, 0 otherwise.
+    A missing a or b is taken as no bound on that side.
+    With StataVarVals arguments, returns a StataMask.
+    
+    """
+    n = _length((z, a, b))
+    if n is None:
+        return _inrange(z, a, b)
+    ops = _ops
+    (vz, z_missing), (va, a_missing), (vb, b_missing) = (
+        _values(z, n), _values(a, n), _values(b, n))
+    inside = ops.and_(
+        ops.or_(a_missing, ops.flags(operator.le, va, vz)), 
+        ops.or_(b_missing, ops.flags(operator.le, vz, vb)))
+    return _flag_mask(ops.and_(ops.not_(z_missing), inside))
+    
 def _int(x):
     if isinstance(x, MissingValue):
         return x
@@ -494,6 +1267,7 @@ def _int(x):
         return get_missing(x)
     return int(x)
 
+@_lazy
 def st_int(x):
     """Integer truncation function.
     
@@ -512,9 +1286,21 @@ def st_int(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_int(v) for v in x.values])
+        return _vectorized(
+            x, lambda v: _ops.ufunc("trunc", math.trunc, v), keep_missing=True)
     return _int(x)
 
+def _invcloglog_kernel(x):
+    ops = _ops
+    exp = math.exp
+    high = ops.flags(operator.gt, x, 5)
+    low = ops.flags(operator.lt, x, -40)
+    inner = ops.apply(exp, ops.where(ops.or_(high, low), 0.0, x))
+    outer = ops.apply(exp, ops.binop(operator.mul, inner, -1))
+    value = ops.binop(operator.sub, 1.0, outer)
+    return ops.where(high, 1.0, ops.where(low, 0.0, value))
+
+@_lazy
 def st_invcloglog(x):
     """Inverse of the complementary log log function.
     
@@ -532,12 +1318,7 @@ def st_invcloglog(x):
     # where invcloglog(x) = . for x > 709.
     exp = math.exp
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v)
-            else 1.0 if v > 5
-            else 0.0 if v < -40
-            else 1.0 - exp(-exp(v)) for v in x.values
-        ])
+        return _vectorized(x, _invcloglog_kernel)
     if _is_missing(x):
         return mv
     if x > 5:
@@ -554,7 +1335,16 @@ def _invlogit(x):
     if x <= -750:
         return 0.0
     return math.exp(x)/(1 + math.exp(x))
+    
+def _invlogit_kernel(x):
+    ops = _ops
+    high = ops.flags(operator.ge, x, 40)
+    low = ops.flags(operator.le, x, -750)
+    exp = ops.apply(math.exp, ops.where(ops.or_(high, low), 0.0, x))
+    value = ops.binop(operator.truediv, exp, ops.binop(operator.add, 1, exp))
+    return ops.where(high, 1.0, ops.where(low, 0.0, value))
 
+@_lazy
 def st_invlogit(x):
     """Inverse logit function.
     
@@ -569,9 +1359,12 @@ def st_invlogit(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_invlogit(v) for v in x.values])
+        if _st_math is not None:
+            return _native("invlogit", x)
+        return _vectorized(x, _invlogit_kernel)
     return _invlogit(x)
 
+@_lazy
 def st_ln(x):
     """Natural log function.
     
@@ -586,9 +1379,8 @@ def st_ln(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or v <= 0 else math.log(v) for v in x.values
-        ])
+        return _vectorized(
+            x, _math(math.log), _interval(0, lo_open=True), safe=1.0)
     if _is_missing(x) or x <= 0:
         return mv
     return math.log(x)
@@ -598,10 +1390,28 @@ def _lnfactorial(n):
     # For example, in Stata 13.1 on Windows 7, lnfactorial(1.285e305) = .k_
     if _is_missing(n) or not n == math.floor(n) or n < 0 or n >= 1.282e+305:
         return mv
+    if n < len(_lnfactorial_table):
+        return _lnfactorial_table[int(n)]
+    if n < _LNFACTORIAL_SIZE:
+        return _lnfactorials(int(n) + 1)[int(n)]
     #value = math.lgamma(n + 1)
     #return value if value <= 8.988465674311579e+307 else mv
     return min(mv, math.lgamma(n + 1))
+    
+def _lnfactorial_kernel(n):
+    ops = _ops
+    return _lnfactorial_lookup(n, 
+        ops.flags(operator.lt, n, _LNFACTORIAL_SIZE),
+        lambda: ops.apply(math.lgamma, ops.binop(operator.add, n, 1)))
+    
+def _lnfactorial_outside(n):
+    ops = _ops
+    return ops.or_(
+        ops.flags(operator.ne, n, ops.ufunc("floor", math.floor, n)),
+        ops.outside(n, 0, 1.282e+305, False, True)
+    )
 
+@_lazy
 def st_lnfactorial(n):
     """Log of factorial function.
     
@@ -622,7 +1432,8 @@ def st_lnfactorial(n):
     
     """
     if isinstance(n, StataVarVals):
-        return StataVarVals([_lnfactorial(v) for v in n.values])
+        return _vectorized(n, _lnfactorial_kernel, _lnfactorial_outside, 
+            checked=True)
     return _lnfactorial(n)
     
 def _lngamma(x):
@@ -630,10 +1441,25 @@ def _lngamma(x):
     # There lngamma(x) = . for x < -2,147,483,648.
     if _is_missing(x) or (x <= 0 and x == math.floor(x)) or x >= 1.282e+305:
         return mv
+    if x == math.floor(x) and x <= _LNFACTORIAL_SIZE:
+        return _lnfactorial(x - 1)
     #v = math.lgamma(x)
     #return v if v <= 8.988465674311579e+307 else mv
     return min(mv, math.lgamma(x))
+    
+def _lngamma_kernel(x):
+    # for positive integers, lngamma(x) is ln((x - 1)!); non-positive
+    # integers have been replaced
+    ops = _ops
+    integer = ops.flags(operator.eq, x, ops.ufunc("floor", math.floor, x))
+    return _lnfactorial_lookup(ops.binop(operator.sub, x, 1), 
+        ops.and_(integer, ops.flags(operator.le, x, _LNFACTORIAL_SIZE)),
+        lambda: ops.apply(math.lgamma, x))
+    
+def _lngamma_outside(x):
+    return _ops.or_(_pole(x), _ops.flags(operator.ge, x, 1.282e+305))
 
+@_lazy
 def st_lngamma(x):
     """Log gamma function.
     
@@ -655,11 +1481,15 @@ def st_lngamma(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_lngamma(v) for v in x.values])
+        if _st_math is not None:
+            return _native("lngamma", x)
+        return _vectorized(x, _lngamma_kernel, _lngamma_outside, safe=1.0, 
+            checked=True)
     return _lngamma(x)
 
 st_log = st_ln
 
+@_lazy
 def st_log10(x):
     """Log-base-10 function.
     
@@ -674,10 +1504,8 @@ def st_log10(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or v <= 0
-            else math.log(v, 10) for v in x.values
-        ])
+        return _vectorized(x, lambda v: _ops.apply(math.log, v, 10), 
+            _interval(0, lo_open=True), safe=1.0)
     if _is_missing(x) or x <= 0:
         return mv
     return math.log(x, 10)
@@ -687,7 +1515,13 @@ def _logit(x):
         return mv
     v = math.log(x / (1 - x))
     return v if -8.988465674311579e+307 <= v <= 8.988465674311579e+307 else mv
+    
+def _logit_kernel(x):
+    ops = _ops
+    ratio = ops.binop(operator.truediv, x, ops.binop(operator.sub, 1, x))
+    return ops.apply(math.log, ratio)
 
+@_lazy
 def st_logit(x):
     """Logit function.
     
@@ -702,15 +1536,11 @@ def st_logit(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_logit(v) for v in x.values])
+        return _vectorized(x, _logit_kernel, 
+            _interval(0, 1, True, True), safe=0.5, checked=True)
     return _logit(x)
     
-def _max(*args, sub_max=None):
-    input = [a for a in args if not _is_missing(a)]
-    if sub_max is not None:
-        input.append(sub_max)
-    return max(input) if not len(input) == 0 else mv
-
+@_lazy
 def st_max(*args):
     """Max function.
     
@@ -727,23 +1557,14 @@ def st_max(*args):
     """
     if len(args) <= 1:
         raise TypeError("need at least 2 arguments")
-    vectors = [a for a in args if isinstance(a, StataVarVals)]
-    scalars = [
-        a for a in args if not isinstance(a, StataVarVals) and not _is_missing(a)
-    ]
-    if len(vectors) != 0:
-        sca_max = max(scalars) if not len(scalars) == 0 else None
-        return StataVarVals([_max(*v, sub_max=sca_max) for v in zip(*vectors)])
-    elif len(scalars) == 0:
+    if any(isinstance(a, StataVarVals) for a in args):
+        return _extreme(args, operator.gt)
+    scalars = [a for a in args if not _is_missing(a)]
+    if len(scalars) == 0:
         return mv
     return max(scalars)
     
-def _min(*args, sub_min=None):
-    input = [a for a in args if not _is_missing(a)]
-    if sub_min is not None:
-        input.append(sub_min)
-    return min(input) if not len(input) == 0 else mv
-
+@_lazy
 def st_min(*args):
     """Min function.
     
@@ -760,17 +1581,48 @@ def st_min(*args):
     """
     if len(args) <= 1:
         raise TypeError("need at least 2 arguments")
-    vectors = [a.values for a in args if isinstance(a, StataVarVals)]
-    scalars = [
-        a for a in args if not isinstance(a, StataVarVals) and not _is_missing(a)
-    ]
-    if len(vectors) != 0:
-        sca_min = min(scalars) if not len(scalars) == 0 else None
-        return StataVarVals([_min(*v, sub_min=sca_min) for v in zip(*vectors)])
-    elif len(scalars) == 0:
+    if any(isinstance(a, StataVarVals) for a in args):
+        return _extreme(args, operator.lt)
+    scalars = [a for a in args if not _is_missing(a)]
+    if len(scalars) == 0:
         return mv
     return min(scalars)
+    
+def _missing(*args):
+    return int(any(a == "" if isinstance(a, str) else _is_missing(a) 
+                   for a in args))
+    
+@_now
+def st_missing(*args):
+    """Missing function.
+    
+    Parameters
+    ----------
+    x : float, int, str, MissingValue instance, or None
+        (1 or more such inputs allowed)
+    
+    Returns
+    -------
+    1 if any x is missing, 0 otherwise. The empty string is missing.
+    With StataVarVals arguments, returns a StataMask.
+    
+    """
+    if len(args) == 0:
+        raise TypeError("need at least 1 argument")
+    n = _length(args)
+    if n is None:
+        return _missing(*args)
+    mask = _mask_of(bytes(n))
+    for a in args:
+        if not isinstance(a, StataVarVals):
+            mask = mask | _missing(a)
+        elif _is_str(a):
+            mask = mask | _mask_of(bytes(map(operator.not_, a)))
+        else:
+            mask = mask | _flag_mask(_values(a)[1])
+    return mask
 
+@_lazy
 def st_mod(x,y):
     """Modulo (modulus) function.
     
@@ -785,25 +1637,10 @@ def st_mod(x,y):
     MISSING (".") otherwise
     
     """
-    if isinstance(x, StataVarVals):
-        if isinstance(y, StataVarVals):
-            return StataVarVals([
-                mv if _is_missing(vx) or _is_missing(vy) or vy <= 0
-                else vx % vy for vx, vy in zip(x.values, y.values)
-            ])
-        elif _is_missing(y) or y <= 0:
-            return StataVarVals([mv for v in x.values])
-        else:
-            return StataVarVals([
-                mv if _is_missing(v) else v % y for v in x.values
-            ])
-    if isinstance(y, StataVarVals):
-        if _is_missing(x):
-            return StataVarVals([mv for v in y.values])
-        else:
-            return StataVarVals([
-                mv if _is_missing(v) or v <= 0 else x % v for v in y.values
-            ])
+    if isinstance(x, StataVarVals) or isinstance(y, StataVarVals):
+        return _vectorized2(x, y, 
+            lambda vx, vy: _ops.apply(operator.mod, vx, vy),
+            lambda vx, vy: _ops.flags(operator.le, vy, 0), safe=(0.0, 1.0))
     if _is_missing(x) or _is_missing(y) or y <= 0:
         return mv
     return x % y
@@ -824,6 +1661,21 @@ def _reldif(x, y):
         return mv
     return abs(x - y) / (abs(y) + 1)
     
+def _reldif_vectorized(x, y):
+    ops = _ops
+    n = len(x) if isinstance(x, StataVarVals) else len(y)
+    # as in _reldif, values out of range are compared as missing values
+    (vx, x_missing), (vy, y_missing) = _values(x, n), _values(y, n)
+    vx, vy = _as_missing(vx, x_missing), _as_missing(vy, y_missing)
+    missing = ops.or_(x_missing, y_missing)
+    equal = ops.flags(operator.eq, vx, vy)
+    vx, vy = ops.where(missing, 0.0, vx), ops.where(missing, 0.0, vy)
+    diff = ops.ufunc("absolute", abs, ops.binop(operator.sub, vx, vy))
+    scale = ops.binop(operator.add, ops.ufunc("absolute", abs, vy), 1)
+    value = ops.where(equal, 0.0, ops.binop(operator.truediv, diff, scale))
+    return _finish(value, ops.and_(missing, ops.not_(equal)))
+    
+@_lazy
 def st_reldif(x, y):
     """Relative difference function.
     
@@ -840,19 +1692,10 @@ def st_reldif(x, y):
     Otherwise, returns MISSING (".").
     
     """
-    if isinstance(x, StataVarVals):
-        if isinstance(y, StataVarVals):
-            return StataVarVals([
-                _reldif(vx, vy) for vx, vy in zip(x.values, y.values)
-            ])
-        else:
-            return StataVarVals([
-                _reldif(v, y) for v in x.values
-            ])
-    if isinstance(y, StataVarVals):
-        return StataVarVals([
-            _reldif(x, v) for v in y.values
-        ])
+    if isinstance(x, StataVarVals) or isinstance(y, StataVarVals):
+        if _st_math is not None:
+            return _native("reldif", x, y)
+        return _reldif_vectorized(x, y)
     return _reldif(x, y)
     
 def _round(x, y):
@@ -913,7 +1756,27 @@ def _round(x, y):
     if _is_missing(x):
         return x if isinstance(x, MissingValue) else get_missing(x)
     return math.floor(x / y + 0.5) * y
+    
+def _round_vectorized(x, y):
+    ops = _ops
+    n = len(x) if isinstance(x, StataVarVals) else len(y)
+    (vx, x_missing), (vy, y_missing) = _values(x, n), _values(y, n)
+    invalid = ops.or_(x_missing, y_missing)
+    zero = ops.flags(operator.eq, vy, 0)
+    wx = ops.where(invalid, 0.0, vx)
+    wy = ops.where(ops.or_(invalid, zero), 1.0, vy)
+    ratio = ops.binop(operator.add, ops.binop(operator.truediv, wx, wy), 0.5)
+    value = ops.binop(operator.mul, ops.ufunc("floor", math.floor, ratio), wy)
+    if isinstance(y, int):
+        # with int y, the product is int, so zero is never negative
+        value = ops.binop(operator.add, value, 0.0)
+    # x is returned where y is zero, or (as its missing value) where x 
+    # is missing and y is not
+    value = ops.where(zero, wx, value)
+    keep = (ops.where(y_missing, mv.value, vx), invalid)
+    return _finish(value, invalid, keep)
 
+@_lazy
 def st_round(x, y=1):
     """Rounding function.
     
@@ -946,27 +1809,13 @@ def st_round(x, y=1):
     the output.
     
     """
-    if isinstance(x, StataVarVals):
-        if isinstance(y, StataVarVals):
-            return StataVarVals([
-                _round(vx, vy) for vx, vy in zip(x.values, y.values)
-            ])
-        if y == 0:
-            return StataVarVals([
-                get_missing(v)
-                if _is_missing(v) and not isinstance(v, MissingValue)
-                else v for v in x.values
-            ])
-        else:
-            return StataVarVals([
-                _round(v, y) for v in x.values
-            ])
-    if isinstance(y, StataVarVals):
-        return StataVarVals([
-            _round(x, v) for v in y.values
-        ])
+    if isinstance(x, StataVarVals) or isinstance(y, StataVarVals):
+        if _st_math is not None:
+            return _native("round", x, y)
+        return _round_vectorized(x, y)
     return _round(x, y)
 
+@_lazy
 def st_sign(x):
     """Sign function.
     
@@ -981,14 +1830,14 @@ def st_sign(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v)
-            else 0 if v == 0 else -1 if v < 0 else 1 for v in x.values
-        ])
+        return _vectorized(x, lambda v: _ops.binop(operator.sub, 
+            _ops.floats(_ops.flags(operator.gt, v, 0)), 
+            _ops.floats(_ops.flags(operator.lt, v, 0))))
     if _is_missing(x):
         return mv
     return 0 if x == 0 else -1 if x < 0 else 1
                      
+@_lazy
 def st_sin(x):
     """Sine function.
     
@@ -1004,10 +1853,7 @@ def st_sin(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or not -1e+18 <= v <= 1e+18
-            else math.sin(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.sin), _interval(-1e+18, 1e+18))
     if _is_missing(x) or not -1e+18 <= x <= 1e+18:
         return mv
     return math.sin(x)
@@ -1018,6 +1864,7 @@ def _sinh(x):
     v = math.sinh(x)
     return v if -8.988465674311579e+307 <= v <= 8.988465674311579e+307 else mv
     
+@_lazy
 def st_sinh(x):
     """Hyperbolic sine function.
     
@@ -1038,9 +1885,11 @@ def st_sinh(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_sinh(v) for v in x.values])
+        return _vectorized(
+            x, _math(math.sinh), _interval(-709.8, 709.8), checked=True)
     return _sinh(x)
 
+@_lazy
 def st_sqrt(x):
     """Square root function.
     
@@ -1055,9 +1904,8 @@ def st_sqrt(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or v < 0 else math.sqrt(v) for v in x.values
-        ])
+        return _vectorized(
+            x, lambda v: _ops.ufunc("sqrt", math.sqrt, v), _interval(0))
     if _is_missing(x) or x < 0:
         return mv
     return math.sqrt(x)
@@ -1084,7 +1932,8 @@ def st_sum(x):
     
     """
     if isinstance(x, StataVarVals):
-        values = [v for v in x.values if not _is_missing(v)]
+        v, missing = _values(x)
+        values = _ops.select(v, _ops.not_(missing))
         if len(values) == 0:
             return 0
         v = sum(values)
@@ -1095,6 +1944,7 @@ def st_sum(x):
         return 0
     return x
 
+@_lazy
 def st_tan(x):
     """Tangent function.
     
@@ -1110,19 +1960,15 @@ def st_tan(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) or not -1e+18 <= v <= 1e+18
-            else math.tan(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.tan), _interval(-1e+18, 1e+18))
     if _is_missing(x) or not -1e+18 <= x <= 1e+18:
         return mv
     return math.tan(x)  # assuming tan does not get above ~ 1e17
 
+@_lazy
 def st_tanh(x):
     if isinstance(x, StataVarVals):
-        return StataVarVals([
-            mv if _is_missing(v) else math.tanh(v) for v in x.values
-        ])
+        return _vectorized(x, _math(math.tanh))
     if _is_missing(x):
         return mv
     return math.tanh(x)
@@ -1163,6 +2009,7 @@ def _trigamma(x):
         
     return value if not flip else -value
 
+@_lazy
 def st_trigamma(x):
     """Trigamma function, derivative of `st_digamma`, second
     derivative of `st_lngamma`.
@@ -1178,7 +2025,9 @@ def st_trigamma(x):
     
     """
     if isinstance(x, StataVarVals):
-        return StataVarVals([_trigamma(v) for v in x.values])
+        if _st_math is not None:
+            return _native("trigamma", x)
+        return _vectorized(x, _trigamma_kernel, _pole, safe=1.0)
     return _trigamma(x)
 
 st_trunc = st_int
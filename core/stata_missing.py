@@ -120,6 +120,15 @@ class MissingValue():
 
 
 MISSING_VALS = tuple(MissingValue(i) for i in range(27))
+
+# Inside Stata, use the MissingValue type implemented in the plugin.
+# It behaves like the class above, but comparisons and arithmetic 
+# run in C. The class above is kept for use outside of Stata.
+try:
+    from stata_plugin import MissingValue, MISSING_VALS
+except ImportError:
+    pass
+
 MISSING = MISSING_VALS[0]
 
 
@@ -0,0 +1,371 @@
+import operator
+import re
+from array import array
+from itertools import repeat
+
+from stata_variable import StataVarVals, _lazy, _mask_of, _wrap
+from stata_math import _is_missing, _items, _length, _now
+
+
+__version__ = "0.2.0"
+
+
+# Vectorized functions
+# --------------------
+# With StataVarVals of strings (e.g., from a string variable of
+# st_mirror, whose values are fetched one chunk at a time with one
+# plugin call per chunk), the functions below work on the whole list of
+# strings at once. Where the other arguments are single values, the
+# work is done by mapping str methods over the list, so no Python code
+# runs per value. Numeric results are returned in an array('d'), so
+# that assigning them to a numeric variable, as in
+# `src.len_ = st_strlen(src.make_)`, stores them in bulk. As in Stata,
+# the empty string is the missing string value.
+
+# matches of the most recent st_regexm, used by st_regexs: a match
+# object or None after a call with a str, or a list of them after a
+# call with StataVarVals
+_last_match = None
+
+
+def _strings(s):
+    """List of the values of StataVarVals s, which must be strings"""
+    values = s._arrays()[0]
+    if isinstance(values, array):
+        raise TypeError("str or StataVarVals of str required")
+    return values
+    
+def _numbers(values):
+    """StataVarVals of numbers, from an iterable of int"""
+    return _wrap(array('d', values), None)
+    
+def _strs(values):
+    """StataVarVals of strings, from an iterable of str"""
+    return _wrap(list(values), None)
+    
+def _int_arg(n):
+    """int of number n, or None if n is missing"""
+    return None if _is_missing(n) else int(n)
+    
+def _lower(s):
+    return s.lower()
+    
+@_lazy
+def st_lower(s):
+    """Lowercase function.
+    
+    Parameters
+    ----------
+    s : str
+    
+    Returns
+    -------
+    s with letters changed to lowercase
+    
+    """
+    if isinstance(s, StataVarVals):
+        return _strs(map(str.lower, _strings(s)))
+    return _lower(s)
+    
+def _ltrim(s):
+    return s.lstrip(" ")
+    
+@_lazy
+def st_ltrim(s):
+    """Left-trim function.
+    
+    Parameters
+    ----------
+    s : str
+    
+    Returns
+    -------
+    s without leading blanks
+    
+    """
+    if isinstance(s, StataVarVals):
+        return _strs(map(str.lstrip, _strings(s), repeat(" ")))
+    return _ltrim(s)
+    
+def _regexm(s, pattern):
+    return re.compile(pattern).search(s)
+    
+@_now
+def st_regexm(s, pattern):
+    """Regular expression match function.
+    
+    Parameters
+    ----------
+    s : str
+    pattern : str
+        regular expression, in Python's syntax
+    
+    Returns
+    -------
+    1 if pattern matches somewhere in s, 0 otherwise.
+    With StataVarVals arguments, returns a StataMask.
+    The matches are kept for use with st_regexs.
+    
+    Notes
+    -----
+    With StataVarVals of strings and a single pattern, the pattern is
+    compiled once for all values. Recently used patterns are kept by
+    the re module, so repeated calls do not compile them again.
+    
+    """
+    global _last_match
+    n = _length((s, pattern))
+    if n is None:
+        _last_match = _regexm(s, pattern)
+        return int(_last_match is not None)
+    if isinstance(pattern, StataVarVals):
+        matches = list(map(_regexm, _items(s, n), _strings(pattern)))
+    else:
+        matches = list(map(re.compile(pattern).search, _strings(s)))
+    _last_match = matches
+    return _mask_of(matches)
+    
+def _regexs(match, n):
+    if match is None:
+        return ""
+    return match.group(n) or ""
+    
+def st_regexs(n):
+    """Regular expression subexpression function.
+    
+    Parameters
+    ----------
+    n : int
+    
+    Returns
+    -------
+    The nth subexpression of the match from the most recent call to
+    st_regexm, with 0 for the whole match. "" if there was no match
+    or the subexpression did not take part in it. If the most recent
+    st_regexm was called with StataVarVals, returns StataVarVals with
+    the subexpression of each match.
+    
+    """
+    if isinstance(_last_match, list):
+        return _strs(map(_regexs, _last_match, repeat(n)))
+    return _regexs(_last_match, n)
+    
+def _rtrim(s):
+    return s.rstrip(" ")
+    
+@_lazy
+def st_rtrim(s):
+    """Right-trim function.
+    
+    Parameters
+    ----------
+    s : str
+    
+    Returns
+    -------
+    s without trailing blanks
+    
+    """
+    if isinstance(s, StataVarVals):
+        return _strs(map(str.rstrip, _strings(s), repeat(" ")))
+    return _rtrim(s)
+    
+def _strlen(s):
+    return len(s)
+    
+@_lazy
+def st_strlen(s):
+    """String length function.
+    
+    Parameters
+    ----------
+    s : str
+    
+    Returns
+    -------
+    number of characters in s
+    
+    """
+    if isinstance(s, StataVarVals):
+        return _numbers(map(len, _strings(s)))
+    return _strlen(s)
+    
+def _strpos(s1, s2):
+    return s1.find(s2) + 1
+    
+@_lazy
+def st_strpos(s1, s2):
+    """String position function.
+    
+    Parameters
+    ----------
+    s1 : str
+    s2 : str
+    
+    Returns
+    -------
+    position in s1 at which s2 is first found (1 for the first
+    character), 0 if s2 is not found
+    
+    """
+    n = _length((s1, s2))
+    if n is None:
+        return _strpos(s1, s2)
+    s2 = _strings(s2) if isinstance(s2, StataVarVals) else repeat(s2)
+    found = map(str.find, _items(s1, n), s2)
+    return _numbers(map(operator.add, found, repeat(1)))
+    
+def _subinstr(s1, s2, s3, n):
+    n = _int_arg(n)
+    if n is None:
+        return s1.replace(s2, s3)
+    return s1.replace(s2, s3, max(n, 0))
+    
+@_lazy
+def st_subinstr(s1, s2, s3, n):
+    """Substring substitution function.
+    
+    Parameters
+    ----------
+    s1 : str
+    s2 : str
+    s3 : str
+    n : int, MissingValue instance, or None
+    
+    Returns
+    -------
+    s1 with the first n occurrences of s2 replaced by s3, or all
+    occurrences if n is missing
+    
+    """
+    count = _length((s1, s2, s3, n))
+    if count is None:
+        return _subinstr(s1, s2, s3, n)
+    if not any(isinstance(x, StataVarVals) for x in (s2, s3, n)):
+        n = _int_arg(n)
+        n = -1 if n is None else max(n, 0)
+        return _strs(map(str.replace, _strings(s1), repeat(s2),
+                         repeat(s3), repeat(n)))
+    return _strs(map(_subinstr, _items(s1, count), _items(s2, count),
+                     _items(s3, count), _items(n, count)))
+    
+def _substr_slice(n1, n2):
+    """Slice of a string giving Stata's substr(s, n1, n2), or None if
+    the slice depends on the length of s
+    
+    """
+    n1, n2 = _int_arg(n1), _int_arg(n2)
+    if n1 is None or n1 == 0 or (n2 is not None and n2 <= 0):
+        return slice(0, 0)
+    if n1 < 0:
+        return None
+    return slice(n1 - 1, None if n2 is None else n1 - 1 + n2)
+    
+def _substr(s, n1, n2):
+    part = _substr_slice(n1, n2)
+    if part is not None:
+        return s[part]
+    # n1 < 0, counted from the end of s
+    start = len(s) + int(n1)
+    if start < 0:
+        return ""
+    n2 = _int_arg(n2)
+    return s[start:] if n2 is None else s[start:start + n2]
+    
+@_lazy
+def st_substr(s, n1, n2):
+    """Substring function.
+    
+    Parameters
+    ----------
+    s : str
+    n1 : int, MissingValue instance, or None
+    n2 : int, MissingValue instance, or None
+    
+    Returns
+    -------
+    the substring of s starting at character n1 (1 for the first),
+    of length n2, or to the end of s if n2 is missing. If n1 < 0, it
+    counts from the end of s (-1 for the last character).
+    "" if n1 is missing or 0, or if n1 or n2 is out of range.
+    
+    """
+    n = _length((s, n1, n2))
+    if n is None:
+        return _substr(s, n1, n2)
+    if not (isinstance(n1, StataVarVals) or isinstance(n2, StataVarVals)):
+        part = _substr_slice(n1, n2)
+        if part is not None:
+            return _strs(map(operator.itemgetter(part), _strings(s)))
+    return _strs(map(_substr, _items(s, n), _items(n1, n), _items(n2, n)))
+    
+def _trim(s):
+    return s.strip(" ")
+    
+@_lazy
+def st_trim(s):
+    """Trim function.
+    
+    Parameters
+    ----------
+    s : str
+    
+    Returns
+    -------
+    s without leading and trailing blanks
+    
+    """
+    if isinstance(s, StataVarVals):
+        return _strs(map(str.strip, _strings(s), repeat(" ")))
+    return _trim(s)
+    
+def _upper(s):
+    return s.upper()
+    
+@_lazy
+def st_upper(s):
+    """Uppercase function.
+    
+    Parameters
+    ----------
+    s : str
+    
+    Returns
+    -------
+    s with letters changed to uppercase
+    
+    """
+    if isinstance(s, StataVarVals):
+        return _strs(map(str.upper, _strings(s)))
+    return _upper(s)
+    
+def _word(s, n):
+    n = _int_arg(n)
+    if n is None or n == 0:
+        return ""
+    words = [w for w in s.split(" ") if w]
+    if not -len(words) <= n <= len(words):
+        return ""
+    return words[n - 1] if n > 0 else words[n]
+    
+@_lazy
+def st_word(s, n):
+    """Word function.
+    
+    Parameters
+    ----------
+    s : str
+    n : int, MissingValue instance, or None
+    
+    Returns
+    -------
+    the nth word of s, with words separated by blanks. Positive n
+    count from the first word (1), negative n from the last (-1).
+    "" if n is missing or 0, or if s has fewer than n words.
+    
+    """
+    count = _length((s, n))
+    if count is None:
+        return _word(s, n)
+    return _strs(map(_word, _items(s, count), _items(n, count)))
+    
\ No newline at end of file
@@ -1,8 +1,159 @@
 import collections
+import functools
+import operator
+from array import array
+from itertools import compress, repeat
 
+from stata_missing import MissingValue, MISSING, MISSING_VALS, get_missing
+try:
+    from stata_plugin import _st_arith
+except ImportError:
+    _st_arith = None
 
-__version__ = "0.1.0"
 
+__version__ = "0.2.0"
+
+# Stata's range of non-missing doubles
+_MIN_VALUE = -1.7976931348623157e+308
+_MAX_VALUE = 8.988465674311579e+307
+_NAN = float("nan")
+
+_OPS = {
+    "+": operator.add, "-": operator.sub, "*": operator.mul, 
+    "/": operator.truediv, "//": operator.floordiv, "%": operator.mod, 
+    "**": operator.pow, "<": operator.lt, "<=": operator.le, 
+    "==": operator.eq, "!=": operator.ne, ">": operator.gt, 
+    ">=": operator.ge
+}
+_COMPARISONS = frozenset(("<", "<=", "==", "!=", ">", ">="))
+
+
+def _out_of_range(values):
+    """Positions in array of float where values are outside of Stata's 
+    non-missing range, including infinite values and nan. The checks
+    are made with map, so no Python code runs per value.
+    
+    """
+    # quick check first; the sum is nan if any value is nan
+    total = sum(values)
+    if (total == total and min(values, default=0.0) >= _MIN_VALUE and 
+            max(values, default=0.0) <= _MAX_VALUE):
+        return []
+    flags = map(operator.or_, 
+        map(operator.gt, values, repeat(_MAX_VALUE)),
+        map(operator.lt, values, repeat(_MIN_VALUE)))
+    flags = map(operator.or_, flags, map(operator.ne, values, values))
+    return list(compress(range(len(values)), flags))
+
+
+def _to_arrays(values):
+    """Convert values to an array of float and missing-value codes.
+    
+    Missing-value codes are held in a bytearray, one for each value: 
+    0 for non-missing, k + 1 for MISSING_VALS[k]. If there are no 
+    missing values, None is returned in place of the bytearray. 
+    Missing values are kept in the array as Stata's large floats, so
+    that comparisons need no special case.
+    
+    If values are not all numbers, MissingValue instances, or None,
+    (e.g., they are strings) a list of the values is returned with 
+    None for the missing-value codes.
+    
+    """
+    if not (isinstance(values, array) and values.typecode == 'd'):
+        values = list(values)
+        try:
+            floats = array('d', values)
+        except TypeError:
+            return _mixed_to_arrays(values)
+    else:
+        floats = values
+        
+    positions = _out_of_range(floats)
+    if not positions:
+        return floats, None
+    
+    if floats is values:
+        floats = array('d', floats)
+    missing = bytearray(len(floats))
+    for i in positions:
+        v = floats[i]
+        mv = MISSING if v != v else get_missing(v)
+        floats[i] = mv.value
+        missing[i] = mv.index + 1
+    return floats, missing
+
+
+def _mixed_to_arrays(values):
+    """helper for _to_arrays; converts a list that is not all numbers"""
+    floats = array('d', [0.0]) * len(values)
+    missing = bytearray(len(values))
+    for i, v in enumerate(values):
+        if v is None:
+            v = MISSING
+        if isinstance(v, MissingValue):
+            floats[i] = v.value
+            missing[i] = v.index + 1
+        elif isinstance(v, int) or isinstance(v, float):
+            floats[i] = v
+        else:
+            return values, None
+    floats, out_of_range = _to_arrays(floats)
+    if out_of_range is not None:
+        for i in compress(range(len(missing)), out_of_range):
+            missing[i] = out_of_range[i]
+    return floats, missing
+
+
+def _safe(op):
+    """Wrap binary operator so that errors and non-real results give 
+    nan, which then becomes missing, as in Stata
+    
+    """
+    def safe_op(x, y):
+        try:
+            z = op(x, y)
+        except (ArithmeticError, ValueError):
+            return _NAN
+        return z if isinstance(z, float) or isinstance(z, int) else _NAN
+    return safe_op
+    
+    
+def _result_codes(values, *masks):
+    """Missing-value codes for the result of arithmetic on arrays, 
+    when the plugin's _st_arith is not available.
+    
+    As in Stata, the result is . wherever an operand is missing or 
+    where the result is outside of the non-missing range. These 
+    positions are set to . in `values`, and a bytearray of codes is 
+    returned, or None if there are no missing values.
+    
+    """
+    positions = set(_out_of_range(values))
+    for mask in masks:
+        if mask is not None:
+            positions.update(compress(range(len(values)), mask))
+    if not positions:
+        return None
+    
+    missing = bytearray(len(values))
+    dot = MISSING.value
+    for i in positions:
+        values[i] = dot
+        missing[i] = 1
+    return missing
+    
+    
+def _wrap(values, missing):
+    """Make StataVarVals from array of float and missing-value codes 
+    (or None), without checking them
+    
+    """
+    vals = StataVarVals.__new__(StataVarVals)
+    vals.values = values
+    vals.missing = missing
+    return vals
+    
 
 class StataVarVals():
     """A class for intermediate values when calculating with data
@@ -11,6 +162,17 @@ class StataVarVals():
     
     This class is meant for internal use.
     
+    Numeric values are held in an array of float (`values`), with 
+    missing values held as Stata's large floats, and a bytearray of 
+    missing-value codes (`missing`): 0 for non-missing, k + 1 for 
+    MISSING_VALS[k], or None if there are no missing values. 
+    Arithmetic loops over the arrays in C, and, as in Stata, gives . 
+    wherever an operand is missing or the result is out of range 
+    (e.g., when dividing by zero). Comparisons use Stata's ordering, 
+    with missing values greater than all numbers. In-place operators 
+    write into the existing array. Non-numeric values (i.e., strings) 
+    are held in a list, and operations on them are done element-wise.
+    
     Example
     -------    
     A user can create or replace a data variable called "target" with
@@ -26,197 +188,654 @@ class StataVarVals():
     adds a new variable to the dataset.
     
     """
-    def __init__(self, values):
+    def __init__(self, values, missing=None):
+        """`values` can be any iterable. If `missing` is given, 
+        `values` should be an array of float, and `missing` a 
+        bytearray of missing-value codes, as from `st_data_array`.
+        The values are copied, so the new instance never shares them 
+        with the caller.
+        
+        """
+        if missing is None:
+            given = values
+            values, missing = _to_arrays(values)
+            if values is given:
+                # an array of float without missing values is not copied
+                values = array('d', values)
+        else:
+            values, missing = array('d', values), bytearray(missing)
         self.values = values
+        self.missing = missing
+        
+    def _arrays(self):
+        """Return values and missing-value codes"""
+        return self.values, self.missing
+        
+    def _set_arrays(self, values, missing):
+        """Replace values and missing-value codes (for in-place ops)"""
+        if (isinstance(self.values, array) and isinstance(values, array) 
+                and len(self.values) == len(values)):
+            self.values[:] = values
+        else:
+            self.values = values
+        self.missing = missing
+        
+    def _elementwise(self, op, other, reflected=False):
+        """Apply op to each value, with MissingValue instances in 
+        place of missing values, when arrays cannot be used
+        
+        """
+        func = _OPS[op]
+        if reflected:
+            func = lambda x, y, func=func: func(y, x)
+        if (isinstance(other, collections.Iterable) and 
+                not isinstance(other, str)):
+            result = [func(v, o) for (v,o) in zip(self, other)]
+        else:
+            result = [func(v, other) for v in self]
+        if op in _COMPARISONS:
+            return StataMask(result)
+        return StataVarVals(result)
+    
+    def _binary(self, op, other, reflected=False):
+        """Apply op, one of the keys of _OPS, to values and other, 
+        where other is a scalar or an iterable. With `reflected`, 
+        other is the left operand.
+        
+        """
+        if _is_lazy(other):
+            if op in _COMPARISONS:
+                # comparisons are done right away, giving a StataMask
+                other = _wrap(*other._arrays())
+            else:
+                return StataVarExpr(
+                    op, (other, self) if reflected else (self, other)
+                )
+            
+        values, missing = self._arrays()
+        if not isinstance(values, array):
+            return self._elementwise(op, other, reflected)
+        
+        if isinstance(other, MissingValue) or other is None:
+            if op in _COMPARISONS:
+                other = MISSING.value if other is None else other.value
+            else:
+                n = len(values)
+                return _wrap(
+                    array('d', [MISSING.value]) * n, bytearray([1]) * n
+                )
+            
+        if isinstance(other, int) or isinstance(other, float):
+            other_missing = None
+            n = len(values)
+        elif (isinstance(other, collections.Iterable) and 
+                not isinstance(other, str)):
+            if isinstance(other, StataVarVals):
+                other, other_missing = other._arrays()
+            else:
+                other, other_missing = _to_arrays(other)
+            if not isinstance(other, array):
+                return self._elementwise(op, other, reflected)
+            n = min(len(values), len(other))
+        else:
+            return self._elementwise(op, other, reflected)
+        
+        operands = [values, missing, other, other_missing]
+        if reflected:
+            operands = operands[2:] + operands[:2]
+            
+        if _st_arith is not None:
+            result = array('d', [0.0]) * n
+            codes = bytearray(n)
+            nmiss = _st_arith(op, *(operands + [result, codes]))
+            if op in _COMPARISONS:
+                return _mask_of(result)
+            return _wrap(result, codes if nmiss else None)
+        
+        x, _, y, _ = operands
+        x = repeat(x) if isinstance(x, (int, float)) else x
+        y = repeat(y) if isinstance(y, (int, float)) else y
+        func = _OPS[op]
+        if op in _COMPARISONS:
+            return _mask_of(map(func, x, y))
+        try:
+            result = array('d', map(func, x, y))
+        except (ArithmeticError, TypeError, ValueError):
+            result = array('d', map(_safe(func), x, y))
+        return _wrap(result, _result_codes(result, missing, other_missing))
+        
+    def _unary(self, op, *args):
+        """Apply op to values, with any extra arguments `args`. 
+        Missing values are unchanged.
+        
+        """
+        values, missing = self._arrays()
+        if not isinstance(values, array):
+            return StataVarVals([op(v, *args) for v in self])
+        
+        result = array('d', map(op, values, *(repeat(a) for a in args)))
+        codes = _result_codes(result, missing)
+        if missing is not None:
+            for i in compress(range(len(missing)), missing):
+                result[i] = values[i]
+                codes[i] = missing[i]
+        return _wrap(result, codes)
+        
+    def _inplace(self, op, other):
+        """Apply op, writing the result into the existing values"""
+        result = self._binary(op, other)
+        self._set_arrays(result.values, result.missing)
+        return self
     
     def __setitem__(self, index, value):
-        self.values[index] = value
+        if isinstance(index, StataMask):
+            for i, v in zip(*_masked(index, value, len(self))):
+                self[i] = v
+            return
+        values = self.values
+        if not isinstance(values, array):
+            values[index] = value
+            return
+            
+        if isinstance(index, slice):
+            indices = range(*index.indices(len(values)))
+            value = list(value)
+            if len(value) != len(indices):
+                msg = "need iterable of length {}, got length {}"
+                raise ValueError(msg.format(len(indices), len(value)))
+            for i, v in zip(indices, value):
+                self[i] = v
+            return
+        
+        if value is None:
+            value = MISSING
+        if isinstance(value, MissingValue):
+            values[index] = value.value
+            code = value.index + 1
+        else:
+            values[index] = value
+            code = 0
+            if not _MIN_VALUE <= values[index] <= _MAX_VALUE:
+                values[index] = MISSING.value
+                code = 1
+        if code and self.missing is None:
+            self.missing = bytearray(len(values))
+        if self.missing is not None:
+            self.missing[index] = code
         
     def __getitem__(self, index):
-        return self.values[index]
+        if isinstance(index, StataMask):
+            return [self[i] for i in index.indices()]
+        values, missing = self._arrays()
+        if missing is None or not isinstance(values, array):
+            if isinstance(index, slice):
+                return list(values[index])
+            return values[index]
+        if isinstance(index, slice):
+            return [MISSING_VALS[m - 1] if m else v 
+                    for (v,m) in zip(values[index], missing[index])]
+        m = missing[index]
+        return MISSING_VALS[m - 1] if m else values[index]
             
     def __abs__(self):
-        return StataVarVals([abs(v) for v in self.values])
+        return self._unary(abs)
         
     def __add__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v + o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v + other for v in self.values])
+        return self._binary("+", other)
+        
+    def __and__(self, other):
+        return StataMask(self) & other
         
     def __bool__(self):
-        return StataVarVals([bool(v) for v in self.values])
+        if len(self) == 0:
+            raise ValueError(
+                "truth value of empty StataVarVals is ambiguous; "
+                "use len() to check for values"
+            )
+        if len(self) != 1:
+            raise ValueError(
+                "truth value of more than one value is ambiguous; "
+                "use StataMask(...).any() or .all()"
+            )
+        return bool(next(iter(self)))
         
     def __eq__(self, other):
-        if isinstance(other, collections.Iterable):
-            values = self.values
-            return StataVarVals(
-                [values[i] == other[i] for i in range(len(self))]
-            )
-        return StataVarVals([v == other for v in self.values])
+        return self._binary("==", other)
         
     def __float__(self):
-        return StataVarVals([float(v) for v in self.values])
+        return StataVarVals([float(v) for v in self])
         
     def __floordiv__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v // o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v // other for v in self.values])
+        return self._binary("//", other)
         
     def __ge__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v >= o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v >= other for v in self.values])
+        return self._binary(">=", other)
         
     def __gt__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v > o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v > other for v in self.values])
+        return self._binary(">", other)
         
     def __iadd__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v + o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v + other for v in self.values]
-        return self
+        return self._inplace("+", other)
         
     def __ifloordiv__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v // o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v // other for v in self.values]
-        return self
+        return self._inplace("//", other)
         
     def __imod__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v % o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v % other for v in self.values]
-        return self
+        return self._inplace("%", other)
         
     def __imul__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v * o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v * other for v in self.values]
-        return self
+        return self._inplace("*", other)
         
     def __int__(self):
-        return StataVarVals([int(v) for v in self.values])
+        return StataVarVals([int(v) for v in self])
+        
+    def __invert__(self):
+        return ~StataMask(self)
         
     def __ipow__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v ** o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v ** other for v in self.values]
-        return self
+        return self._inplace("**", other)
         
     def __isub__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v - o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v - other for v in self.values]
-        return self
+        return self._inplace("-", other)
         
     def __iter__(self):
-        values = self.values
-        for v in values:
-            yield v
+        values, missing = self._arrays()
+        if missing is None or not isinstance(values, array):
+            for v in values:
+                yield v
+        else:
+            for v, m in zip(values, missing):
+                yield MISSING_VALS[m - 1] if m else v
         
     def __itruediv__(self, other):
-        if isinstance(other, collections.Iterable):
-            self.values = [v / o for (v,o) in zip(self.values, other)]
-        else:
-            self.values = [v / other for v in self.values]
-        return self
+        return self._inplace("/", other)
         
     def __le__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v <= o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v <= other for v in self.values])
+        return self._binary("<=", other)
         
     def __len__(self):
         return len(self.values)
         
     def __lt__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v < o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v < other for v in self.values])
+        return self._binary("<", other)
         
     def __mod__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v % o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v % other for v in self.values])
+        return self._binary("%", other)
         
     def __mul__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v * o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v * other for v in self.values])
+        return self._binary("*", other)
         
     def __ne__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v != o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v != other for v in self.values])
+        return self._binary("!=", other)
         
     def __neg__(self):
-        return StataVarVals([-v for v in self.values])
+        return self._binary("*", -1.0)
+        
+    def __or__(self, other):
+        return StataMask(self) | other
         
     def __pos__(self):
         return self
         
     def __pow__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v ** o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v ** other for v in self.values])
+        return self._binary("**", other)
         
     def __radd__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o + v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other + v for v in self.values])
+        return self._binary("+", other, reflected=True)
+        
+    def __rand__(self, other):
+        return StataMask(self) & other
         
     def __rfloordiv__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o // v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other // v for v in self.values])
+        return self._binary("//", other, reflected=True)
         
     def __rmod__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o % v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other % v for v in self.values])
+        return self._binary("%", other, reflected=True)
         
     def __rmul__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o * v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other * v for v in self.values])
+        return self._binary("*", other, reflected=True)
+        
+    def __ror__(self, other):
+        return StataMask(self) | other
         
     def __round__(self, n=None):
-        return StataVarVals([round(v, n) for v in self.values])
+        return self._unary(round, n)
         
     def __rpow__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o ** v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other ** v for v in self.values])
+        return self._binary("**", other, reflected=True)
         
     def __rsub__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o - v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other - v for v in self.values])
+        return self._binary("-", other, reflected=True)
         
     def __rtruediv__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([o / v for (v,o) in zip(self.values, other)])
-        return StataVarVals([other / v for v in self.values])
+        return self._binary("/", other, reflected=True)
+        
+    def __rxor__(self, other):
+        return StataMask(self) ^ other
         
     def __sub__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v - o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v - other for v in self.values])
+        return self._binary("-", other)
         
     def __truediv__(self, other):
-        if isinstance(other, collections.Iterable):
-            return StataVarVals([v / o for (v,o) in zip(self.values, other)])
-        return StataVarVals([v / other for v in self.values])
+        return self._binary("/", other)
+        
+    def __xor__(self, other):
+        return StataMask(self) ^ other
+        
+    
+_TO_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+_TO_FLAGS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def _mask_of(flags):
+    """Make StataMask from an iterable of bool or of numbers, with any 
+    number other than 0 counted as true, as in Stata. A bytes object is
+    taken to hold only 0 and 1 already.
+    
+    """
+    mask = StataMask.__new__(StataMask)
+    if not isinstance(flags, bytes):
+        flags = bytes(map(bool, flags))
+    mask._set_flags(flags)
+    return mask
+
+
+def _masked(mask, value, n):
+    """Positions selected by StataMask `mask` of n values, and the 
+    values to assign there: `value` repeated if it is a single value,
+    the values at the selected positions if it has n values, or 
+    `value` itself if it has one value per selected position
+    
+    """
+    if len(mask) != n:
+        raise ValueError("mask has length {}, need {}".format(len(mask), n))
+    indices = mask.indices()
+    if isinstance(value, str) or not isinstance(value, collections.Iterable):
+        return indices, repeat(value, len(indices))
+    if not hasattr(value, "__len__"):
+        value = list(value)
+    if len(value) == n != len(indices):
+        if isinstance(value, StataVarVals):
+            return indices, value[mask]
+        return indices, [value[i] for i in indices]
+    if len(value) != len(indices):
+        msg = "need iterable of length {} or {}, got length {}"
+        raise ValueError(msg.format(len(indices), n, len(value)))
+    return indices, value
+
+
+class StataMask(StataVarVals):
+    """True/false values, one bit each, as given by comparisons of 
+    StataVarVals, StataVariable, and StataVarExpr (e.g., `src.mpg_ > 30`).
+    
+    Masks combine with `&`, `|`, `^`, and `~`, each a single operation
+    on the packed bits, and can select observations, as with 
+    `src.price_[mask] = 0` or `st_view(mask)`. In arithmetic, a mask 
+    acts as values of 1 and 0, as comparisons do in Stata. 
+    
+    """
+    def __init__(self, flags):
+        """`flags` can be any iterable. As in Stata, values other than 
+        0 (including missing values) are true. Strings are true if not 
+        empty.
+        
+        """
+        if isinstance(flags, StataMask):
+            self._set_flags(flags._flags())
+        elif isinstance(flags, StataVarVals):
+            self._set_flags(bytes(map(bool, flags._arrays()[0])))
+        else:
+            self._set_flags(bytes(map(bool, flags)))
+        
+    def _set_flags(self, flags):
+        """Pack bytes of 0 and 1, the first value in the lowest bit"""
+        self.size = len(flags)
+        digits = flags.translate(_TO_DIGITS)[::-1]
+        self.bits = int(digits, 2) if digits else 0
+        
+    def _flags(self):
+        """Unpack bits into bytes of 0 and 1"""
+        if not self.size:
+            return b""
+        digits = format(self.bits, "0{}b".format(self.size)).encode()
+        return digits[::-1].translate(_TO_FLAGS)
+        
+    def _new(self, bits, size=None):
+        mask = StataMask.__new__(StataMask)
+        mask.bits = bits
+        mask.size = self.size if size is None else size
+        return mask
+        
+    def _other_bits(self, other):
+        """Bits of other, a StataMask, something that can be made into
+        one, or a single value (applied to all positions)
+        
+        """
+        if isinstance(other, str) or not isinstance(
+                other, collections.Iterable):
+            return (1 << self.size) - 1 if other else 0
+        if not isinstance(other, StataMask):
+            other = StataMask(other)
+        if len(other) != self.size:
+            msg = "masks have different lengths, {} and {}"
+            raise ValueError(msg.format(self.size, len(other)))
+        return other.bits
+        
+    def _arrays(self):
+        return array('d', list(self._flags())), None
+        
+    def _inplace(self, op, other):
+        return self._binary(op, other)
+        
+    @property
+    def values(self):
+        return self._arrays()[0]
+        
+    @property
+    def missing(self):
+        return None
+        
+    def count(self):
+        """Number of true values"""
+        return bin(self.bits).count("1")
+        
+    def any(self):
+        """Whether any value is true"""
+        return self.bits != 0
+        
+    def all(self):
+        """Whether all values are true"""
+        return self.bits == (1 << self.size) - 1
+        
+    def indices(self):
+        """Positions of true values, as an array of int"""
+        return array('l', compress(range(self.size), self._flags()))
+        
+    def __and__(self, other):
+        return self._new(self.bits & self._other_bits(other))
+        
+    def __or__(self, other):
+        return self._new(self.bits | self._other_bits(other))
+        
+    def __xor__(self, other):
+        return self._new(self.bits ^ self._other_bits(other))
+        
+    def __invert__(self):
+        return self._new(self.bits ^ ((1 << self.size) - 1))
+        
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+    
+    def __iter__(self):
+        return map(bool, self._flags())
+        
+    def __len__(self):
+        return self.size
         
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            if step == 1:
+                size = max(stop - start, 0)
+                return self._new((self.bits >> start) & ((1 << size) - 1), 
+                                 size)
+            return _mask_of(self._flags()[index])
+        if isinstance(index, StataMask):
+            return _mask_of(compress(self._flags(), index._flags()))
+        if not isinstance(index, int):
+            raise TypeError("index must be slice, StataMask, or int")
+        if not -self.size <= index < self.size:
+            raise IndexError("mask index out of range")
+        return bool((self.bits >> (index % self.size)) & 1)
+        
+    def __setitem__(self, index, value):
+        raise TypeError("StataMask does not support item assignment")
+        
+    def __repr__(self):
+        return "<StataMask: {} of {} true>".format(self.count(), self.size)
+        
+    
+def _is_lazy(x):
+    """Whether x is evaluated only when its values are needed"""
+    return isinstance(x, StataVariable) or isinstance(x, StataVarExpr)
+    
+    
+def _lazy(func):
+    """Decorator for functions taking StataVarVals, such as those in
+    stata_math, so that calling them with a StataVariable or StataVarExpr 
+    argument gives a StataVarExpr instead of evaluating immediately
+    
+    """
+    @functools.wraps(func)
+    def lazy_func(*args, **kwargs):
+        if any(_is_lazy(a) for a in args):
+            if kwargs:
+                return StataVarExpr(functools.partial(func, **kwargs), args)
+            return StataVarExpr(func, args)
+        return func(*args, **kwargs)
+    return lazy_func
+    
+    
+def _chunk_of(x, start, stop, cache):
+    """Values of StataVariable, StataVarExpr, or StataVarVals x in
+    positions start to stop, as StataVarVals; other x are returned as 
+    is. Variables already read for this chunk are taken from cache.
+    
+    """
+    if isinstance(x, StataVarExpr):
+        return x._chunk(start, stop, cache)
+    if isinstance(x, StataMask):
+        return x[start:stop]
+    if isinstance(x, StataVariable):
+        key = (id(x.source), x.name)
+        if key not in cache:
+            cache[key] = x._chunk(start, stop)
+        return cache[key]
+    if isinstance(x, StataVarVals):
+        values, missing = x._arrays()
+        if missing is not None:
+            missing = missing[start:stop]
+        return _wrap(values[start:stop], missing)
+    return x
+    
+    
+class StataVarExpr(StataVarVals):
+    """A class for lazily evaluated calculations with data variables 
+    within a Dta object or in Stata.
     
+    Operators on a StataVariable, and stata_math functions called with
+    one, give a StataVarExpr, which records the calculation instead of
+    doing it. Further operators on a StataVarExpr extend the recorded
+    calculation. Values are calculated only when the result is assigned
+    to a variable (as in `src.target_ = expr`), or when values are 
+    otherwise requested, e.g., with `expr.values` or `list(expr)`. The 
+    calculation is done in chunks of `chunk_size` observations, reading 
+    each variable once per chunk, so that intermediate results never 
+    take more memory than one chunk, however long the expression. 
+    
+    Values are calculated from the data at the time they are requested,
+    so changes to the variables in between are reflected in the result.
+    
+    This class is meant for internal use.
+    
+    """
+    chunk_size = 65536
+    
+    def __init__(self, func, args):
+        """`func` is an operator (a key of _OPS) applied to two args,
+        or a function that will be called with args, after each 
+        StataVariable, StataVarExpr, and StataVarVals in args has been
+        replaced by a chunk of its values, as StataVarVals
+        
+        """
+        self.func = func
+        self.args = args
+        
+    def _chunk(self, start, stop, cache):
+        """Calculate values in positions start to stop, as StataVarVals"""
+        args = [_chunk_of(a, start, stop, cache) for a in self.args]
+        if callable(self.func):
+            return self.func(*args)
+        left, right = args
+        if isinstance(left, StataVarVals):
+            return left._binary(self.func, right)
+        return right._binary(self.func, left, reflected=True)
+        
+    def _chunks(self):
+        """Iterate over (start position, StataVarVals) for each chunk"""
+        n = len(self)
+        size = self.chunk_size
+        for start in range(0, n, size):
+            yield start, self._chunk(start, min(start + size, n), {})
+            
+    def _arrays(self):
+        """Calculate all values; return values and missing-value codes"""
+        values = None
+        missing = bytearray()
+        any_missing = False
+        for start, chunk in self._chunks():
+            chunk_values, chunk_missing = chunk._arrays()
+            if values is None:
+                values = chunk_values
+            else:
+                values.extend(chunk_values)
+            if chunk_missing is None:
+                missing.extend(bytes(len(chunk_values)))
+            else:
+                missing.extend(chunk_missing)
+                any_missing = True
+        if values is None:
+            values = array('d')
+        return values, (missing if any_missing else None)
+        
+    def _binary(self, op, other, reflected=False):
+        if op in _COMPARISONS:
+            # comparisons are done right away, giving a StataMask
+            return _wrap(*self._arrays())._binary(op, other, reflected)
+        return StataVarExpr(op, (other, self) if reflected else (self, other))
+        
+    def _unary(self, op, *args):
+        return StataVarExpr(op, (self,) + args)
+        
+    def _inplace(self, op, other):
+        return self._binary(op, other)
+        
+    @property
+    def values(self):
+        return self._arrays()[0]
+        
+    @property
+    def missing(self):
+        return self._arrays()[1]
+        
+    def __len__(self):
+        for a in self.args:
+            if isinstance(a, StataVarVals):
+                return len(a)
+        return 0
+        
+        
 class StataVariable(StataVarVals):
     """A class for referencing a data variable within a Dta object or in
     Stata. Class instances are created when the user accesses a variable
@@ -233,23 +852,78 @@ class StataVariable(StataVarVals):
         self.source = source
         self.name = name
         
-    @property
-    def values(self):
+    def _arrays(self):
+        """Return values and missing-value codes, using the source's
+        `_column` method if it has one
+        
+        """
+        src = self.source
+        c = src.index(self.name)
+        if hasattr(src, "_column"):
+            return src._column(c)
+        get = src.get
+        return _to_arrays([get(r,c) for r in range(len(src))])
+        
+    def _chunk(self, start, stop):
+        """Return values in observations start to stop, as StataVarVals"""
         src = self.source
+        c = src.index(self.name)
+        if hasattr(src, "_column"):
+            return _wrap(*src._column(c, range(start, stop)))
         get = src.get
+        return StataVarVals([get(r,c) for r in range(start, stop)])
+        
+    def _store(self, vals):
+        """Replace values in the source with those of StataVarVals vals,
+        using the source's `_store_column` method if it has one. 
+        A StataVarExpr is stored chunk by chunk.
+        
+        """
+        src = self.source
         c = src.index(self.name)
-        return [get(r,c) for r in range(len(src))]
+        if not hasattr(src, "_store_column"):
+            src[:, c] = list(vals)
+        elif isinstance(vals, StataVarExpr):
+            for start, chunk in vals._chunks():
+                src._store_column(c, *chunk._arrays(), obsnums=start)
+        else:
+            src._store_column(c, *vals._arrays())
+            
+    def _binary(self, op, other, reflected=False):
+        if op in _COMPARISONS:
+            # comparisons are done right away, giving a StataMask
+            return _wrap(*self._arrays())._binary(op, other, reflected)
+        return StataVarExpr(op, (other, self) if reflected else (self, other))
+        
+    def _unary(self, op, *args):
+        return StataVarExpr(op, (self,) + args)
+        
+    def _inplace(self, op, other):
+        self._store(self._binary(op, other))
+        return self
+        
+    @property
+    def values(self):
+        return self._arrays()[0]
+        
+    @property
+    def missing(self):
+        return self._arrays()[1]
         
     def __iter__(self):
         src = self.source
-        get = src.get
         c = src.index(self.name)
+        get = src._getter(c) if hasattr(src, "_getter") else src.get
         for r in range(len(src)):
             yield get(r, c)
         
     def __setattr__(self, name, value):
         if name == "values":
             src = self.source
+            if getattr(src, "_changed", None) is not None:
+                # StataMirror writing only changed values
+                setattr(src, self.name + "_", value)
+                return
             c = src.index(self.name)
             src[:, c] = value
         else:
@@ -257,16 +931,38 @@ class StataVariable(StataVarVals):
     
     def __setitem__(self, index, value):
         src = self.source
-        src[index, src.index(self.name)] = value
+        if isinstance(index, StataMask):
+            c = src.index(self.name)
+            indices, value = _masked(index, value, len(src))
+            if not indices:
+                return
+            if hasattr(src, "_store_column"):
+                src._store_column(c, list(value), None, indices)
+            else:
+                for i, v in zip(indices, value):
+                    src[i, c] = v
+            return
+        if isinstance(index, int) and hasattr(src, "_set"):
+            src._set(index, src.index(self.name), value)
+        else:
+            src[index, src.index(self.name)] = value
         
     def __getitem__(self, index):
         src = self.source
-        get = src.get
         c = src.index(self.name)
+        get = src._getter(c) if hasattr(src, "_getter") else src.get
     
         if isinstance(index, int):
             return get(index, c)
             
+        if isinstance(index, StataMask):
+            if len(index) != len(src):
+                msg = "mask has length {}, need {}"
+                raise ValueError(msg.format(len(index), len(src)))
+            index = index.indices()
+            if hasattr(src, "_column"):
+                return list(_wrap(*src._column(c, index)))
+            
         if isinstance(index, slice):
             start, stop, step = index.indices(len(src))
             index = range(start, stop, step)
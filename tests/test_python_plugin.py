@@ -2,11 +2,13 @@ import unittest
 import sys
 import random
 from types import GeneratorType
+from array import array
 
-from stata_missing import MISSING_VALS as mvs
-from stata_variable import StataVariable, StataVarVals
-from stata import StataMatrix
+from stata_missing import MissingValue, MISSING_VALS as mvs
+from stata_variable import StataVariable, StataVarVals, StataVarExpr, StataMask
+from stata import StataMatrix, _st_varindex_stats, _data_context
 from stata_math import *
+from stata_string import *
 
 
 def makeCapture(parent):
@@ -33,6 +35,17 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertEqual(st_cols("matA"), 4)
         self.assertEqual(st_cols("noSuchMatrix"), 0)
         
+    def test__data_context(self):
+        context = _data_context()
+        self.assertEqual(context.nobs, st_nobs())
+        self.assertEqual(context.nvar, st_nvar())
+        self.assertEqual((context.in1, context.in2), (1, 74))
+        self.assertEqual(
+            [bool(t) for t in context.isstr], 
+            [st_isstrvar(i) for i in range(12)]
+        )
+        self.assertTrue(_data_context() is context)
+        
     def test__st_data(self):
         self.assertRaises(TypeError, _st_data, 0, 1, 0) # too many arguments
         self.assertRaises(TypeError, _st_data, 0) # too few arguments
@@ -48,6 +61,7 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertEqual(_st_data(-1, 1), 11995)
         self.assertEqual(_st_data(0, -1), 0)
         self.assertEqual(_st_data(-1, -1), 1)
+        self.assertIs(_st_data(2, 3), mvs[0]) # missing values are shared objects
         
     def test_st_data(self):
         self.assertRaises(TypeError, st_data, "4", "pr") # 1st arg should be int or iterable of int
@@ -110,7 +124,66 @@ class TestSmallFuncs(unittest.TestCase):
              [97.0, 7140.0, 12.0],
              [121.0, 3799.0, 12.0],
              [258.0, 4749.0, 11.0]])
-        
+
+    def test_st_data_array(self):
+        self.assertRaises(TypeError, st_data_array, 0) # "make" is not numeric
+        self.assertRaises(TypeError, st_data_array, "ma") # "make" is not numeric
+        self.assertRaises(TypeError, st_data_array, None) # var should be int or str
+        self.assertRaises(TypeError, st_data_array, 1, "4") # obs should be int or iterable of int
+        self.assertRaises(IndexError, st_data_array, 12) # var num out of range
+        self.assertRaises(IndexError, st_data_array, 1, 74) # obs num out of range
+        self.assertRaises(IndexError, st_data_array, 1, (0, -75)) # obs num out of range
+
+        values, missing = st_data_array("pr")
+        self.assertEqual(list(values), [row[1] for row in self.data])
+        self.assertEqual(missing, bytearray(74))
+
+        values, missing = st_data_array(3, range(0, 74, 2))
+        self.assertEqual(
+            [mvs[m - 1] if m else v for v, m in zip(values, missing)],
+            [row[3] for row in self.data[::2]]
+        )
+        self.assertEqual(missing[1], 1) # rep78 of obs 2 is .
+
+        self.assertEqual(st_data_array(1, slice(None, None, -5))[0].tolist(),
+                         [row[1] for row in self.data[::-5]])
+        self.assertEqual(st_data_array(1, (8, -5, 2))[0].tolist(),
+                         [10372.0, 7140.0, 3799.0])
+
+        # extended missing values keep their values and codes
+        old = [row[3] for row in self.data[:3]]
+        st_store(range(3), 3, [[mvs[1]], [mvs[2]], [mvs[26]]])
+        values, missing = st_data_array(3, range(3))
+        self.assertEqual(list(values), [mvs[1].value, mvs[2].value, mvs[26].value])
+        self.assertEqual(list(missing), [2, 3, 27])
+        st_store(range(3), 3, [[v] for v in old])
+        self.assertEqual(st_data(range(3), 3), [[v] for v in old])
+
+    def test_st_data_block(self):
+        self.assertRaises(TypeError, st_data_block, 0, "ma") # "make" is not numeric
+        self.assertRaises(TypeError, st_data_block, 0, (1, 0)) # "make" is not numeric
+        self.assertRaises(TypeError, st_data_block, 0, None) # vars should be int, str, or iterable
+        self.assertRaises(TypeError, st_data_block, "4", 1) # obs should be int or iterable of int
+        self.assertRaises(IndexError, st_data_block, 0, 12) # var num out of range
+        self.assertRaises(IndexError, st_data_block, (0, 74), 1) # obs num out of range
+
+        rows = range(0, 74, 5)
+        cols = (1, 2, 3, -1)
+        values, missing = st_data_block(rows, ("pr", "mpg rep78", -1))
+        self.assertEqual(
+            [mvs[m - 1] if m else v for v, m in zip(values, missing)],
+            [row[j] for row in self.data[::5] for j in cols]
+        )
+
+        values, missing = st_data_block(slice(None, None, 5), cols, True)
+        self.assertEqual(
+            [mvs[m - 1] if m else v for v, m in zip(values, missing)],
+            [row[j] for j in cols for row in self.data[::5]]
+        )
+
+        self.assertEqual(st_data_block(None, 1)[0].tolist(),
+                         [row[1] for row in self.data])
+
     def test_st_format(self): # not in mata
         self.assertRaises(TypeError, st_format, 1, 1) # 1st arg should be str
         self.assertRaises(TypeError, st_format, "%12.0g", "1") # 2nd arg should be numeric
@@ -243,6 +316,36 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertFalse(st_ismissing('blah')) # non-numerical are not missing
         self.assertFalse(st_ismissing({})) # non-numerical are not missing
         
+    def test_missing_values(self): # not in mata
+        import stata_plugin
+        self.assertIs(MissingValue, stata_plugin.MissingValue)
+        self.assertIs(MissingValue(3), mvs[3])
+        self.assertRaises(ValueError, MissingValue, 27)
+        
+        self.assertEqual([str(m) for m in mvs[:3]], ['.', '.a', '.b'])
+        self.assertTrue(0 < 8.9e307 < mvs[0] < mvs[1] < mvs[26])
+        self.assertEqual(mvs[2], mvs[2].value)
+        self.assertEqual(hash(mvs[2]), hash(mvs[2].value))
+        self.assertEqual(sorted([mvs[5], 1, mvs[0]]), [1, mvs[0], mvs[5]])
+        
+        for m in (mvs[0], mvs[12]):
+            self.assertIs(m + 1, mvs[0])
+            self.assertIs(2 * m, mvs[0])
+            self.assertIs(1 / m, mvs[0])
+            self.assertIs(m ** 2, mvs[0])
+            self.assertIs(-m, mvs[0])
+            self.assertIs(abs(m), m)
+            self.assertIs(round(m), m)
+            self.assertEqual(divmod(m, 3), (mvs[0], mvs[0]))
+            self.assertTrue(m)
+        
+        # copies and pickles give the same instances
+        import copy, pickle
+        self.assertIs(copy.copy(mvs[1]), mvs[1])
+        self.assertEqual(copy.deepcopy([mvs[0], mvs[26], 1]), [mvs[0], mvs[26], 1])
+        self.assertIs(copy.deepcopy([mvs[26]])[0], mvs[26])
+        self.assertIs(pickle.loads(pickle.dumps(mvs[3])), mvs[3])
+        
     def test_st_isname(self):
         letters = list('_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
         numbers = list('0123456789')
@@ -311,6 +414,11 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertFalse(st_isnumvar(0))
         self.assertFalse(st_isnumvar("ma"))
         
+        # variables 0 and 1 give the same result by name and by index
+        self.assertEqual((st_isnumvar("make"), st_isnumvar(0)), (False, False))
+        self.assertEqual((st_isnumvar("price"), st_isnumvar(1)), (True, True))
+        self.assertTrue(st_isnumvar("foreign") and st_isnumvar(-1))
+        
     def test_st_isstrfmt(self):
         # str_fmt_re = re.compile(r'^%(-|~)?(0)?([0-9]+)s$')
         # any testing here is inferior to simply checking the regular expression 
@@ -341,6 +449,11 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertFalse(st_isstrvar(9))
         self.assertFalse(st_isstrvar("disp"))
         
+        # variables 0 and 1 give the same result by name and by index
+        self.assertEqual((st_isstrvar("make"), st_isstrvar(0)), (True, True))
+        self.assertEqual((st_isstrvar("price"), st_isstrvar(1)), (False, False))
+        self.assertFalse(st_isstrvar("foreign") or st_isstrvar(-1))
+        
     def test_st_isvarname(self): # not in mata
         reserved = frozenset(('_all', '_b', 'byte', '_coef', '_cons', 
             'double', 'float', 'if', 'in', 'int', 'long', '_n', '_N',
@@ -490,6 +603,22 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertEqual(st_sdata(range(12), (-12, "ma ma")), tripleOutput)
         self.assertEqual(st_sdata(range(12), (-12, "ma", "ma")), tripleOutput)
         
+    def test_st_sdata_list(self):
+        self.assertRaises(TypeError, st_sdata_list, "pr") # "price" is not string
+        self.assertRaises(TypeError, st_sdata_list, None) # var should be int or str
+        self.assertRaises(TypeError, st_sdata_list, 0, "4") # obs should be int or iterable of int
+        self.assertRaises(IndexError, st_sdata_list, 12) # var num out of range
+        self.assertRaises(IndexError, st_sdata_list, 0, (0, 74)) # obs num out of range
+        
+        self.assertEqual(st_sdata_list("ma"), [row[0] for row in self.data])
+        self.assertEqual(st_sdata_list(0, range(0, 74, 3)), 
+                         [row[0] for row in self.data[::3]])
+        self.assertEqual(st_sdata_list(0, (0, -1)), ["AMC Concord", "Volvo 260"])
+        
+        # repeated values share one object
+        values = st_sdata_list(0, [1, 2, 1])
+        self.assertIs(values[0], values[2])
+        
     def test__st_sstore(self):
         self.assertRaises(TypeError, _st_sstore, 0, 0) # too few arguemtns
         self.assertRaises(TypeError, _st_sstore, 0, 0, 0, 0) # too many arguemtns
@@ -548,6 +677,28 @@ class TestSmallFuncs(unittest.TestCase):
         # test the replacement
         self.assertEqual(st_sdata(range(74), 0), [[row[0]] for row in self.data])
         
+    def test_st_sstore_list(self):
+        self.assertRaises(TypeError, st_sstore_list, "pr", ["blah"]) # "price" is not string
+        self.assertRaises(TypeError, st_sstore_list, None, ["blah"]) # var should be int or str
+        self.assertRaises(TypeError, st_sstore_list, 0, ["blah", 1]) # values should be str
+        self.assertRaises(IndexError, st_sstore_list, 12, ["blah"]) # var num out of range
+        self.assertRaises(IndexError, st_sstore_list, 0, ["blah", "blah"], 73) # obs num out of range
+        self.assertRaises(ValueError, st_sstore_list, 0, ["blah"], range(2)) # length mismatch
+        
+        # set values
+        st_sstore_list(0, [str(i) for i in range(12)])
+        st_sstore_list("ma", ["a", "b"] * 6, -12)
+        
+        # test
+        self.assertEqual(st_sdata(range(12), 0), [[str(i)] for i in range(12)])
+        self.assertEqual(st_sdata(range(62,74), 0), [["a"], ["b"]] * 6)
+        
+        # replace
+        st_sstore_list(0, (row[0] for row in self.data))
+        
+        # test the replacement
+        self.assertEqual(st_sdata(range(74), 0), [[row[0]] for row in self.data])
+        
     def test__st_store(self):
         self.assertRaises(TypeError, _st_store, 0, 1, 0, 0) # too many arguments
         self.assertRaises(TypeError, _st_store, 0, 1) # too few arguments
@@ -617,8 +768,46 @@ class TestSmallFuncs(unittest.TestCase):
         # test the replacement
         self.assertEqual(st_data(range(74), (1, "mpg rep", 4, "tr")),
             [row[1:6] for row in self.data])
+        
+        # a bad value in an iterator of rows, here in the second 
+        # column, is caught before any column of its block is written
+        rows = iter([(1.0, 2.0)] * 3 + [(5.0, "bad")] + [(1.0, 2.0)] * 6)
+        self.assertRaisesRegex(TypeError, "first 0 rows were written",
+                               st_store, range(10), ("price", "mpg"), rows)
+        self.assertEqual(st_data(range(10), ("price", "mpg")),
+                         [row[1:3] for row in self.data[:10]])
         self.assertEqual(st_data(range(74), 11), [[row[11]] for row in self.data])
         
+    def test_st_store_array(self):
+        self.assertRaises(TypeError, st_store_array, "ma", array('d', [1])) # "make" is not numeric
+        self.assertRaises(TypeError, st_store_array, None, array('d', [1])) # var should be int or str
+        self.assertRaises(TypeError, st_store_array, 1, array('u', "ab")) # values should be numeric
+        self.assertRaises(TypeError, st_store_array, 1, [1, "a"]) # values should be numeric
+        self.assertRaises(IndexError, st_store_array, 12, array('d', [1])) # var num out of range
+        self.assertRaises(IndexError, st_store_array, 1, array('d', [1, 2]), 73) # obs num out of range
+        self.assertRaises(ValueError, st_store_array, 1, array('d', [1, 2]), range(3)) # length mismatch
+        self.assertRaises(ValueError, st_store_array, 1, array('d', [1]), 0, bytearray([28])) # bad missing code
+
+        # set values
+        st_store_array("pr", array('d', range(74)))
+        st_store_array(2, array('i', range(10, 20)), 10)
+        st_store_array(-1, array('d', [0.0] * 27), missing=bytearray(range(1, 28)))
+        st_store_array(3, [1.5, None, mvs[5]], [-1, 0, 1])
+
+        # test
+        self.assertEqual(st_data(range(74), 1), [[i] for i in range(74)])
+        self.assertEqual(st_data(range(10, 20), 2), [[i] for i in range(10, 20)])
+        self.assertEqual(st_data(range(27), 11), [[mv] for mv in mvs])
+        self.assertEqual(st_data((73, 0, 1), 3), [[1.5], [mvs[0]], [mvs[5]]])
+
+        # replace
+        for j in (1, 2, 3, 11):
+            st_store_array(j, [row[j] for row in self.data])
+
+        # test the replacement
+        self.assertEqual(st_data(range(74), (1, 2, 3, 11)),
+            [[row[j] for j in (1, 2, 3, 11)] for row in self.data])
+
     def test_st_varindex(self):
         self.assertRaises(TypeError, st_varindex, 0) # should be str
         self.assertRaises(ValueError, st_varindex, 'm', 1) # ambiguous
@@ -635,6 +824,25 @@ class TestSmallFuncs(unittest.TestCase):
         self.assertTrue(all(st_varindex(x, 1) == i for x,i in zip(abbrevs, range(12))))
         self.assertTrue(all(st_varindex(x, True) == i for x,i in zip(abbrevs, range(12))))
         
+    def test__st_varindex_stats(self): # not in mata
+        self.assertRaises(TypeError, _st_varindex_stats, 0) # no arguments allowed
+        
+        stats = _st_varindex_stats()
+        self.assertEqual(stats["nvars"], st_nvar())
+        self.assertTrue(stats["bytes"] > 0)
+        self.assertTrue(stats["build_time"] >= 0)
+        self.assertTrue(stats["builds"] >= 1) # index was built at least once
+        
+        # each name looked up is a hit if found, a miss otherwise
+        st_varindex("price")
+        st_varindex("price")
+        after = _st_varindex_stats()
+        self.assertEqual(after["hits"], stats["hits"] + 2)
+        self.assertEqual(after["misses"], stats["misses"])
+        self.assertRaises(ValueError, st_varindex, "nosuchvar")
+        self.assertEqual(_st_varindex_stats()["misses"], after["misses"] + 1)
+        self.assertEqual(_st_varindex_stats()["builds"], stats["builds"])
+        
     def test_st_varname(self):
         self.assertRaises(TypeError, st_varname, "m") # should be int
         self.assertRaises(TypeError, st_varname, 1.2) # should be int
@@ -645,6 +853,7 @@ class TestSmallFuncs(unittest.TestCase):
                    'weight', 'length', 'turn', 'displacement', 'gear_ratio', 
                    'foreign']
         self.assertEqual(names, [st_varname(i) for i in range(st_nvar())])
+        self.assertEqual(names, [st_varname(i) for i in range(-st_nvar(), 0)])
       
     @classmethod
     def tearDownClass(cls):        
@@ -967,6 +1176,7 @@ class TestMatrix(unittest.TestCase):
         self.assertRaises(ValueError, setItem, ((1,2,3),(1,2)), [[2, 2, 2]*2] ) # 2nd arg not right shape
         self.assertRaises(ValueError, setItem, ((1,2,3),(1,2)), [2] ) # 2nd arg not right shape
         self.assertRaises(ValueError, setItem, ((1,2,3),(1,2)), [[2,2,2,2,2,2]] ) # 2nd arg not right shape
+        self.assertRaises(TypeError, setItem, (slice(None), 0), st_view(range(7), 0)) # "make" is not numeric
     
         m2 = st_matrix("matB")
         
@@ -1074,15 +1284,23 @@ class TestView(unittest.TestCase):
             if not st_ismissing(_st_data(x,3))
         )
         
-        self.assertEqual(st_view(selectvar=None)._rownums, nonmiss_rep)
-        self.assertEqual(st_view(selectvar=mvs[0])._rownums, nonmiss_rep)
-        self.assertEqual(st_view(selectvar=mvs[8])._rownums, nonmiss_rep)
+        self.assertEqual(st_view(selectvar=None).rows, nonmiss_rep)
+        self.assertEqual(st_view(selectvar=mvs[0]).rows, nonmiss_rep)
+        self.assertEqual(st_view(selectvar=mvs[8]).rows, nonmiss_rep)
         
         self.assertEqual(
-            st_view(range(0,74,10), selectvar=mvs[8])._rownums,
+            st_view(range(0,74,10), selectvar=mvs[8]).rows,
             (0, 10, 20, 30, 40, 60, 70)  # `rep78` is missing in obs 50
         )
         
+        # rows and columns are kept as ranges where possible
+        self.assertEqual(st_view()._rownums, range(74))
+        self.assertEqual(st_view(range(0, 74, 2))._rownums, range(0, 74, 2))
+        self.assertEqual(st_view(range(-2, 0))._rownums, array('l', [72, 73]))
+        self.assertEqual(st_view((3, -1, 3))._rownums, array('l', [3, 73, 3]))
+        self.assertEqual(st_view((3, -1, 3))._nobs, 2)
+        self.assertRaises(IndexError, st_view, range(70, 75))
+        
     def test___init__(self):
         self.assertEqual(self.v._nrows, 74)
         self.assertEqual(self.v._nobs, 74)
@@ -1091,8 +1309,8 @@ class TestView(unittest.TestCase):
         self.assertEqual(self.v._getters, [_st_sdata] + [_st_data]*11)
         self.assertEqual(self.v._setters, [_st_sstore] + [_st_store]*11)
         self.assertEqual(self.v._formats, ["%11s"] + ["%9.0g"]*11)
-        self.assertEqual(self.v._rownums, tuple(range(74)))
-        self.assertEqual(self.v._colnums, tuple(range(12)))
+        self.assertEqual(self.v._rownums, range(74))
+        self.assertEqual(self.v._colnums, range(12))
         
         newView = self.v[::2, ::2]
         self.assertEqual(newView._nrows, 37)
@@ -1102,8 +1320,8 @@ class TestView(unittest.TestCase):
         self.assertEqual(newView._getters, [_st_sdata] + [_st_data]*5)
         self.assertEqual(newView._setters, [_st_sstore] + [_st_store]*5)
         self.assertEqual(newView._formats, ["%11s"] + ["%9.0g"]*5)
-        self.assertEqual(newView._rownums, tuple(range(0,74,2)))
-        self.assertEqual(newView._colnums, tuple(range(0,12,2)))
+        self.assertEqual(newView._rownums, range(0,74,2))
+        self.assertEqual(newView._colnums, range(0,12,2))
         
         newView = self.v[::4, (0,1,2,0,1,2)]
         self.assertEqual(newView._nrows, 19)
@@ -1113,8 +1331,14 @@ class TestView(unittest.TestCase):
         self.assertEqual(newView._getters, ([_st_sdata] + [_st_data]*2)*2)
         self.assertEqual(newView._setters, ([_st_sstore] + [_st_store]*2)*2)
         self.assertEqual(newView._formats, (["%11s"] + ["%9.0g"]*2)*2)
-        self.assertEqual(newView._rownums, tuple(range(0,74,4)))
-        self.assertEqual(newView._colnums, (0,1,2,0,1,2))
+        self.assertEqual(newView._rownums, range(0,74,4))
+        self.assertEqual(newView._colnums, array('l', (0,1,2,0,1,2)))
+        
+        newView = newView[(2, 0, 2), 1:4]
+        self.assertEqual(newView._rownums, array('l', (8, 0, 8)))
+        self.assertEqual(newView._colnums, array('l', (1, 2, 0)))
+        self.assertEqual(newView._nobs, 2)
+        self.assertEqual(newView._nvar, 3)
         
     def test___iter__(self):
         v = self.v
@@ -1141,8 +1365,69 @@ class TestView(unittest.TestCase):
     def test_list(self):
         pass
         
+    def test_iter_chunks(self):
+        self.assertRaises(TypeError, self.v.iter_chunks, 2.5)
+        self.assertRaises(ValueError, self.v.iter_chunks, 0)
+        
+        for v in (self.v, self.v[::3, ::2], self.v[(5, 1, 5), (3, 0)]):
+            for size in (1, 10, 74, 100):
+                chunks = list(v.iter_chunks(size))
+                self.assertEqual([len(c[0]) for c in chunks[:-1]], 
+                                 [size] * (len(chunks) - 1))
+                rows = [row for c in chunks for row in zip(*c)]
+                self.assertEqual([list(r) for r in rows], v.to_list())
+        
+        chunk = next(self.v.iter_chunks(5))
+        self.assertTrue(isinstance(chunk[0], list))
+        self.assertTrue(isinstance(chunk[1], StataVarVals))
+        
+    def test_store_chunks(self):
+        v = self.v[:, (0, 2)]
+        varCopy = v.to_list()
+        
+        v.store_chunks(
+            [[s + "!" for s in c[0]], c[1] + 1] for c in v.iter_chunks(10)
+        )
+        self.assertEqual(v.to_list(), [[s + "!", x + 1] for s, x in varCopy])
+        
+        # wrong shapes are caught before a block is written
+        chunks = [[["a"] * 10, [1.0] * 10]] * 8
+        self.assertRaisesRegex(ValueError, "first 70 were written",
+                               v.store_chunks, chunks)
+        self.assertRaisesRegex(ValueError, "first 0 rows were written",
+                               v.store_chunks, [[["a"] * 10, [1.0] * 9]])
+        self.assertRaisesRegex(ValueError, "first 0 rows were written",
+                               v.store_chunks, [[["a"] * 10]])
+        self.assertEqual(v.to_list()[69:71], 
+                         [["a", 1.0], [varCopy[70][0] + "!", 
+                                       varCopy[70][1] + 1]])
+        
+        # iterators of rows are written the same way
+        v[:, :] = (row for row in varCopy)
+        self.assertEqual(v.to_list(), varCopy)
+        self.assertRaisesRegex(ValueError, "value has 73 rows",
+                               v.__setitem__, (slice(None),),
+                               iter(varCopy[:-1]))
+        self.assertRaisesRegex(ValueError, "more than 74 rows",
+                               v.__setitem__, (slice(None),),
+                               iter(varCopy + varCopy))
+        v[:, :] = iter(varCopy)
+        self.assertEqual(v.to_list(), varCopy)
+        
+        # so are bad values, with nothing of the bad block written
+        rows = [[s, 1.0] for s, x in varCopy]
+        rows[3][1] = "bad"
+        self.assertRaisesRegex(TypeError, "first 0 rows were written",
+                               v.__setitem__, (slice(None),), iter(rows))
+        self.assertEqual(v.to_list(), varCopy)
+        chunks = [[["a"] * 10, [1.0] * 10]] * 7 + [[["a"] * 4, [1.0] * 3 + ["b"]]]
+        self.assertRaisesRegex(TypeError, "first 70 rows were written",
+                               v.store_chunks, chunks)
+        self.assertEqual(v.to_list()[70:], varCopy[70:])
+        v[:, :] = iter(varCopy)
+        
     def test_to_list(self):
-        self.assertEqual(self.v[::6,::4].to_list(), 
+        self.assertEqual(self.v[::6,::4].to_list(),
             [['AMC Concord', 2.5, 40.0], 
              ['Buick Opel', 3.0, 34.0], 
              ['Cad. Seville', 3.0, 45.0], 
@@ -1577,12 +1862,213 @@ class TestMirror(unittest.TestCase):
         
         mpg = self.m.length_ + self.m.weight_
         self.assertEqual(
-            list(mpg.values),
+            mpg.values,
             (self.m.length_ + self.m.weight_).values
         )
         
         self.m.mpg_ = backup
         
+    def test_StataVarVals(self):
+        vals = StataVarVals([1, 2.5, None, mvs[3], -4])
+        self.assertTrue(isinstance(vals.values, array))
+        self.assertEqual(list(vals.missing), [0, 0, 1, 4, 0])
+        self.assertEqual(list(vals), [1, 2.5, mvs[0], mvs[3], -4])
+        
+        # values given are copied, not shared
+        arr = array('d', [1.0, 2.0])
+        copied = StataVarVals(arr)
+        copied += 1
+        self.assertEqual(list(arr), [1.0, 2.0])
+        codes = bytearray([0, 1])
+        copied = StataVarVals(array('d', [1.0, mvs[0].value]), codes)
+        copied[1] = 3
+        self.assertEqual(list(codes), [0, 1])
+        self.assertRaises(ValueError, bool, StataVarVals([]))
+        self.assertRaises(ValueError, bool, vals)
+        self.assertTrue(StataVarVals([2]))
+        
+        # missing operands and out-of-range results give .
+        self.assertEqual(list(vals + 1), [2, 3.5, mvs[0], mvs[0], -3])
+        self.assertEqual(list(1 / (vals + 1)), [0.5, 1/3.5, mvs[0], mvs[0], -1/3])
+        self.assertEqual(list(vals / 0), [mvs[0]] * 5)
+        self.assertEqual(list(vals ** 0.5)[3:], [mvs[0], mvs[0]])
+        self.assertEqual(list(vals * vals), [1, 6.25, mvs[0], mvs[0], 16])
+        self.assertEqual(list(abs(vals)), [1, 2.5, mvs[0], mvs[3], 4])
+        
+        # comparisons use Stata's ordering
+        self.assertEqual(list(vals > 2), [0, 1, 1, 1, 0])
+        self.assertEqual(list(vals == mvs[3]), [0, 0, 0, 1, 0])
+        
+        # in-place operators write into the existing array
+        values = vals.values
+        vals *= 2
+        self.assertIs(vals.values, values)
+        self.assertEqual(list(vals), [2, 5, mvs[0], mvs[0], -8])
+        
+        # arithmetic on Stata variables
+        rep78 = self.m.rep78_ * 1
+        self.assertEqual(rep78.missing.count(1), 5)
+        self.assertEqual(list(rep78), self.m.rep78_[:])
+        
+    def test_StataVarExpr(self):
+        m = self.m
+        length, weight = m.length_[:], m.weight_[:]
+        
+        expr = m.length_ + 2 * m.weight_
+        self.assertTrue(isinstance(expr, StataVarExpr))
+        self.assertEqual(len(expr), 74)
+        self.assertEqual(list(expr), [l + 2 * w for l, w in zip(length, weight)])
+        
+        # evaluation in chunks gives the same values
+        expr = st_round(st_sqrt(m.weight_)) - m.rep78_
+        self.assertTrue(isinstance(expr, StataVarExpr))
+        values = expr.values
+        expr.chunk_size = 5
+        self.assertEqual(expr.values, values)
+        self.assertEqual(list(expr.missing), [int(r is mvs[0]) for r in m.rep78_])
+        
+        # values are calculated on assignment, from current data
+        backup = m.mpg_[:]
+        m.mpg_ = m.mpg_ * 2 + 1
+        self.assertEqual(m.mpg_[:], [2 * v + 1 for v in backup])
+        m.mpg_ -= 1
+        self.assertEqual(m.mpg_[:], [2 * v for v in backup])
+        m.mpg_ = backup
+        self.assertEqual(m.mpg_[:], backup)
+        
+    def test_StataMask(self):
+        m = self.m
+        mpg, foreign = m.mpg_[:], m.foreign_[:]
+        
+        high = m.mpg_ > 25
+        self.assertTrue(isinstance(high, StataMask))
+        self.assertEqual(len(high), 74)
+        self.assertEqual(list(high), [v > 25 for v in mpg])
+        self.assertEqual(high.count(), sum(v > 25 for v in mpg))
+        self.assertRaises(ValueError, bool, high)
+        
+        both = high & (m.foreign_ == 1)
+        self.assertEqual(list(both), [v > 25 and f == 1 for v, f in zip(mpg, foreign)])
+        self.assertEqual(list(high | ~high), [True] * 74)
+        self.assertTrue((high ^ high).count() == 0 and (high | True).all())
+        self.assertEqual(list(both.indices()), [i for i in range(74) if both[i]])
+        self.assertEqual(m.make_[both], [m.make_[i] for i in both.indices()])
+        self.assertEqual(
+            st_view(both, 0).to_list(), [[m.make_[i]] for i in both.indices()]
+        )
+        self.assertRaises(ValueError, st_view, high[:10])
+        
+        # masked assignment, with one value or one per selected row
+        m.mpg_[high] = 0
+        self.assertEqual(m.mpg_[:], [0 if v > 25 else v for v in mpg])
+        m.mpg_[high] = [v for v in mpg if v > 25]
+        self.assertEqual(m.mpg_[:], mpg)
+        self.assertRaises(ValueError, m.mpg_.__setitem__, high, [1, 2])
+        
+        # masks from conditional functions
+        rep78 = m.rep78_[:]
+        self.assertEqual(st_missing(m.rep78_).count(), 5)
+        self.assertEqual(st_inlist(m.make_, "AMC Pacer", "Buick Opel").count(), 2)
+        self.assertEqual(list(st_inrange(m.rep78_, 3, None)), 
+                         [r is not mvs[0] and r >= 3 for r in rep78])
+        self.assertEqual(list(st_cond(st_missing(m.rep78_), 0, m.rep78_)), 
+                         [0 if r is mvs[0] else r for r in rep78])
+        
+    def test_stata_math_vectorized(self):
+        # vectorized functions give the same values as scalar functions
+        values = [0, 0.5, -0.5, 1, -1, 2.5, -3, 8, 30, 750, 1e300, -1e308, 
+                  None, mvs[3]]
+        vals = StataVarVals(values)
+        for func in (st_abs, st_acos, st_acosh, st_asin, st_asinh, st_atan, 
+                st_atanh, st_ceil, st_cloglog, st_cos, st_cosh, st_digamma, 
+                st_exp, st_floor, st_int, st_invcloglog, st_invlogit, st_ln, 
+                st_lnfactorial, st_lngamma, st_log10, st_logit, st_sign, 
+                st_sin, st_sinh, st_sqrt, st_tan, st_tanh, st_trigamma):
+            self.assertEqual(list(func(vals)), [func(v) for v in values])
+        for func in (st_atan2, st_comb, st_mod, st_reldif, st_round, 
+                     st_max, st_min):
+            for other in (2, 0, mvs[1], vals):
+                if isinstance(other, StataVarVals):
+                    others = list(other)
+                else:
+                    others = [other] * len(values)
+                self.assertEqual(list(func(vals, other)), 
+                    [func(v, o) for v, o in zip(values, others)])
+                self.assertEqual(list(func(other, vals)), 
+                    [func(o, v) for v, o in zip(values, others)])
+        self.assertEqual(st_sum(vals), sum(values[:-3]))
+        for func, args in ((st_cond, (vals, 1, -1)), 
+                (st_cond, (vals, vals, 2, mvs[5])), (st_cond, (vals, "a", "b")), 
+                (st_inlist, (vals, 0, 8, mvs[3])), (st_inrange, (vals, -1, 2.5)), 
+                (st_inrange, (vals, None, 1)), (st_missing, (vals, 2)), 
+                (st_clip, (vals, -1, 8)), (st_clip, (vals, 0, None))):
+            self.assertEqual(list(func(*args)), 
+                [func(*(v if a is vals else a for a in args)) for v in values])
+        # arguments are not changed
+        st_max(vals, None)
+        self.assertEqual(list(vals), list(StataVarVals(values)))
+        
+        # values looked up in tables are the same as calculated values
+        import math
+        for n in (0, 1, 5, 170, 65535, 65536, 100000):
+            self.assertEqual(st_lnfactorial(n), math.lgamma(n + 1))
+            self.assertEqual(st_lngamma(n + 1), math.lgamma(n + 1))
+        ints = StataVarVals([float(n) for n in range(300)])
+        self.assertEqual(list(st_lnfactorial(ints)), 
+                         [math.lgamma(n + 1) for n in range(300)])
+        self.assertEqual([st_comb(50, k) for k in (0, 3, 25)] * 2, 
+                         [1, 19600, 126410606437752.0] * 2)
+        
+        # calculation in parts, in threads, gives the same values
+        import stata_math
+        vals = StataVarVals(values * 100)
+        funcs = (st_digamma, st_lngamma, lambda v: st_round(v, 0.5), 
+                 lambda v: st_reldif(v, 1))
+        expected = [list(func(vals)) for func in funcs]
+        threads, min_part = stata_math.threads, stata_math._MIN_PART
+        stata_math.threads, stata_math._MIN_PART = 3, 100
+        try:
+            self.assertEqual([list(func(vals)) for func in funcs], expected)
+        finally:
+            stata_math.threads, stata_math._MIN_PART = threads, min_part
+        
+    def test_stata_string(self):
+        # vectorized functions give the same values as scalar functions
+        strings = ["  AMC Concord ", "Buick Opel", "", "a b  c", "abcdef"]
+        vals = StataVarVals(strings)
+        for func, args in ((st_lower, ()), (st_upper, ()), (st_trim, ()), 
+                (st_ltrim, ()), (st_rtrim, ()), (st_strlen, ()), 
+                (st_strpos, ("c",)), (st_subinstr, ("c", "Z", 1)), 
+                (st_subinstr, (" ", "", None)), (st_substr, (2, 3)), 
+                (st_substr, (-3, 2)), (st_substr, (2, None)), 
+                (st_word, (2,)), (st_word, (-1,)), (st_regexm, ("[A-Z]",))):
+            self.assertEqual(list(func(vals, *args)), 
+                             [func(s, *args) for s in strings])
+        self.assertEqual(st_substr("abcdef", -3, mvs[0]), "def")
+        self.assertEqual(st_substr("abcdef", 15, 2), "")
+        self.assertEqual(st_word("a\tb  c", 2), "c")
+        
+        # matches are kept for st_regexs
+        self.assertEqual(st_regexm(vals, "([A-Z])[a-z]+").count(), 2)
+        self.assertEqual(list(st_regexs(1)), ["C", "B", "", "", ""])
+        self.assertEqual(st_regexm("Buick Opel", "(O)pel"), 1)
+        self.assertEqual(st_regexs(0), "Opel")
+        
+        # numeric results can be stored in numeric variables
+        m = self.m
+        make, mpg = m.make_[:], m.mpg_[:]
+        self.assertTrue(isinstance(st_strlen(m.make_), StataVarExpr))
+        m.mpg_ = st_strlen(m.make_)
+        self.assertEqual(m.mpg_[:], [len(s) for s in make])
+        m.mpg_ = st_strpos(m.make_, " ")
+        self.assertEqual(m.mpg_[:], [s.find(" ") + 1 for s in make])
+        m.mpg_ = mpg
+        self.assertEqual(
+            st_regexm(m.make_, "^Buick").count(), 
+            sum(s.startswith("Buick") for s in make)
+        )
+        
+
     def test___iter__(self):
         m = self.m
         it = iter(m)
@@ -1611,6 +2097,77 @@ class TestMirror(unittest.TestCase):
     def test_list(self):
         pass
         
+    def test_iter_chunks(self):
+        m = self.m
+        rows = [row for c in m.iter_chunks(20) for row in zip(*c)]
+        self.assertEqual([list(r) for r in rows], m.to_list())
+        self.assertEqual([len(c[0]) for c in m.iter_chunks(20)], 
+                         [20, 20, 20, 14])
+        
+    def test_changed_only(self):
+        m = self.m
+        oldmake = m.make_[:]
+        oldmpg = m.mpg_[:]
+        
+        newmpg = oldmpg[:]
+        newmpg[5] = newmpg[5] + 1
+        self.assertEqual(st_store_array("mpg", newmpg, changed_only=True), 1)
+        self.assertEqual(st_store_array("mpg", oldmpg, changed_only=True), 1)
+        self.assertEqual(
+            st_sstore_list("make", oldmake[:3], changed_only=True), 0
+        )
+        
+        with m.changed_only() as count:
+            self.assertRaises(ValueError, m.changed_only().__enter__)
+            m.mpg_ = st_round(m.mpg_, 1)
+            self.assertEqual((count.compared, count.written), (74, 0))
+            m.mpg_ += (m.mpg_ > 40)
+            m.make_ = oldmake[:-1] + ["x"]
+            m.mpg_.values = oldmpg
+        self.assertEqual((count.compared, count.written), (296, 3))
+        self.assertEqual(m.mpg_[:], oldmpg)
+        self.assertEqual(m.make_[-1], "x")
+        
+        m.make_ = oldmake
+        
+    def test_buffered(self):
+        m = self.m
+        self.assertRaises(TypeError, m.buffered(2.5).__enter__)
+        self.assertRaises(ValueError, m.buffered(0).__enter__)
+        
+        oldmake = m.make_[:]
+        oldmpg = m.mpg_[:]
+        
+        with m.buffered() as b:
+            self.assertTrue(b is m)
+            self.assertRaises(ValueError, m.buffered().__enter__)
+            for i in range(74):
+                m.mpg_[i] = i
+            m.mpg_[-1] = None
+            m.make_[3] = "x"
+            self.assertRaises(TypeError, m.mpg_.__setitem__, 0, "x")
+            self.assertRaises(TypeError, m.make_.__setitem__, 0, 1.0)
+            self.assertRaises(IndexError, m.mpg_.__setitem__, 74, 1.0)
+            # pending values are seen, but not yet written
+            self.assertEqual(m.mpg_[5], 5.0)
+            self.assertEqual(m.get(73, 2), mvs[0])
+            self.assertEqual(m.make_[3], "x")
+            self.assertEqual(st_data(3, 2)[0][0], oldmpg[3])
+        self.assertEqual(m.mpg_[:], list(range(73)) + [mvs[0]])
+        self.assertEqual(m.make_[3], "x")
+        
+        v = st_view(None, (2, 0))
+        with v.buffered(size=2):
+            v[0, 0] = 100
+            self.assertEqual(st_data(0, 2)[0][0], 0.0)
+            v[1, 0] = 101
+            self.assertEqual(st_data(0, 2)[0][0], 100.0)
+            v[2, :] = (102, "y")
+            self.assertEqual(v.to_list()[2], [102.0, "y"])
+        
+        m.make_ = oldmake
+        m.mpg_ = oldmpg
+        
     def test_to_list(self):
         self.assertEqual(
             self.m[::6,::4].to_list(), 
@@ -1650,6 +2207,20 @@ class TestMirror(unittest.TestCase):
         self.assertEqual(self.m.get(1,1), 4749.0)
         self.assertTrue(abs(self.m.get(-1,-2) - 2.98) < 1e-6)
         
+    def test__metadata(self):
+        m = self.m
+        meta = m._metadata()
+        self.assertEqual((meta["nobs"], meta["nvar"]), (74, 12))
+        self.assertEqual(meta["isstr"], (1,) + (0,) * 11)
+        self.assertEqual(m.index("tr"), 5)
+        self.assertEqual(meta["index"]["tr"], 5)
+        self.assertRaises(ValueError, m.index, "nosuchvar")
+        self.assertEqual(len(m), 74)
+        self.assertEqual((m._rownums, m._colnums), (range(74), range(12)))
+        self.assertTrue(m._metadata() is meta)
+        self.assertEqual(m._getter(0)(3, 0), "AMC Spirit")
+        self.assertEqual(m._getter(-1)(3, -1), 0.0)
+        
     def test___str__(self):
         self.assertEqual(
             self.m[::6, ::4].__str__(),
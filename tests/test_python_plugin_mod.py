@@ -11,6 +11,18 @@ class TestSmallFuncs(unittest.TestCase):
         
     def test_st_in2(self): # not in mata
         self.assertEqual(st_in2(), 70)
+        
+    def test_st_touse(self): # not in mata
+        mask = st_touse()
+        self.assertEqual(len(mask), 74)
+        self.assertEqual([i for i in range(74) if mask[i]], list(range(4,70,2)))
+        
+    def test_st_touse_obs(self): # not in mata
+        self.assertEqual(list(st_touse_obs()), list(range(4,70,2)))
+        
+    def test_st_view_touse(self): # not in mata
+        self.assertEqual(st_view(touse=True).rows, tuple(range(4,70,2)))
+        self.assertEqual(st_view((71, 10, 5, 4, -70), touse=True).rows, (10, 4, 4))
 
         
 suite = unittest.TestLoader().loadTestsFromTestCase(TestSmallFuncs)